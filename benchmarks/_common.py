@@ -0,0 +1,116 @@
+"""Shared helpers for the benchmark scripts."""
+import json
+import os
+import re
+import sys
+from typing import Any, Callable, Dict, List
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tdd_gpt")
+sys.path.insert(0, PACKAGE_DIR)
+
+
+def get_token_counter() -> Callable[[str], int]:
+    """Return a tiktoken based counter, or a regex approximation when the encoding cannot be loaded offline."""
+    try:
+        import tiktoken
+
+        encoding = tiktoken.get_encoding("cl100k_base")
+        return lambda text: len(encoding.encode(text))
+    except Exception:
+        print("warning: tiktoken encoding unavailable, using an approximate token counter")
+        pattern = re.compile(r"\w+|[^\w\s]")
+        return lambda text: len(pattern.findall(text))
+
+
+def project_steps(output_dir: str, files: int, steps: int) -> List[Dict[str, Any]]:
+    """Commands of a synthetic TDD project: write tests and components, run the tests, finish."""
+    commands = []
+    for n in range(steps - 1):
+        i = n % files
+        if n % 4 == 3:
+            commands.append({"name": "cli", "args": {"commands": [f"cd {output_dir}", "echo 'Tests: 1 failed, 3 passed'"]}})
+        elif n % 4 == 2 and n >= files:
+            commands.append({"name": "read_file", "args": {"file_path": f"{output_dir}/src/components/Component{i}.js"}})
+        else:
+            body = "".join(f"export function part{k}(props) {{\n  return props.value + {k};\n}}\n" for k in range(10))
+            commands.append({"name": "write_file", "args": {"file_path": f"{output_dir}/src/components/Component{i}.js", "text": body}})
+    commands.append({"name": "finish", "args": {"response": "All tasks are completed."}})
+
+    for n, command in enumerate(commands):
+        command["thoughts"] = {
+            "role": "Programmer",
+            "phase": "Development",
+            "tests_status": "failing",
+            "text": f"Step {n + 1}: run {command['name']} for the next task.",
+            "reasoning": "The kanban board lists this as the next task.",
+            "criticism": "Keep the steps small.",
+            "kanban": {
+                "todo": [f"Task {k}" for k in range(n + 1, min(n + 6, len(commands)))],
+                "in_progress": "finish the project" if command["name"] == "finish" else f"Task {n}",
+                "done": [f"Task {k}" for k in range(max(0, n - 5), n)],
+            },
+        }
+    return commands
+
+
+def history_step_messages(step: int, files: int, kind: str = "write_file") -> List[Any]:
+    """The Human, AI and System messages the agent adds to the chat history for a step."""
+    from langchain.schema.messages import AIMessage, HumanMessage, SystemMessage
+
+    file_path = f"/tmp/app/src/components/Component{step % files}.js"
+    code = "".join(f"export function part{k}(props) {{\n  return props.value + {k + step};\n}}\n" for k in range(30))
+    code_str = ""
+    if kind == "cli":
+        file_path = ""
+        args = {"commands": ["cd /tmp/app", "CI=true npm test"]}
+        output = "\n".join(f"  \u2713 renders part {k} ({k % 7 + 1} ms)" for k in range(60))
+        result = f"The cli tool returned: The commands failed.\nTests: 1 failed, 59 passed\n{output}"
+        action = "executing cli commands 'cd /tmp/app && CI=true npm test'"
+    else:
+        args = {"file_path": file_path, "text": code} if kind == "write_file" else {"file_path": file_path}
+        code_str = f"\n```\n// {file_path}\n{code}\n```"
+        result = f"The {kind} tool returned: " + (f"File written successfully to {file_path}." if kind == "write_file" else code)
+        action = f"{'writing' if kind == 'write_file' else 'reading'} file {file_path}"
+    metadata = json.dumps({"step": step, "role": "Programmer", "phase": "Development", "Action": action}, indent=4)
+    return [
+        HumanMessage(content=f"You have completed step {step - 1}. Determine the next step and respond using the json specified in Response Format section."),
+        AIMessage(content=json.dumps({"thoughts": {"text": f"Step {step}"}, "command": {"name": kind, "args": args}})),
+        SystemMessage(content=result,
+                      additional_kwargs={"metadata": f"```json\n{metadata}\n```", "code": code_str, "file_path": file_path, "summary_tier": "passthrough"}),
+    ]
+
+
+def json_reply(command: Dict[str, Any]) -> str:
+    return json.dumps({"thoughts": command["thoughts"], "command": {"name": command["name"], "args": command["args"]}}, indent=4)
+
+
+def function_call(command: Dict[str, Any]) -> Dict[str, Any]:
+    thoughts = {key: value for key, value in command["thoughts"].items() if key not in ("reasoning", "criticism")}
+    return {"name": command["name"], "arguments": {"thoughts": thoughts, **command["args"]}}
+
+
+def build_agent(llm, output_dir: str, context_window: int = 16000, embedding_size: int = 64, cli_tool=None, embeddings=None, **kwargs):
+    """Build a TddGPTAgent on local fakes only: fake embeddings and a canned summarizer."""
+    os.environ.setdefault("OPENAI_API_KEY", "offline")
+    import faiss
+    from langchain.docstore import InMemoryDocstore
+    from langchain.embeddings import FakeEmbeddings
+    from langchain.tools.file_management.read import ReadFileTool
+    from langchain.tools.file_management.write import WriteFileTool
+    from langchain.vectorstores import FAISS
+
+    from agent import TddGPTAgent
+    from cli import CLITool
+    from fakes import ScriptedChatModel
+
+    vectorstore = FAISS(embeddings or FakeEmbeddings(size=embedding_size), faiss.IndexFlatL2(embedding_size), InMemoryDocstore({}), {})
+    summarizer_llm = ScriptedChatModel(responses=["The commands succeeded with the message 'done'."], repeat=True)
+    return TddGPTAgent.from_llm_and_tools(
+        output_dir=output_dir,
+        tools=[cli_tool or CLITool(), WriteFileTool(), ReadFileTool()],
+        llm=llm,
+        memory=vectorstore.as_retriever(),
+        context_window=context_window,
+        summarizer_llm=summarizer_llm,
+        **kwargs,
+    )
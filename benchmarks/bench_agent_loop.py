@@ -0,0 +1,228 @@
+"""End-to-end benchmark of TddGPTAgent.run over synthetic projects of growing size.
+
+The LLM is the local ScriptedChatModel, the memory uses fake embeddings and the summarizer
+a canned model, so the numbers only cover the agent loop itself. A project of N steps
+and F files writes the F components in turn, reads back the last one and runs a cli
+command every four steps. The commands are real processes: a jest stand-in whose report
+lists every component written so far, parsed by the output parsers, and every third time
+a build whose log grows with the project and has to be summarized.
+
+Every size runs in its own process, so the peak RSS is that of the size alone. Sizes of
+up to --allocations_max_steps steps run again under tracemalloc for the allocations, as
+it slows the loop down by an order of magnitude or more. For every size the script
+prints the mean milliseconds per step of each phase of the loop:
+- prompt: formatting the messages
+- llm: the scripted model, with the chain and the callbacks around it
+- parse: the reply
+- tool: running it
+- summarize: condensing the output
+- memory: adding the step memory
+- history: the chat history
+The script also prints the p95 of the whole step, the peak RSS and the peak of traced
+allocations. --output writes the results as JSON, with the commit they were measured
+on. --compare takes such a file and prints the ratio of every number to it.
+
+Usage: python benchmarks/bench_agent_loop.py [--sizes 10:10,100:100,1000:500] [--allocations_max_steps 100]
+       [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from _common import build_agent, json_reply
+
+PHASES = ["prompt", "llm", "parse", "tool", "summarize", "memory", "history"]
+
+JEST_SCRIPT = '''set -- $(ls -tr src/components)
+last=""
+for file; do
+    [ -n "$last" ] && echo "PASS src/tests/${last%.js}.test.js"
+    last=$file
+done
+name=${last%.js}
+echo "FAIL src/tests/$name.test.js"
+printf '  \\342\\227\\217 %s \\342\\200\\272 renders the value\\n\\n' "$name"
+printf '    expect(received).toBe(expected)\\n\\n    Expected: "1"\\n    Received: 1\\n\\n'
+printf "      3 | test('renders the value', () => {\\n    > 4 |   expect(render%s(1)).toBe('1');\\n" "$name"
+printf '      at Object.<anonymous> (src/tests/%s.test.js:4:27)\\n\\n' "$name"
+echo "Tests:       1 failed, $(($# - 1)) passed, $# total"
+exit 1
+'''
+
+BUILD_SCRIPT = '''n=0
+for file in src/components/*.js; do
+    echo "[$n] compiling $file -> build/${file#src/} ($((n % 97 + 3)) modules, $((n * 37 % 1000)) kB)"
+    n=$((n + 1))
+done
+echo "warning: bundle size exceeds the recommended limit"
+echo "Compiled with warnings."
+'''
+
+
+def component(i, step):
+    return "".join(f"export function render{i}Part{k}(value) {{\n  return `${{value}}-{k}-{step}`;\n}}\n" for k in range(12))
+
+
+def synthetic_project(output_dir, steps, files):
+    """Commands of a project of steps steps over files components."""
+    commands = []
+    written = 0
+    for n in range(steps - 1):
+        path = f"{output_dir}/src/components/Component{(written - 1) % files}.js"
+        if n % 4 == 3:
+            script = "build" if n % 12 == 11 else "jest"
+            commands.append({"name": "cli", "args": {"commands": [f"cd {output_dir}", f"sh bin/{script}"]}})
+        elif n % 4 == 2:
+            commands.append({"name": "read_file", "args": {"file_path": path}})
+        else:
+            path = f"{output_dir}/src/components/Component{written % files}.js"
+            commands.append({"name": "write_file", "args": {"file_path": path, "text": component(written % files, n)}})
+            written += 1
+    commands.append({"name": "finish", "args": {"response": "All tasks are completed."}})
+
+    for n, command in enumerate(commands):
+        command["thoughts"] = {
+            "role": "Programmer",
+            "phase": "Development",
+            "tests_status": "failing",
+            "text": f"Step {n + 1}: run {command['name']} for the next component.",
+            "reasoning": "The kanban board lists this as the next task.",
+            "criticism": "Keep the steps small.",
+            "kanban": {
+                "todo": [f"Component {k}" for k in range(n + 1, min(n + 6, len(commands)))],
+                "in_progress": "finish the project" if command["name"] == "finish" else f"Component {n}",
+                "done": [f"Component {k}" for k in range(max(0, n - 5), n)],
+            },
+        }
+    return commands
+
+
+def run_size(steps, files, allocations):
+    """Run one project in this process and return its results."""
+    from fakes import ScriptedChatModel
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        os.makedirs(os.path.join(output_dir, "bin"))
+        os.makedirs(os.path.join(output_dir, "src", "components"))
+        for name, script in (("jest", JEST_SCRIPT), ("build", BUILD_SCRIPT)):
+            with open(os.path.join(output_dir, "bin", name), "w") as f:
+                f.write(script)
+        replies = [json_reply(command) for command in synthetic_project(output_dir, steps, files)]
+        agent = build_agent(ScriptedChatModel(responses=replies), output_dir)
+
+        if allocations:
+            tracemalloc.start()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            agent.run(["Build the components"])
+        wall = time.perf_counter() - start
+        result = {"steps": steps, "files": files}
+        if allocations:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            return {**result, "alloc_peak_mb": round(peak / 2 ** 20, 2)}
+
+    totals = [timings["total"] for timings in agent.step_timings]
+    phases = {phase: round(sum(timings.get(phase, 0.0) for timings in agent.step_timings) / len(totals) * 1000, 3) for phase in PHASES}
+    return {
+        **result,
+        "wall_s": round(wall, 3),
+        "step_ms": round(statistics.mean(totals) * 1000, 3),
+        "step_p95_ms": round(sorted(totals)[int(len(totals) * 0.95)] * 1000, 3),
+        "phase_ms": phases,
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10), 1),
+        "summary_tiers": agent.text_summarizer.stats,
+    }
+
+
+def child(steps, files, allocations):
+    """Run one size in a new process, so that its peak RSS is its own."""
+    command = [sys.executable, os.path.abspath(__file__), "--child", f"{steps}:{files}"]
+    if allocations:
+        command.append("--allocations")
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(result):
+    numbers = {key: value for key, value in result.items() if isinstance(value, (int, float))}
+    numbers.update({f"{phase} ms": value for phase, value in result.get("phase_ms", {}).items()})
+    return numbers
+
+
+def print_results(results, baseline=None):
+    previous = {(r["steps"], r["files"]): flatten(r) for r in (baseline or {}).get("results", [])}
+    print(f"{'steps':>6} {'files':>6} " + " ".join(f"{phase:>9}" for phase in PHASES)
+          + f" {'step ms':>9} {'p95 ms':>9} {'RSS MB':>7} {'alloc MB':>9}")
+    for result in results:
+        phases = result["phase_ms"]
+        print(f"{result['steps']:>6} {result['files']:>6} " + " ".join(f"{phases[phase]:>9.3f}" for phase in PHASES)
+              + f" {result['step_ms']:>9.3f} {result['step_p95_ms']:>9.3f} {result['peak_rss_mb']:>7.1f} {result.get('alloc_peak_mb', float('nan')):>9.2f}")
+        before = previous.get((result["steps"], result["files"]))
+        if before:
+            now = flatten(result)
+            ratios = {key: now[key] / before[key] for key in now if key in before and before[key] and key not in ("steps", "files")}
+            print(f"{'':>13} vs {baseline.get('commit')}: " + ", ".join(f"{key} x{ratio:.2f}" for key, ratio in ratios.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=str, default="10:10,100:100,1000:500", help="steps:files of the projects")
+    parser.add_argument("--allocations_max_steps", type=int, default=100, help="largest size run again under tracemalloc, 0 for none")
+    parser.add_argument("--output", type=str, help="write the results to this JSON file")
+    parser.add_argument("--compare", type=str, help="JSON results of an earlier run to compare with")
+    parser.add_argument("--child", type=str, help=argparse.SUPPRESS)
+    parser.add_argument("--allocations", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        steps, files = (int(n) for n in args.child.split(":"))
+        print(json.dumps(run_size(steps, files, args.allocations)))
+        return
+
+    results = []
+    for size in args.sizes.split(","):
+        steps, files = (int(n) for n in size.split(":"))
+        result = child(steps, files, allocations=False)
+        if steps <= args.allocations_max_steps:
+            result.update(child(steps, files, allocations=True))
+        results.append(result)
+
+    report = {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Compare the per-step critical path of TddGPTAgent.run and TddGPTAgent.arun.
+
+The LLM is the local ScriptedChatModel and the memory embeddings are fake ones that
+sleep --embedding_latency seconds per call, standing in for a remote embedding API.
+The chat history is a FileChatMessageHistory, rewritten on every message. The script
+prints the average seconds per step spent in each phase for both loops. In arun the
+embeddings and history writes run in background queues, so only the time spent
+submitting them ("background") stays on the critical path, unless the embeddings are
+slower than the steps and the bounded queues push back.
+
+Usage: python benchmarks/bench_async_loop.py [--steps 30] [--latency 0.3] [--embedding_latency 0.15]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import tempfile
+import time
+from typing import List
+
+from _common import build_agent, json_reply, project_steps
+from fakes import ScriptedChatModel
+from langchain.embeddings import FakeEmbeddings
+from langchain.memory.chat_message_histories import FileChatMessageHistory
+
+
+class SlowEmbeddings(FakeEmbeddings):
+    latency: float = 0.0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency)
+        return super().embed_documents(texts)
+
+
+def run(args, use_async):
+    with tempfile.TemporaryDirectory() as output_dir:
+        replies = [json_reply(command) for command in project_steps(output_dir, files=5, steps=args.steps)]
+        llm = ScriptedChatModel(responses=replies, latency=args.latency)
+        agent = build_agent(
+            llm,
+            output_dir,
+            embeddings=SlowEmbeddings(size=64, latency=args.embedding_latency),
+            chat_history_memory=FileChatMessageHistory(os.path.join(output_dir, "history.json")),
+        )
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if use_async:
+                asyncio.run(agent.arun(["Build the components"]))
+            else:
+                agent.run(["Build the components"])
+        elapsed = time.perf_counter() - start
+        saved = len(FileChatMessageHistory(os.path.join(output_dir, "history.json")).messages)
+        return elapsed, agent.timing_summary(), saved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--steps", type=int, default=30)
+    parser.add_argument("--latency", type=float, default=0.3, help="simulated seconds per LLM reply")
+    parser.add_argument("--embedding_latency", type=float, default=0.15, help="simulated seconds per embedding call")
+    args = parser.parse_args()
+
+    phases = ["llm", "tool", "summarize", "history", "memory", "background", "total"]
+    print(f"{'loop':>5} {'wall s':>7} " + " ".join(f"{phase:>10}" for phase in phases) + f" {'messages':>9}")
+    for name, use_async in [("run", False), ("arun", True)]:
+        elapsed, timings, saved = run(args, use_async)
+        print(f"{name:>5} {elapsed:>7.2f} " + " ".join(f"{timings.get(phase, 0.0) * 1000:>8.1f}ms" for phase in phases) + f" {saved:>9}")
+
+
+if __name__ == "__main__":
+    main()
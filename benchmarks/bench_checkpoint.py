@@ -0,0 +1,103 @@
+"""Checkpoint a long agent run, crash it part way and resume it from the checkpoint.
+
+The run uses the local ScriptedChatModel, fake embeddings and a journal chat history.
+It crashes when the script is cut at --crash_step, after half of the next step was
+written to the history. The resumed run rebuilds the agent the way main.py does with
+--resume: the journal is truncated to the checkpoint, the vector memory is loaded and
+the memories of the later steps are added back from the history. The script prints the
+checkpoint cost per step and the resume time, and exits non-zero if the resumed run
+does not continue at the next step or ends with different files, history or memory
+than an uninterrupted run.
+
+Usage: python benchmarks/bench_checkpoint.py [--steps 200] [--crash_step 137] [--memory_every 10]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+from _common import build_agent, json_reply, project_steps
+from checkpoint import CheckpointManager
+from fakes import ScriptedChatModel
+from history import JournalChatMessageHistory
+from langchain.schema.messages import HumanMessage
+
+
+def snapshot(output_dir):
+    files = {}
+    for directory, _, names in os.walk(os.path.join(output_dir, "src")):
+        for name in names:
+            with open(os.path.join(directory, name)) as f:
+                files[os.path.relpath(os.path.join(directory, name), output_dir)] = f.read()
+    return files
+
+
+def start(output_dir, replies, memory_every):
+    checkpoints = CheckpointManager(os.path.join(output_dir, ".checkpoint"), output_dir, memory_every=memory_every)
+    history = JournalChatMessageHistory(os.path.join(checkpoints.directory, "history.jsonl"))
+    agent = build_agent(ScriptedChatModel(responses=replies), output_dir, chat_history_memory=history, checkpoints=checkpoints)
+    return agent, history
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--crash_step", type=int, default=137, help="steps completed before the crash")
+    parser.add_argument("--memory_every", type=int, default=10)
+    args = parser.parse_args()
+    failures = 0
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        replies = [json_reply(command) for command in project_steps(output_dir, files=8, steps=args.steps)]
+        agent, history = start(output_dir, replies, args.memory_every)
+        with contextlib.redirect_stdout(io.StringIO()):
+            agent.run(["Build the components"])
+        expected = (snapshot(output_dir), len(history), len(agent.memory.vectorstore.docstore._dict))
+        checkpoint = agent.checkpoints.stats
+        history.close()
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        replies = [json_reply(command) for command in project_steps(output_dir, files=8, steps=args.steps)]
+        agent, history = start(output_dir, replies[:args.crash_step], args.memory_every)
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                agent.run(["Build the components"])
+            except IndexError:
+                pass
+        history.add_message(HumanMessage(content=f"You have completed step {args.crash_step}. Half a step."))
+        history.close()
+
+        begin = time.perf_counter()
+        checkpoints = CheckpointManager(os.path.join(output_dir, ".checkpoint"), output_dir, memory_every=args.memory_every)
+        saved = checkpoints.load()
+        history = JournalChatMessageHistory(saved.history_path)
+        dropped = len(history) - saved.messages
+        history.truncate(saved.messages)
+        agent = build_agent(ScriptedChatModel(responses=replies[saved.step:]), output_dir, chat_history_memory=history, checkpoints=checkpoints)
+        agent.memory.vectorstore = checkpoints.restore_memory(saved, agent.memory.vectorstore, history.messages)
+        changed = checkpoints.changed_files(saved)
+        resumed = time.perf_counter() - begin
+        restored = len(agent.memory.vectorstore.docstore._dict)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            agent.run(saved.goals, start_step=saved.step, user_input=saved.user_input)
+        actual = (snapshot(output_dir), len(history), len(agent.memory.vectorstore.docstore._dict))
+        first = history.messages[saved.messages]
+        history.close()
+
+    print(f"checkpoints: {checkpoint['saves']} saves, {checkpoint['memory_saves']} with the memory, "
+          f"{checkpoint['seconds'] / max(checkpoint['saves'], 1) * 1000:.2f} ms/step")
+    print(f"resume at step {saved.step + 1} (memory of step {saved.memory_step}): {resumed * 1000:.1f} ms, "
+          f"{dropped} messages dropped, {restored} memories, {len(changed)} files changed")
+    failures += saved.step != args.crash_step or dropped != 1 or bool(changed)
+    failures += not first.content.startswith(f"You have completed step {args.crash_step}.")
+    failures += restored != args.crash_step or actual != expected
+    print("resumed run matches the uninterrupted run" if actual == expected else "resumed run differs from the uninterrupted run")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Stress the output capture of the cli tool with a command that emits --mb megabytes.
+
+Each capture runs in a fresh child process, so its peak memory can be reported on its own.
+The line readline based capture the tool used before is included for comparison with
+--legacy. The progress mode emits a carriage return progress bar without any newline.
+
+Usage: python benchmarks/bench_cli_capture.py [--mb 100] [--mode lines|progress] [--legacy]
+"""
+import argparse
+import json
+import resource
+import select
+import subprocess
+import sys
+import time
+
+import _common  # noqa: F401
+
+EMITTERS = {
+    "lines": "import sys\nline = b'npm WARN deprecated some-package@1.0.0: this library is no longer supported\\n'\n"
+             "for _ in range({mb} * 1024 * 1024 // len(line)):\n    sys.stdout.buffer.write(line)\n",
+    "progress": "import sys\n"
+                "for i in range({mb} * 1024 * 1024 // 64):\n    sys.stdout.buffer.write(b'\\r[' + b'#' * 40 + b'] ' + str(i).encode().rjust(20))\n",
+}
+
+
+def legacy_capture(cmd, timeout_sec):
+    """The capture loop of run_command_with_timeout before the output was bounded."""
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
+    output = ''
+    while True:
+        ret = select.select([proc.stdout.fileno()], [], [], timeout_sec)
+        if proc.stdout.fileno() in ret[0]:
+            line = proc.stdout.readline()
+            if line:
+                output += line.decode()
+            else:
+                break
+        else:
+            proc.kill()
+            return f"Command '{cmd}' timed out after {timeout_sec} seconds of inactivity on stdout {output}"
+    if proc.poll():
+        return f"Command '{cmd}' failed with error: {output}"
+    return f"Command '{cmd}' succeeded with the following output:\n{output}"
+
+
+def child(args):
+    from cli import CLITool
+
+    command = f"{sys.executable} -c \"{EMITTERS[args.mode].format(mb=args.mb)}\""
+    start = time.perf_counter()
+    if args.variant == "legacy":
+        output = legacy_capture(command, 60)
+    else:
+        output = CLITool().run({"commands": [command]})
+    elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"seconds": elapsed, "peak_mb": peak_kb / 1024, "output_kb": len(output) / 1024}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mb", type=int, default=100)
+    parser.add_argument("--mode", choices=sorted(EMITTERS), default="lines")
+    parser.add_argument("--legacy", action="store_true", help="also run the readline based capture")
+    parser.add_argument("--variant", choices=["bounded", "legacy"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        child(args)
+        return
+
+    print(f"emitting {args.mb} MB ({args.mode})")
+    print(f"{'capture':>8} {'seconds':>8} {'MB/s':>8} {'peak MB':>8} {'kept KB':>8}")
+    for variant in ["bounded"] + (["legacy"] if args.legacy else []):
+        result = subprocess.run(
+            [sys.executable, __file__, "--variant", variant, "--mb", str(args.mb), "--mode", args.mode],
+            capture_output=True, text=True, check=True,
+        )
+        stats = json.loads(result.stdout.strip().splitlines()[-1])
+        print(f"{variant:>8} {stats['seconds']:>8.2f} {args.mb / stats['seconds']:>8.0f} "
+              f"{stats['peak_mb']:>8.0f} {stats['output_kb']:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
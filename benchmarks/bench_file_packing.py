@@ -0,0 +1,115 @@
+"""Compare the legacy and knapsack packing of the Files section over a recorded or synthetic history.
+
+For every step the prompt is rebuilt from the history so far. A re-read is counted when the
+next step reads a file that was already known but not sent in full in the prompt.
+
+Usage: python benchmarks/bench_file_packing.py [--history chat_history.json] [--context_window 8000]
+"""
+import argparse
+import json
+import random
+
+from _common import get_token_counter
+from langchain.memory.chat_message_histories import FileChatMessageHistory
+from langchain.schema.messages import AIMessage, HumanMessage, SystemMessage
+from langchain.tools.file_management.read import ReadFileTool
+from langchain.tools.file_management.write import WriteFileTool
+
+from cli import CLITool
+from file_index import FileIndex
+from prompt import TddGPTPrompt
+
+OUTPUT_DIR = "/tmp/app"
+
+
+def step_metadata(step, in_progress, result, tests_status="failing"):
+    record = {"step": step, "tests_status": tests_status, "kanban": {"in_progress": in_progress}, "Result": result}
+    return f"```json\n{json.dumps(record, indent=4)}\n```"
+
+
+def synthetic_history(steps, files, seed=0):
+    rng = random.Random(seed)
+    paths = [f"{OUTPUT_DIR}/src/components/Component{i}.js" for i in range(files)]
+    sizes = {path: rng.choice([40, 80, 150, 300, 1500]) for path in paths}
+    messages = []
+    for step in range(1, steps + 1):
+        path = rng.choice(paths)
+        action = rng.choice(["write_file", "write_file", "read_file", "cli"])
+        body = "".join(
+            f"export function {path.rsplit('/', 1)[-1][:-3]}Part{i}(props) {{\n  return props.value + {i};\n}}\n"
+            for i in range(sizes[path] // 12)
+        )
+        code = f"\n```\n// {path}\n{body}\n```" if action != "cli" else ""
+        result = f"FAIL src/tests/{path.rsplit('/', 1)[-1]}" if action == "cli" else "successfully written"
+        command = {"name": action, "args": {"file_path": path}}
+        messages.append(HumanMessage(content=f"You have completed step {step - 1}."))
+        messages.append(AIMessage(content=json.dumps({"command": command})))
+        messages.append(SystemMessage(
+            content=f"The {action} tool returned: ok",
+            additional_kwargs={
+                "metadata": step_metadata(step, f"Fix {path.rsplit('/', 1)[-1]}", result),
+                "code": code,
+                "file_path": path if code else "",
+            },
+        ))
+    return messages
+
+
+def replay(prompt, history, token_counter):
+    steps = [i for i, m in enumerate(history) if isinstance(m, SystemMessage)]
+    file_index = FileIndex(token_counter)
+    tokens_sent = 0
+    re_reads = 0
+    for n, end in enumerate(steps):
+        m = history[end]
+        file_index.update(m.additional_kwargs.get("file_path", ""), m.additional_kwargs.get("code", ""), n + 1)
+        content = prompt.format_messages(
+            goals=["Build a counter app in ReactJS."],
+            messages=history[:end + 1],
+            memory=None,
+            file_index=file_index,
+            user_input=f"You have completed step {n + 1}.",
+        )[0].content
+        tokens_sent += token_counter(content)
+
+        if n + 1 < len(steps):
+            next_ai = next((h for h in history[end + 1:steps[n + 1]] if isinstance(h, AIMessage)), None)
+            try:
+                command = json.loads(next_ai.content)["command"] if next_ai else {}
+            except (json.JSONDecodeError, KeyError):
+                command = {}
+            file_path = command.get("args", {}).get("file_path", "")
+            if command.get("name") == "read_file" and file_path in file_index:
+                header = f"// {file_path}\n"
+                start = content.find(header)
+                if start == -1 or content.startswith("// (skeleton", start + len(header)):
+                    re_reads += 1
+    return tokens_sent, re_reads, len(steps)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--history", type=str, help="Chat history file written by --chat_history_file")
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--files", type=int, default=40)
+    parser.add_argument("--context_window", type=int, default=8000)
+    args = parser.parse_args()
+
+    token_counter = get_token_counter()
+    history = FileChatMessageHistory(args.history).messages if args.history else synthetic_history(args.steps, args.files)
+
+    for strategy in ("legacy", "knapsack"):
+        prompt = TddGPTPrompt(
+            tools=[CLITool(), WriteFileTool(), ReadFileTool()],
+            input_variables=["memory", "messages", "goals", "user_input", "file_index"],
+            token_counter=token_counter,
+            output_dir=OUTPUT_DIR,
+            send_token_limit=args.context_window,
+            file_packing=strategy,
+        )
+        tokens_sent, re_reads, steps = replay(prompt, history, token_counter)
+        print(f"{strategy:>8}: {steps} steps, {tokens_sent / steps:.0f} tokens/step, {re_reads} re-reads")
+
+
+if __name__ == "__main__":
+    main()
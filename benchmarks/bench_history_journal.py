@@ -0,0 +1,101 @@
+"""Write, reopen, recover and compact a long chat history with the JSONL journal.
+
+Each synthetic step adds the three messages of an agent step, the system message
+carrying the code of a file as the agent stores it. FileChatMessageHistory rewrites the
+whole file on every message, so it is only run for --baseline_steps steps. The script
+exits non-zero if a torn last line is not recovered or the reopened journal loses a message.
+
+Usage: python benchmarks/bench_history_journal.py [--steps 1000] [--baseline_steps 200] [--files 20]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from _common import history_step_messages
+from history import JournalChatMessageHistory
+from langchain.memory.chat_message_histories import FileChatMessageHistory
+
+
+def write(history, steps, files):
+    start = time.perf_counter()
+    for step in range(1, steps + 1):
+        for message in history_step_messages(step, files):
+            history.add_message(message)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--steps", type=int, default=1000)
+    parser.add_argument("--baseline_steps", type=int, default=200, help="steps written with FileChatMessageHistory")
+    parser.add_argument("--files", type=int, default=20)
+    args = parser.parse_args()
+    failures = 0
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "history.json")
+        history = FileChatMessageHistory(path)
+        written = 0
+        start = time.perf_counter()
+        for step in range(1, args.baseline_steps + 1):
+            for message in history_step_messages(step, args.files):
+                history.add_message(message)
+                written += os.path.getsize(path)
+        elapsed = time.perf_counter() - start
+        print(f"file history, {args.baseline_steps:5} steps: {elapsed:7.2f} s, {elapsed / args.baseline_steps * 1000:7.2f} ms/step, "
+              f"{written / 2 ** 20:8.1f} MB written")
+
+        for sync_every in (1, 32):
+            path = os.path.join(directory, f"history-{sync_every}.jsonl")
+            journal = JournalChatMessageHistory(path, sync_every=sync_every)
+            elapsed = write(journal, args.steps, args.files)
+            journal.close()
+            written = os.path.getsize(path) + os.path.getsize(journal.index_path)
+            print(f"journal, fsync every {sync_every:2}, {args.steps:5} steps: {elapsed:7.2f} s, {elapsed / args.steps * 1000:7.2f} ms/step, "
+                  f"{written / 2 ** 20:8.1f} MB written")
+
+        expected = 3 * args.steps
+        start = time.perf_counter()
+        journal = JournalChatMessageHistory(path)
+        opened = time.perf_counter() - start
+        start = time.perf_counter()
+        last = journal.tail(3)
+        tail = time.perf_counter() - start
+        start = time.perf_counter()
+        count = len(journal.messages)
+        decoded = time.perf_counter() - start
+        journal.close()
+        print(f"reopen {opened * 1000:.1f} ms, last step {tail * 1000:.1f} ms, all {count} messages {decoded * 1000:.1f} ms")
+        failures += count != expected or last[-1].additional_kwargs["metadata"] != history_step_messages(args.steps, args.files)[-1].additional_kwargs["metadata"]
+
+        with open(path, "ab") as f:
+            f.write(b'{"type": "system", "data": {"content": "The cli tool ret')
+        start = time.perf_counter()
+        journal = JournalChatMessageHistory(path)
+        recovered = time.perf_counter() - start
+        print(f"torn tail: reopen {recovered * 1000:.1f} ms, dropped {journal.recovered_bytes} bytes, {len(journal)} messages")
+        failures += len(journal) != expected or not journal.recovered_bytes
+        journal.close()
+
+        os.remove(journal.index_path)
+        start = time.perf_counter()
+        journal = JournalChatMessageHistory(path)
+        rebuilt = time.perf_counter() - start
+        print(f"lost index: reopen {rebuilt * 1000:.1f} ms, {len(journal)} messages")
+        failures += len(journal) != expected
+
+        size = os.path.getsize(path)
+        start = time.perf_counter()
+        saved = journal.compact()
+        compacted = time.perf_counter() - start
+        print(f"compact: {size / 2 ** 20:.1f} MB -> {os.path.getsize(path) / 2 ** 20:.1f} MB in {compacted:.2f} s ({saved} bytes saved)")
+        journal.close()
+        failures += len(JournalChatMessageHistory(path).messages) != expected
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Memory of the in-memory chat history over a long synthetic run, with and without compaction.
+
+Each step adds the three messages of a write_file, read_file or cli step, as the agent
+does, and the compactor runs after every step. The script reports the memory held by the
+messages (tracemalloc), the time to compact and to rebuild the file index from the
+messages, and exits non-zero if the file index rebuilt from the compacted messages
+differs from the one rebuilt from the full history.
+
+Usage: python benchmarks/bench_history_memory.py [--steps 2000] [--files 30] [--max_messages 60] [--max_bytes 262144]
+"""
+import argparse
+import gc
+import sys
+import time
+import tracemalloc
+
+from _common import get_token_counter, history_step_messages
+from file_index import FileIndex
+from history import HistoryCompactor
+from langchain.memory import ChatMessageHistory
+
+KINDS = ["write_file", "cli", "write_file", "read_file", "cli"]
+
+
+def run(args, compactor, trace):
+    gc.collect()
+    if trace:
+        tracemalloc.start()
+    history = ChatMessageHistory()
+    compact_seconds = 0.0
+    for step in range(1, args.steps + 1):
+        for message in history_step_messages(step, args.files, KINDS[step % len(KINDS)]):
+            history.add_message(message)
+        if compactor is not None:
+            start = time.perf_counter()
+            compactor.compact(history.messages)
+            compact_seconds += time.perf_counter() - start
+    current = peak = 0
+    if trace:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return history.messages, current, peak, compact_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--steps", type=int, default=2000)
+    parser.add_argument("--files", type=int, default=30)
+    parser.add_argument("--max_messages", type=int, default=60)
+    parser.add_argument("--max_bytes", type=int, default=256 * 1024)
+    args = parser.parse_args()
+
+    token_counter = get_token_counter()
+    reference = None
+    failures = 0
+    print(f"{'policy':>18} {'messages':>9} {'held MB':>8} {'peak MB':>8} {'compact ms/step':>16} {'index rebuild ms':>17}")
+    policies = [
+        ("none", None),
+        (f"{args.max_messages} messages", lambda: HistoryCompactor(max_messages=args.max_messages)),
+        (f"{args.max_bytes // 1024} KB", lambda: HistoryCompactor(max_bytes=args.max_bytes)),
+    ]
+    for name, make_compactor in policies:
+        # Timed without tracemalloc, which slows the allocations down
+        _, _, _, compact_seconds = run(args, make_compactor and make_compactor(), trace=False)
+        messages, current, peak, _ = run(args, make_compactor and make_compactor(), trace=True)
+        start = time.perf_counter()
+        file_index = FileIndex.from_messages(messages, token_counter)
+        rebuild = time.perf_counter() - start
+        files = [(entry.file_path, entry.code) for entry in file_index.entries()]
+        reference = reference or files
+        mark = "" if files == reference else "  MISMATCH: file index differs"
+        failures += files != reference
+        print(f"{name:>18} {len(messages):>9} {current / 2 ** 20:>8.1f} {peak / 2 ** 20:>8.1f} "
+              f"{compact_seconds / args.steps * 1000:>16.3f} {rebuild * 1000:>17.1f}{mark}")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Record an agent run in an LLMCache transcript, then replay it offline.
+
+The recorded run uses the local ScriptedChatModel with --latency seconds per call,
+standing in for the API. Every cli output is summarized by the LLM, so the summarizer
+calls are recorded as well. The replayed run wraps models without any response, in
+replay mode, so every call must be answered from the transcript. Both runs use the
+same output directory, emptied in between. The script prints the wall time of both
+runs, the time spent in the model calls that was replayed, and the hits and misses
+for blocking and streamed replies. It exits non-zero if the replayed run misses or
+ends with different files or history than the recorded one.
+
+Usage: python benchmarks/bench_llm_cache.py [--steps 100] [--latency 0.2]
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from _common import build_agent, json_reply, project_steps
+from fakes import ScriptedChatModel
+from llm_cache import CacheMissError, LLMCache, RecordReplayChatModel
+
+
+def snapshot(output_dir):
+    files = {}
+    for directory, _, names in os.walk(os.path.join(output_dir, "src")):
+        for name in names:
+            with open(os.path.join(directory, name)) as f:
+                files[os.path.relpath(os.path.join(directory, name), output_dir)] = f.read()
+    return files
+
+
+def run(output_dir, llm, cache, streaming):
+    shutil.rmtree(os.path.join(output_dir, "src"), ignore_errors=True)
+    agent = build_agent(
+        RecordReplayChatModel(llm=llm, llm_cache=cache),
+        output_dir,
+        streaming=streaming,
+        summary_passthrough_tokens=0,
+        summary_extractive_tokens=0,
+        llm_cache=cache,
+    )
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        agent.run(["Build the components"])
+    elapsed = time.perf_counter() - start
+    history = [(message.type, message.content) for message in agent.chat_history_memory.messages]
+    return elapsed, snapshot(output_dir), history
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.2)
+    args = parser.parse_args()
+    failures = 0
+
+    print(f"{'reply':>9} {'mode':>7} {'wall s':>8} {'model s':>8} {'hits':>5} {'misses':>7} {'recorded':>9}")
+    for streaming in (False, True):
+        label = "streamed" if streaming else "blocking"
+        with tempfile.TemporaryDirectory() as output_dir:
+            path = os.path.join(output_dir, "transcript.jsonl")
+            replies = [json_reply(command) for command in project_steps(output_dir, files=8, steps=args.steps)]
+
+            cache = LLMCache(path, mode="record")
+            recorded = run(output_dir, ScriptedChatModel(responses=replies, latency=args.latency), cache, streaming)
+            cache.close()
+            stats = cache.stats
+            model_seconds = sum(item["elapsed"] for responses in cache._responses.values() for item in responses)
+            print(f"{label:>9} {'record':>7} {recorded[0]:>8.2f} {model_seconds:>8.2f} {stats['hits']:>5} {stats['misses']:>7} {stats['recorded']:>9}")
+
+            cache = LLMCache(path, mode="replay")
+            try:
+                replayed = run(output_dir, ScriptedChatModel(responses=[]), cache, streaming)
+            except CacheMissError as e:
+                print(f"{label:>9} {'replay':>7} {e}")
+                failures += 1
+                continue
+            finally:
+                cache.close()
+            stats = cache.stats
+            print(f"{label:>9} {'replay':>7} {replayed[0]:>8.2f} {stats['replayed_seconds']:>8.2f} {stats['hits']:>5} {stats['misses']:>7} {stats['recorded']:>9}")
+            failures += replayed[1:] != recorded[1:]
+            if replayed[1:] != recorded[1:]:
+                print("the replayed run differs from the recorded run")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
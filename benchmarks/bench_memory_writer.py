@@ -0,0 +1,82 @@
+"""Throughput of the agent memory writes, per step and batched, for two embedding backends.
+
+"remote" stands in for OpenAIEmbeddings: every request sleeps --request_latency seconds
+plus --document_latency per document, the FakeEmbeddings vectors are random. "hashing"
+is the local HashingEmbeddings. The documents are the step memories the agent stores.
+For every backend and batch size the script prints the documents embedded per second
+and the milliseconds per step spent on the critical path, then the share of the step
+memories of a file found in the top --k results of a query about it.
+
+Usage: python benchmarks/bench_memory_writer.py [--steps 400] [--request_latency 0.2] [--document_latency 0.002]
+"""
+import argparse
+import time
+from typing import List
+
+import faiss
+from _common import history_step_messages
+from langchain.docstore import InMemoryDocstore
+from langchain.embeddings import FakeEmbeddings
+from langchain.schema import Document
+from langchain.vectorstores import FAISS
+from memory_writer import HashingEmbeddings, MemoryWriter
+
+
+class RemoteEmbeddings(FakeEmbeddings):
+    request_latency: float = 0.0
+    document_latency: float = 0.0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.request_latency + self.document_latency * len(texts))
+        return super().embed_documents(texts)
+
+
+def memories(steps: int, files: int) -> List[str]:
+    kinds = ["write_file", "read_file", "write_file", "cli"]
+    return [history_step_messages(step, files, kinds[step % 4])[-1].additional_kwargs["metadata"] for step in range(1, steps + 1)]
+
+
+def write(embeddings, size, documents, batch_size):
+    vectorstore = FAISS(embeddings, faiss.IndexFlatL2(size), InMemoryDocstore({}), {})
+    writer = MemoryWriter(vectorstore.as_retriever(), batch_size=batch_size)
+    start = time.perf_counter()
+    for document in documents:
+        writer.add(Document(page_content=document))
+    on_steps = time.perf_counter() - start
+    writer.flush()
+    return vectorstore, time.perf_counter() - start, on_steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--steps", type=int, default=400)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--request_latency", type=float, default=0.2, help="simulated seconds per remote embeddings request")
+    parser.add_argument("--document_latency", type=float, default=0.002, help="simulated seconds per document of a remote request")
+    parser.add_argument("--k", type=int, default=4)
+    args = parser.parse_args()
+
+    documents = memories(args.steps, args.files)
+    backends = [
+        ("remote", RemoteEmbeddings(size=1536, request_latency=args.request_latency, document_latency=args.document_latency), 1536),
+        ("hashing", HashingEmbeddings(), HashingEmbeddings().size),
+    ]
+    print(f"{'backend':>8} {'batch':>6} {'docs/s':>10} {'ms/step':>9}")
+    for name, embeddings, size in backends:
+        for batch_size in (1, 16, 64):
+            vectorstore, elapsed, on_steps = write(embeddings, size, documents, batch_size)
+            print(f"{name:>8} {batch_size:>6} {len(documents) / elapsed:>10.1f} {on_steps / len(documents) * 1000:>9.2f}")
+
+    vectorstore, _, _ = write(HashingEmbeddings(), HashingEmbeddings().size, documents, 64)
+    found = total = 0
+    for i in range(args.files):
+        file_path = f"/tmp/app/src/components/Component{i}.js"
+        relevant = sum(file_path in document for document in documents)
+        results = vectorstore.similarity_search(f"writing file {file_path}", k=args.k)
+        found += sum(file_path in result.page_content for result in results)
+        total += min(args.k, relevant)
+    print(f"hashing retrieval: {found / total:.2f} of the top {args.k} results are memories of the queried file")
+
+
+if __name__ == "__main__":
+    main()
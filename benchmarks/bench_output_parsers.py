@@ -0,0 +1,72 @@
+"""Replay a corpus of cli tool outputs through the output parser registry.
+
+Each corpus entry records the report the registry should produce, or null when the
+output has to be summarized. The script reports how many outputs are parsed locally,
+so they cost no summarization call, the time per output, and exits non-zero if the
+registry disagrees with the corpus.
+
+Usage: python benchmarks/bench_output_parsers.py [--corpus benchmarks/data/command_outputs.jsonl] [--repeat 200]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import _common  # noqa: F401
+from output_parsers import default_registry
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "command_outputs.jsonl")
+
+
+def describe(command_report):
+    if command_report is None:
+        return None
+    failures = [[f.name, f.file, f.line] for r in command_report.reports for f in r.failures]
+    return {
+        "tools": [r.tool for r in command_report.reports],
+        "passed": sum(r.passed for r in command_report.reports),
+        "failed": sum(r.failed for r in command_report.reports),
+        "failures": failures,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--corpus", type=str, default=DEFAULT_CORPUS)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--show", action="store_true", help="print the reports sent to the agent")
+    args = parser.parse_args()
+
+    with open(args.corpus, encoding="utf-8") as f:
+        corpus = [json.loads(line) for line in f if line.strip()]
+
+    registry = default_registry()
+    mismatches = 0
+    for case in corpus:
+        command_report = registry.parse(case["commands"], case["observation"])
+        actual = describe(command_report)
+        mark = "ok" if actual == case["expected"] else "MISMATCH"
+        mismatches += actual != case["expected"]
+        result = ", ".join(actual["tools"]) if actual else "summarize"
+        print(f"{case['name']:28} {result:22} {mark}")
+        if mark != "ok":
+            print(f"    expected {case['expected']}\n    actual   {actual}")
+        if args.show and command_report:
+            print("    " + command_report.format().replace("\n", "\n    "))
+
+    print(f"\nparsed locally {registry.stats['parsed']}/{len(corpus)}, "
+          f"summarization calls {registry.stats['unparsed']}/{len(corpus)}")
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for case in corpus:
+            registry.parse(case["commands"], case["observation"])
+    elapsed = time.perf_counter() - start
+    print(f"{elapsed / (args.repeat * len(corpus)) * 1e6:.1f} us/output")
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Per-step cost of TddGPTPrompt.format_messages with and without the cached prompt prefix.
+
+Usage: python benchmarks/bench_prompt_cache.py [--steps 300] [--files 40]
+"""
+import argparse
+import time
+
+from _common import get_token_counter
+from langchain.schema.messages import AIMessage, HumanMessage, SystemMessage
+from langchain.tools.file_management.read import ReadFileTool
+from langchain.tools.file_management.write import WriteFileTool
+
+from cli import CLITool
+from prompt import TddGPTPrompt
+
+
+def build_history(steps: int, files: int):
+    messages = []
+    for step in range(1, steps + 1):
+        file_path = f"/tmp/app/src/components/Component{step % files}.js"
+        code = f"\n```\n// {file_path}\n" + "export const value = 42;\n" * 20 + "```"
+        messages.append(HumanMessage(content=f"You have completed step {step - 1}."))
+        messages.append(AIMessage(content='{"thoughts": {}, "command": {}}'))
+        messages.append(SystemMessage(
+            content=f"The write_file tool returned: File written successfully to {file_path}.",
+            additional_kwargs={"metadata": f"step {step}", "code": code, "file_path": file_path},
+        ))
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--steps", type=int, default=300)
+    parser.add_argument("--files", type=int, default=40)
+    args = parser.parse_args()
+
+    prompt = TddGPTPrompt(
+        tools=[CLITool(), WriteFileTool(), ReadFileTool()],
+        input_variables=["memory", "messages", "goals", "user_input"],
+        token_counter=get_token_counter(),
+        output_dir="/tmp/app",
+        send_token_limit=128000,
+    )
+    history = build_history(args.steps, args.files)
+    goals = ["Build a counter app in ReactJS."]
+
+    def run(invalidate: bool) -> float:
+        start = time.perf_counter()
+        for step in range(1, args.steps + 1):
+            if invalidate:
+                # As before the cache, the prefix is rendered and counted on every step
+                prompt._prefix_cache = None
+            prompt.format_messages(
+                goals=goals,
+                messages=history[:step * 3],
+                memory=None,
+                user_input=f"You have completed step {step}.",
+            )
+        return (time.perf_counter() - start) / args.steps
+
+    uncached = run(invalidate=True)
+    cached = run(invalidate=False)
+    print(f"steps: {args.steps}, files: {args.files}")
+    print(f"format_messages without prefix cache: {uncached * 1000:.3f} ms/step")
+    print(f"format_messages with prefix cache:    {cached * 1000:.3f} ms/step")
+    print(f"speedup: {uncached / cached:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Replay a corpus of assistant replies through the legacy parsing and the ReplyParser.
+
+Each corpus entry records whether the reply should be accepted, with the command parsed
+from it or the error, which tests/test_reply_parser.py checks. The script reports how
+many replies each parser accepts, the retries the ReplyParser saves, the time per reply,
+and exits non-zero if the ReplyParser disagrees with the corpus.
+
+Usage: python benchmarks/bench_reply_parser.py [--corpus benchmarks/data/replies.jsonl] [--repeat 200]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import _common  # noqa: F401
+from reply_parser import ReplyParseError, ReplyParser, legacy_loads, missing_key
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "replies.jsonl")
+
+
+def legacy_accepts(text):
+    try:
+        return missing_key(legacy_loads(text)) is None
+    except json.JSONDecodeError:
+        return False
+
+
+def parser_accepts(parser, text):
+    try:
+        parser.parse(text)
+        return True
+    except ReplyParseError:
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--corpus", type=str, default=DEFAULT_CORPUS)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    with open(args.corpus, encoding="utf-8") as f:
+        corpus = [json.loads(line) for line in f if line.strip()]
+
+    reply_parser = ReplyParser()
+    mismatches = 0
+    for case in corpus:
+        legacy = legacy_accepts(case["reply"])
+        accepted = parser_accepts(reply_parser, case["reply"])
+        mark = "ok" if accepted == case["valid"] else "MISMATCH"
+        mismatches += accepted != case["valid"]
+        print(f"{case['name']:40} legacy={'accept' if legacy else 'retry':6} parser={'accept' if accepted else 'retry':6} {mark}")
+
+    print(f"\nlegacy accepted {sum(legacy_accepts(c['reply']) for c in corpus)}/{len(corpus)}, "
+          f"parser accepted {sum(parser_accepts(ReplyParser(), c['reply']) for c in corpus)}/{len(corpus)}")
+    print(f"parser stats: {reply_parser.stats}")
+
+    for name, accepts in (("legacy", legacy_accepts), ("parser", lambda text: parser_accepts(ReplyParser(), text))):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for case in corpus:
+                accepts(case["reply"])
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {elapsed / (args.repeat * len(corpus)) * 1e6:.1f} us/reply")
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
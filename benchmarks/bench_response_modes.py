@@ -0,0 +1,53 @@
+"""Compare the json response format with native function calling on a scripted project.
+
+Both modes drive TddGPTAgent.run with the local ScriptedChatModel, replaying the same
+commands, and report steps per project and approximate prompt/completion tokens per step.
+The functions are counted in the prompt tokens the way the API bills them, rendered as
+type declarations in the system message, not as their json schema.
+
+Usage: python benchmarks/bench_response_modes.py [--steps 40] [--files 10]
+"""
+import argparse
+import contextlib
+import io
+import tempfile
+
+from _common import build_agent, function_call, json_reply, project_steps
+from fakes import ScriptedChatModel
+
+
+def run_mode(mode, steps, files):
+    with tempfile.TemporaryDirectory() as output_dir:
+        commands = project_steps(output_dir, files, steps)
+        responses = [json_reply(c) for c in commands] if mode == "json" else [function_call(c) for c in commands]
+        llm = ScriptedChatModel(responses=responses)
+        agent = build_agent(llm, output_dir, response_mode=mode)
+        with contextlib.redirect_stdout(io.StringIO()):
+            agent.run(["Build a counter app in ReactJS."])
+    calls = len(llm.usage)
+    prompt_tokens = sum(u["prompt_tokens"] for u in llm.usage)
+    completion_tokens = sum(u["completion_tokens"] for u in llm.usage)
+    return calls, prompt_tokens / calls, completion_tokens / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--steps", type=int, default=40)
+    parser.add_argument("--files", type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{'mode':>10} {'steps':>6} {'prompt tok/step':>16} {'completion tok/step':>20} {'total tok/step':>15}")
+    totals = {}
+    for mode in ("json", "functions"):
+        calls, prompt, completion = run_mode(mode, args.steps, args.files)
+        totals[mode] = (prompt, completion)
+        print(f"{mode:>10} {calls:>6} {prompt:>16.0f} {completion:>20.0f} {prompt + completion:>15.0f}")
+    (json_prompt, json_completion), (functions_prompt, functions_completion) = totals["json"], totals["functions"]
+    print(
+        f"functions vs json: {functions_prompt - json_prompt:+.0f} prompt tok/step ({functions_prompt / json_prompt - 1:+.1%}), "
+        f"{functions_completion - json_completion:+.0f} completion tok/step ({functions_completion / json_completion - 1:+.1%})"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Run a TDD loop with and without speculative test runs after write_file steps.
+
+The project is a package.json whose test script takes --test_seconds, and every reply
+of the scripted LLM takes --latency seconds. Most writes are followed by the test
+command, some by another write or a read first, so some speculative runs are
+cancelled or go unused. The script reports the wall time of both runs and the
+hit rate and seconds saved by the speculator.
+
+Usage: python benchmarks/bench_speculative_tests.py [--cycles 6] [--latency 0.5] [--test_seconds 0.8]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+
+from _common import build_agent, json_reply
+from cli import CLITool
+from fakes import ScriptedChatModel
+from speculation import TestSpeculator
+
+
+def thoughts(n, name):
+    return {
+        "role": "Programmer", "phase": "Development", "tests_status": "failing",
+        "text": f"Step {n}: {name}.", "reasoning": "Next task.", "criticism": "None.",
+        "kanban": {"todo": ["Task"], "in_progress": "finish the project" if name == "finish" else f"Task {n}", "done": []},
+    }
+
+
+def steps(project_dir, cycles):
+    test = {"name": "cli", "args": {"commands": [f"cd {project_dir}", "npm test"]}}
+    commands = []
+    for i in range(cycles):
+        write = {"name": "write_file", "args": {"file_path": f"{project_dir}/src/part{i}.js", "text": f"export const part{i} = {i};\n"}}
+        commands.append(write)
+        if i % 3 == 1:
+            # A second write before the tests, which cancels the first speculative run
+            commands.append(dict(write, args=dict(write["args"], text=f"export const part{i} = {i + 1};\n")))
+        elif i % 3 == 2:
+            # A read before the tests, which does not change the workspace
+            commands.append({"name": "read_file", "args": {"file_path": write["args"]["file_path"]}})
+        commands.append(test)
+    commands.append({"name": "finish", "args": {"response": "Done."}})
+    return [json_reply(dict(command, thoughts=thoughts(n, command["name"]))) for n, command in enumerate(commands)]
+
+
+def run(args, speculative):
+    with tempfile.TemporaryDirectory() as project_dir:
+        os.makedirs(os.path.join(project_dir, "src"))
+        test_script = f"node -e \"setTimeout(() => console.log('Tests: 3 passed, 3 total'), {int(args.test_seconds * 1000)})\""
+        with open(os.path.join(project_dir, "package.json"), "w") as f:
+            json.dump({"name": "bench", "version": "1.0.0", "scripts": {"test": test_script}}, f)
+
+        speculator = TestSpeculator(root=project_dir) if speculative else None
+        llm = ScriptedChatModel(responses=steps(project_dir, args.cycles), latency=args.latency)
+        agent = build_agent(llm, project_dir, cli_tool=CLITool(speculator=speculator))
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            agent.run(["Build the parts"])
+        elapsed = time.perf_counter() - start
+        if speculator is not None:
+            speculator.close()
+        return elapsed, speculator
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cycles", type=int, default=6)
+    parser.add_argument("--latency", type=float, default=0.5, help="simulated seconds per LLM reply")
+    parser.add_argument("--test_seconds", type=float, default=0.8, help="seconds the test script takes")
+    args = parser.parse_args()
+
+    baseline, _ = run(args, speculative=False)
+    print(f"sequential:  {baseline:6.2f} s")
+    elapsed, speculator = run(args, speculative=True)
+    print(f"speculative: {elapsed:6.2f} s ({baseline - elapsed:.2f} s faster)")
+    print(f"hit rate {speculator.hit_rate:.2f}, {speculator.stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Steps to green of a replayed TDD session, with the retrieval of relevant past steps on and off.
+
+The session builds --components components and their tests in a temporary directory.
+The tests are run by a small script that fails a component with a default export,
+because the tests import named exports. The model is a scripted policy standing in for
+the LLM. For each component it writes the test and a component with a default export,
+then runs the tests. It fixes a failure right away if one of the "Relevant Past Steps"
+in its prompt is an earlier fix of the same failure. Otherwise it first reads the test
+and the component. Since the policy is scripted, the numbers measure whether retrieval
+puts the lesson of an earlier step in front of the model within --memory_tokens, among
+the other steps, not how well a real model uses it. The memory uses HashingEmbeddings.
+
+Usage: python benchmarks/bench_step_retrieval.py [--components 8] [--memory_tokens 600]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+from typing import Any, List
+
+from _common import build_agent
+from fakes import ScriptedChatModel, approximate_token_count
+from langchain.schema.messages import AIMessage, BaseMessage
+from memory_writer import HashingEmbeddings
+
+LESSON = "the tests import named exports, so switched the default export to a named export"
+
+TEST_SCRIPT = '''import glob, os, sys
+failed, passed = [], 0
+for test in sorted(glob.glob("src/tests/*.test.js")):
+    name = os.path.basename(test).split(".")[0]
+    path = f"src/components/{name}.js"
+    if not os.path.exists(path):
+        failed.append(f"FAIL {test}\\n  Cannot find module '../components/{name}' from '{test}'")
+    elif "export default" in open(path).read():
+        failed.append(f"FAIL {test}\\n  TypeError: (0 , _{name}.format{name}) is not a function\\n    at Object.<anonymous> ({test}:4:12)")
+    else:
+        passed += 1
+print("\\n".join(failed))
+print(f"Tests: {len(failed)} failed, {passed} passed, {len(failed) + passed} total")
+sys.exit(1 if failed else 0)
+'''
+
+
+def reply(name: str, args: dict, in_progress: str, text: str, todo: List[str]) -> str:
+    thoughts = {
+        "role": "Programmer",
+        "phase": "Development",
+        "tests_status": "failing",
+        "text": text,
+        "reasoning": "Follow the TDD workflow one component at a time.",
+        "criticism": "Keep the steps small.",
+        "kanban": {"todo": todo, "in_progress": in_progress, "done": []},
+    }
+    return json.dumps({"thoughts": thoughts, "command": {"name": name, "args": args}}, indent=4)
+
+
+class PolicyChatModel(ScriptedChatModel):
+    """Replies with the next step of the session, depending on the last step and the retrieved ones."""
+
+    output_dir: str
+    components: int
+    component: int = 0
+    state: str = "test"
+    fixes: int = 0
+    fixes_from_memory: int = 0
+
+    def _next_message(self, messages: List[BaseMessage], **kwargs: Any) -> AIMessage:
+        prompt = messages[0].content
+        last_step = prompt[prompt.rfind("## Last Step:"):]
+        past_steps = prompt[prompt.find("## Relevant Past Steps:"):prompt.rfind("## Last Step:")] if "## Relevant Past Steps:" in prompt else ""
+        self.usage.append({"prompt_tokens": approximate_token_count(prompt), "completion_tokens": 0})
+
+        name = f"Component{self.component}"
+        component_path = f"{self.output_dir}/src/components/{name}.js"
+        test_path = f"{self.output_dir}/src/tests/{name}.test.js"
+        todo = [f"Build Component{i}" for i in range(self.component + 1, self.components)]
+        if self.state == "check" and f"FAIL src/tests/{name}.test.js" in last_step:
+            self.fixes += 1
+            self.state = "fix" if LESSON in past_steps else "read_test"
+            self.fixes_from_memory += self.state == "fix"
+        elif self.state == "check":
+            self.component += 1
+            self.state = "test"
+            return self._next_message(messages, **kwargs)
+
+        if self.component == self.components:
+            return AIMessage(content=reply("finish", {"response": "All components pass."}, "finish the project", "All tests pass.", []))
+        if self.state == "test":
+            self.state = "implement"
+            code = f"import {{ format{name} }} from '../components/{name}';\ntest('formats', () => {{\n  expect(format{name}(1)).toBe('1');\n}});\n"
+            return AIMessage(content=reply("write_file", {"file_path": test_path, "text": code}, f"Write the failing test of {name}", f"Write the test of {name}.", todo))
+        if self.state == "implement":
+            self.state = "run"
+            code = f"export default function format{name}(value) {{\n  return String(value);\n}}\n"
+            return AIMessage(content=reply("write_file", {"file_path": component_path, "text": code}, f"Implement {name}", f"Implement {name}.", todo))
+        if self.state == "read_test":
+            self.state = "read_component"
+            return AIMessage(content=reply("read_file", {"file_path": test_path}, f"Fix the TypeError in {name}: format{name} is not a function", "Look at how the test imports the component.", todo))
+        if self.state == "read_component":
+            self.state = "fix"
+            return AIMessage(content=reply("read_file", {"file_path": component_path}, f"Fix the TypeError in {name}: format{name} is not a function", "Compare the export with the import of the test.", todo))
+        if self.state == "fix":
+            self.state = "run"
+            code = f"export function format{name}(value) {{\n  return String(value);\n}}\n"
+            return AIMessage(content=reply("write_file", {"file_path": component_path, "text": code}, f"Fix the TypeError in {name}: format{name} is not a function",
+                                           f"TypeError: format{name} is not a function: {LESSON}.", todo))
+        self.state = "check"
+        return AIMessage(content=reply("cli", {"commands": [f"cd {self.output_dir}", "python3 run_tests.py"]}, f"Run the tests of {name}", f"Run the tests of {name}.", todo))
+
+
+def run(components: int, memory_tokens: int):
+    with tempfile.TemporaryDirectory() as output_dir:
+        os.makedirs(os.path.join(output_dir, "src", "components"))
+        os.makedirs(os.path.join(output_dir, "src", "tests"))
+        with open(os.path.join(output_dir, "run_tests.py"), "w") as f:
+            f.write(TEST_SCRIPT)
+        llm = PolicyChatModel(responses=[], output_dir=output_dir, components=components)
+        agent = build_agent(llm, output_dir, embeddings=HashingEmbeddings(size=64), memory_tokens=memory_tokens)
+        with contextlib.redirect_stdout(io.StringIO()):
+            agent.run([f"Build {components} formatting components with tests"])
+        prompt_tokens = sum(usage["prompt_tokens"] for usage in llm.usage)
+        return len(llm.usage), llm.fixes, llm.fixes_from_memory, prompt_tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--components", type=int, default=8)
+    parser.add_argument("--memory_tokens", type=int, default=600)
+    args = parser.parse_args()
+
+    print(f"{'retrieval':>9} {'steps':>6} {'fixes':>6} {'from memory':>12} {'prompt tokens':>14}")
+    for memory_tokens in (0, args.memory_tokens):
+        steps, fixes, from_memory, prompt_tokens = run(args.components, memory_tokens)
+        label = f"{memory_tokens} tok" if memory_tokens else "off"
+        print(f"{label:>9} {steps:>6} {fixes:>6} {from_memory:>12} {prompt_tokens:>14}")
+
+
+if __name__ == "__main__":
+    main()
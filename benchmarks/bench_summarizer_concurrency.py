@@ -0,0 +1,64 @@
+"""Wall-clock time of summarizing large logs, sequential map-reduce chain vs concurrent map step.
+
+The summarization LLM is the local ScriptedChatModel, with a simulated latency per call
+and per streamed chunk. For every chunk count, a log of that many chunks is summarized
+by the sequential MapReduceDocumentsChain and by TextSummarizer.amap_reduce, and the
+time to the first streamed token of the final summary is reported for the latter.
+
+Usage: python benchmarks/bench_summarizer_concurrency.py [--chunks 1 2 4 8 16 32] [--latency 0.2] [--concurrency 8]
+"""
+import argparse
+import asyncio
+import time
+
+from _common import get_token_counter
+from fakes import ScriptedChatModel
+from summarizer import TextSummarizer
+
+SUMMARY = "The commands failed with the message 'webpack compiled with 3 errors in src/App.js'."
+
+
+def make_log(chunks, chunk_tokens, token_counter):
+    line = "WARNING in ./src/components/Widget.js 12:4-18 export 'useWidget' was not found in './hooks'"
+    lines_per_chunk = max(int(chunk_tokens * 0.9) // (token_counter(line) + 1), 1)
+    return "\n".join(f"{line} #{i}" for i in range(chunks * lines_per_chunk))
+
+
+def build(token_counter, latency, token_latency, concurrency):
+    llm = ScriptedChatModel(responses=[SUMMARY], repeat=True, latency=latency, token_latency=token_latency)
+    summarizer = TextSummarizer("cli", token_counter=token_counter, llm=llm, max_concurrency=concurrency)
+    return summarizer, llm
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chunks", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--latency", type=float, default=0.2, help="simulated seconds per LLM call")
+    parser.add_argument("--token_latency", type=float, default=0.002, help="simulated seconds per streamed chunk")
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    token_counter = get_token_counter()
+    print(f"{'chunks':>6} {'calls':>6} {'sequential s':>13} {'calls':>6} {'concurrent s':>13} {'first token s':>14} {'speedup':>8}")
+    for chunks in args.chunks:
+        log = make_log(chunks, 1000, token_counter)
+
+        summarizer, llm = build(token_counter, args.latency, args.token_latency, args.concurrency)
+        start = time.perf_counter()
+        docs = summarizer.split(log)
+        summarizer.map_reduce_chain.run(docs)
+        sequential = time.perf_counter() - start
+        sequential_calls = len(llm.usage)
+
+        summarizer, llm = build(token_counter, args.latency, args.token_latency, args.concurrency)
+        first_token = []
+        start = time.perf_counter()
+        asyncio.run(summarizer.amap_reduce(log, on_token=lambda token: first_token.append(time.perf_counter() - start)))
+        concurrent = time.perf_counter() - start
+
+        print(f"{len(docs):>6} {sequential_calls:>6} {sequential:>13.2f} {len(llm.usage):>6} {concurrent:>13.2f} "
+              f"{first_token[0]:>14.2f} {sequential / concurrent:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
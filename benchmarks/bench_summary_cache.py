@@ -0,0 +1,82 @@
+"""Summarize recurring large command outputs with and without the persistent summary cache.
+
+The outputs repeat across steps with different timings, temporary paths, PIDs and hashes,
+as npm install and create-react-app logs do. The summarization LLM is the local
+ScriptedChatModel with a simulated latency per call. The script reports the LLM calls,
+the hit rate and the time per summary for both runs, then reopens the cache file to show
+the summaries survive across runs, and looks them up again to time outputs
+already seen in the same run.
+
+Usage: python benchmarks/bench_summary_cache.py [--outputs 40] [--distinct 4] [--latency 0.2]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from _common import get_token_counter
+from fakes import ScriptedChatModel
+from summarizer import TextSummarizer
+from summary_cache import SummaryCache
+
+
+def make_output(kind, rng):
+    tmp = f"/tmp/tmp{rng.randrange(16 ** 8):08x}"
+    lines = [f"Command 'cd {tmp}/app && npm install' succeeded with the following output:"]
+    for i in range(1500):
+        lines.append(f"npm WARN deprecated package{kind}-{i}@{i % 7}.{i % 5}.0: use package{kind}-{i + 1} instead")
+    lines.append(f"added {1400 + kind} packages, and audited {1401 + kind} packages in {rng.randrange(5, 60)}s")
+    lines.append(f"npm info lifecycle pid {rng.randrange(1000, 60000)} at {time.strftime('%H:%M:%S')}")
+    lines.append(f"lockfile {rng.randrange(16 ** 12):012x} written to {tmp}/app/package-lock.json")
+    return "\n".join(lines)
+
+
+def run(outputs, cache, latency, token_counter):
+    llm = ScriptedChatModel(responses=["The commands succeeded with the message 'installed'."], repeat=True, latency=latency)
+    summarizer = TextSummarizer("cli", token_counter=token_counter, llm=llm, extractive_tokens=1000, cache=cache)
+    start = time.perf_counter()
+    for output in outputs:
+        summarizer.summarize_tiered(output)
+    elapsed = time.perf_counter() - start
+    return len(llm.usage), elapsed / len(outputs), summarizer.stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--outputs", type=int, default=40)
+    parser.add_argument("--distinct", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.2, help="simulated seconds per LLM call")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    token_counter = get_token_counter()
+    outputs = [make_output(rng.randrange(args.distinct), rng) for _ in range(args.outputs)]
+
+    calls, per_summary, stats = run(outputs, None, args.latency, token_counter)
+    print(f"no cache:    {calls:4} LLM calls, {per_summary * 1000:8.1f} ms/summary, tiers {stats}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "summaries.sqlite")
+        cache = SummaryCache(path)
+        calls, per_summary, stats = run(outputs, cache, args.latency, token_counter)
+        print(f"cache:       {calls:4} LLM calls, {per_summary * 1000:8.1f} ms/summary, tiers {stats}")
+        print(f"cache stats: {cache.stats()}")
+        cache.close()
+
+        cache = SummaryCache(path)
+        start = time.perf_counter()
+        for output in outputs:
+            cache.get("cli", output)
+        lookup = (time.perf_counter() - start) / len(outputs)
+        print(f"reopened:    hit rate {cache.stats()['hit_rate']:.2f}, {lookup * 1e6:.0f} us/lookup")
+        start = time.perf_counter()
+        for output in outputs:
+            cache.get("cli", output)
+        lookup = (time.perf_counter() - start) / len(outputs)
+        print(f"seen again:  {lookup * 1e6:.0f} us/lookup")
+        cache.close()
+
+
+if __name__ == "__main__":
+    main()
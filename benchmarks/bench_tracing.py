@@ -0,0 +1,74 @@
+"""Overhead of tracing an agent run, and the report of its trace.
+
+Runs the synthetic project of bench_agent_loop with the local ScriptedChatModel, without
+a tracer and with one writing a JSONL trace file, alternately --repeat times each, and
+prints the median milliseconds per step of both, the overhead per step and the number
+of spans per step. It then prints the trace report of the last traced run.
+
+Usage: python benchmarks/bench_tracing.py [--steps 200] [--files 50] [--repeat 3]
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import tempfile
+import time
+
+from _common import build_agent, json_reply
+from bench_agent_loop import BUILD_SCRIPT, JEST_SCRIPT, synthetic_project
+from fakes import ScriptedChatModel
+import trace_report
+import tracing
+
+
+def run(steps, files, trace_file):
+    with tempfile.TemporaryDirectory() as output_dir:
+        os.makedirs(os.path.join(output_dir, "bin"))
+        os.makedirs(os.path.join(output_dir, "src", "components"))
+        for name, script in (("jest", JEST_SCRIPT), ("build", BUILD_SCRIPT)):
+            with open(os.path.join(output_dir, "bin", name), "w") as f:
+                f.write(script)
+        tracer = tracing.Tracer(trace_file) if trace_file else None
+        tracing.set_tracer(tracer)
+        try:
+            llm = ScriptedChatModel(responses=[json_reply(command) for command in synthetic_project(output_dir, steps, files)])
+            llm.callbacks = tracing.callbacks()
+            agent = build_agent(llm, output_dir)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                agent.run(["Build the components"])
+            return (time.perf_counter() - start) / steps * 1000
+        finally:
+            tracing.set_tracer(None)
+            if tracer is not None:
+                tracer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--steps", type=int, default=200)
+    parser.add_argument("--files", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        trace_file = os.path.join(directory, "trace.jsonl")
+        plain, traced = [], []
+        for _ in range(args.repeat):
+            plain.append(run(args.steps, args.files, None))
+            if os.path.exists(trace_file):
+                os.remove(trace_file)
+            traced.append(run(args.steps, args.files, trace_file))
+        with open(trace_file) as f:
+            spans = sum(1 for _ in f)
+
+        plain_ms, traced_ms = statistics.median(plain), statistics.median(traced)
+        print(f"{'steps':>6} {'plain ms':>9} {'traced ms':>10} {'overhead ms':>12} {'overhead %':>11} {'spans/step':>11}")
+        print(f"{args.steps:>6} {plain_ms:>9.3f} {traced_ms:>10.3f} {traced_ms - plain_ms:>12.3f} "
+              f"{(traced_ms - plain_ms) / plain_ms * 100:>11.1f} {spans / args.steps:>11.1f}\n")
+        trace_report.report(trace_file)
+
+
+if __name__ == "__main__":
+    main()
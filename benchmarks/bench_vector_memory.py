@@ -0,0 +1,92 @@
+"""Recall and latency of the DiskFAISS memory, exact and migrated to HNSW or IVF.
+
+The step records are synthetic: unit vectors drawn around --clusters centers, the
+queries are records with noise added. For every size the memory is built in a temporary
+directory with each index type. The approximate ones are migrated at a tenth of the size,
+then keep growing. The script prints:
+- the build time
+- the time to reopen the memory, memory-mapped and read
+- the size on disk
+- the mean milliseconds per search through the vector store
+- recall@k against an exact search
+The default --dim is 64: 1M records of 1536 dimensions take 6 GB of vectors.
+
+Usage: python benchmarks/bench_vector_memory.py [--sizes 1000,100000,1000000] [--dim 64] [--queries 200]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import faiss
+import numpy as np
+import _common  # noqa: F401
+from langchain.embeddings import FakeEmbeddings
+from vector_memory import DiskFAISS
+
+CHUNK = 10000
+
+
+def records(rng, size, dim, clusters):
+    centers = rng.standard_normal((clusters, dim), dtype=np.float32)
+    vectors = centers[rng.integers(0, clusters, size)] + 0.6 * rng.standard_normal((size, dim), dtype=np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def build(directory, vectors, index_type, migrate_at):
+    store = DiskFAISS.open(directory, FakeEmbeddings(size=vectors.shape[1]), vectors.shape[1], migrate_at=migrate_at, index_type=index_type or "ivf")
+    start = time.perf_counter()
+    for offset in range(0, len(vectors), CHUNK):
+        chunk = vectors[offset:offset + CHUNK]
+        store.add_embeddings([(f"step {offset + i}", vector) for i, vector in enumerate(chunk.tolist())])
+    store.close()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=str, default="1000,100000,1000000")
+    parser.add_argument("--dim", type=int, default=64)
+    parser.add_argument("--clusters", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+
+    print(f"{'records':>8} {'index':>6} {'build s':>8} {'mmap ms':>8} {'read ms':>8} {'disk MB':>8} {'ms/query':>9} {'recall@' + str(args.k):>9}")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        vectors = records(rng, size, args.dim, args.clusters)
+        queries = vectors[rng.integers(0, size, args.queries)] + 0.05 * rng.standard_normal((args.queries, args.dim), dtype=np.float32)
+        exact = faiss.IndexFlatL2(args.dim)
+        exact.add(vectors)
+        _, truth = exact.search(queries, args.k)
+        del exact
+
+        for index_type in (None, "hnsw", "ivf"):
+            with tempfile.TemporaryDirectory() as directory:
+                built = build(directory, vectors, index_type, max(1, size // 10) if index_type else size + 1)
+                disk = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+                start = time.perf_counter()
+                DiskFAISS.open(directory, FakeEmbeddings(size=args.dim), args.dim, mmap=False).close()
+                read = time.perf_counter() - start
+                start = time.perf_counter()
+                store = DiskFAISS.open(directory, FakeEmbeddings(size=args.dim), args.dim)
+                mapped = time.perf_counter() - start
+
+                start = time.perf_counter()
+                for query in queries.tolist():
+                    store.similarity_search_with_score_by_vector(query, k=args.k)
+                latency = (time.perf_counter() - start) / args.queries
+                _, found = store.index.search(queries, args.k)
+                recall = np.mean([len(set(f) & set(t)) / args.k for f, t in zip(found, truth)])
+                store.close()
+                del store
+
+            name = index_type or "flat"
+            print(f"{size:>8} {name:>6} {built:>8.2f} {mapped * 1000:>8.1f} {read * 1000:>8.1f} {disk / 2 ** 20:>8.1f} {latency * 1000:>9.3f} {recall:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 from __future__ import annotations
-from typing import List, Optional
+import asyncio
+from contextlib import closing, contextmanager
+from typing import Any, Callable, Dict, Generator, List, Optional, Tuple
 from pydantic import ValidationError
 from langchain.chains import LLMChain
 from langchain.chat_models.base import BaseChatModel
@@ -21,8 +23,19 @@ from langchain.tools.base import BaseTool
 from langchain.tools.human.tool import HumanInputRun
 from langchain.vectorstores.base import VectorStoreRetriever
 from summarizer import TextSummarizer
+from summary_cache import SummaryCache
+from llm_cache import LLMCache
+from function_calling import build_functions, function_call_to_reply
+from reply_parser import JSONRepairer, ReplyParseError, ReplyParser
+from file_index import FileIndex
+from output_parsers import OutputParserRegistry, condense_jest_output, default_registry
+from token_cache import TokenCounterCache
+from background import BackgroundQueue
+from history import CachedChatMessageHistory, HistoryCompactor, JournalChatMessageHistory
+from checkpoint import CheckpointManager
+from memory_writer import MemoryWriter
+import tracing
 import json
-import re
 import time
 import signal
 import sys
@@ -40,16 +53,55 @@ class TddGPTAgent:
         feedback_tool: Optional[HumanInputRun] = None,
         chat_history_memory: Optional[BaseChatMessageHistory] = None,
         context_window: Optional[int] = None,
+        token_counter: Optional[Callable[[str], int]] = None,
+        streaming: bool = False,
+        response_mode: str = "json",
+        summarizer_llm: Optional[BaseChatModel] = None,
+        output_parsers: Optional[OutputParserRegistry] = None,
+        summary_passthrough_tokens: int = 300,
+        summary_extractive_tokens: int = 6000,
+        summary_cache: Optional[SummaryCache] = None,
+        summary_concurrency: int = 8,
+        history_compactor: Optional[HistoryCompactor] = None,
+        checkpoints: Optional[CheckpointManager] = None,
+        memory_writer: Optional[MemoryWriter] = None,
+        llm_cache: Optional[LLMCache] = None,
     ):
         self.memory = memory
+        self.memory_writer = memory_writer or MemoryWriter(memory)
+        self.streaming = streaming
+        self.response_mode = response_mode
+        self.functions = build_functions(tools) if response_mode == "functions" else None
         self.context_window = context_window
         self.next_action_count = 0
         self.chain = chain
         self.output_parser = output_parser
         self.tools = tools
         self.feedback_tool = feedback_tool
-        self.chat_history_memory = chat_history_memory or ChatMessageHistory()
-        self.text_summarizer = TextSummarizer(summary_type="cli")
+        self.chat_history_memory = chat_history_memory if chat_history_memory is not None else ChatMessageHistory()
+        self.history_compactor = history_compactor
+        self.checkpoints = checkpoints
+        self.console: Callable[[str], None] = print
+        self.step_timings: List[dict] = []
+        self.background_queues: List[BackgroundQueue] = []
+        self.token_counter = token_counter
+        self.reply_parser = ReplyParser()
+        self.output_parsers = output_parsers or default_registry()
+        self.test_runner = next((tool.test_runner for tool in tools if getattr(tool, "test_runner", None) is not None), None)
+        self.speculator = next((tool.speculator for tool in tools if getattr(tool, "speculator", None) is not None), None)
+        self.text_summarizer = TextSummarizer(
+            summary_type="cli",
+            token_counter=token_counter,
+            llm=summarizer_llm,
+            passthrough_tokens=summary_passthrough_tokens,
+            extractive_tokens=summary_extractive_tokens,
+            cache=summary_cache,
+            max_concurrency=summary_concurrency,
+            llm_cache=llm_cache,
+        )
+        self.file_index = FileIndex.from_messages(
+            self.chat_history_memory.messages, token_counter or chain.prompt.token_counter
+        )
 
     @classmethod
     def from_llm_and_tools(
@@ -62,13 +114,30 @@ class TddGPTAgent:
         output_parser: Optional[BaseAutoGPTOutputParser] = None,
         chat_history_memory: Optional[BaseChatMessageHistory] = None,
         context_window: Optional[int] = 4096,
+        streaming: bool = False,
+        response_mode: str = "json",
+        summarizer_llm: Optional[BaseChatModel] = None,
+        summary_passthrough_tokens: int = 300,
+        summary_extractive_tokens: int = 6000,
+        summary_cache: Optional[SummaryCache] = None,
+        summary_concurrency: int = 8,
+        history_compactor: Optional[HistoryCompactor] = None,
+        checkpoints: Optional[CheckpointManager] = None,
+        memory_writer: Optional[MemoryWriter] = None,
+        memory_tokens: int = 0,
+        llm_cache: Optional[LLMCache] = None,
     ) -> TddGPTAgent:
+        token_counter = TokenCounterCache(llm.get_num_tokens)
         prompt = TddGPTPrompt(
             tools=tools,
-            input_variables=["memory", "messages", "goals", "user_input"],
-            token_counter=llm.get_num_tokens,
+            input_variables=["memory", "messages", "goals", "user_input", "file_index"],
+            token_counter=token_counter,
             output_dir=output_dir,
             send_token_limit=context_window,
+            response_mode=response_mode,
+            persistent_shell=any(getattr(tool, "session", None) is not None for tool in tools),
+            related_tests=any(getattr(tool, "test_runner", None) is not None for tool in tools),
+            memory_tokens=memory_tokens,
         )
         human_feedback_tool = HumanInputRun() if human_in_the_loop else None
         chain = LLMChain(llm=llm, prompt=prompt)
@@ -79,256 +148,591 @@ class TddGPTAgent:
             tools,
             feedback_tool=human_feedback_tool,
             chat_history_memory=chat_history_memory,
+            token_counter=token_counter,
+            streaming=streaming,
+            response_mode=response_mode,
+            summarizer_llm=summarizer_llm,
+            summary_passthrough_tokens=summary_passthrough_tokens,
+            summary_extractive_tokens=summary_extractive_tokens,
+            summary_cache=summary_cache,
+            summary_concurrency=summary_concurrency,
+            history_compactor=history_compactor,
+            checkpoints=checkpoints,
+            memory_writer=memory_writer,
+            llm_cache=llm_cache,
         )
 
     def summarize_text(self, text: str) -> str:
-        result = self.text_summarizer.summarize(text)
+        result, _ = self.summarize_text_tiered(text)
         return result
 
+    def summarize_text_tiered(self, text: str) -> Tuple[str, str]:
+        return self.text_summarizer.summarize_tiered(text)
+
     def parse_npm_test_output(self, test_output):
-        lines = test_output.strip().split("\n")
-        parsed_output = []
-        inside_console_error_block = False
-        inside_console_details = False
-        console_line_count = 0
-        in_expect_block = False
-        after_received = False
-
-        for line in lines:
-            if line.startswith("PASS") or line.startswith("FAIL"):
-                parsed_output.append(line + ("\n" if line.startswith("PASS") else ""))
-                inside_console_error_block = False
-                inside_console_details = False
-                in_expect_block = False  # Reset the expect block flag
-                after_received = False  # Reset the after_received flag
-
-            elif line.startswith("  ●"):
-                parsed_output.append(line)
-                inside_console_error_block = "Console" in line
-                if inside_console_error_block:
-                    inside_console_details = True
-            
-            elif "Error: " in line:
-                parsed_output.append(f"    {line.strip()}")
-            
-            elif line.startswith("    expect("):
-                parsed_output.append(line.strip())
-                in_expect_block = True  # Set flag to capture the next few lines
-            
-            elif in_expect_block and ("Expected element" in line or "Received:" in line or "Test todo" in line or "Number of calls:" in line):
-                parsed_output.append(f"    {line.strip()}")
-                if "Received:" in line:
-                    after_received = True  # Flag to capture the line after "Received:"
-            
-            elif after_received:  # If the flag is True, capture the next line
-                parsed_output.append(f"    {line.strip()}")
-                after_received = False  # Reset the flag
-            
-            elif "Expected:" in line or "Received:" in line:
-                if not inside_console_error_block:
-                    parsed_output.append(f"    {line.strip()}")
-            
-            elif line.startswith("    >"):
-                parsed_output.append(f"    {line}\n")
-            
-            elif inside_console_error_block and inside_console_details:
-                if "console.error" in line:
-                    parsed_output.append("  ● console.error")
-                elif "Warning:" in line or "Error:" in line: 
-                    parsed_output.append(f"    {line.strip()}")
-                elif console_line_count < 1:
-                    parsed_output.append(f"    {line.strip()}")
-                    console_line_count += 1
-            
-            elif "Test Suites:" in line or "Tests:" in line:
-                parsed_output.append(line)
-
-        return "\n".join(parsed_output)
-
-    def run(self, goals: List[str]) -> str:
-        user_input = (
-            "You are at the first step. Determine which next command to use, "
-            "and respond using the json as specified in Response Format section."
+        return condense_jest_output(test_output)
+
+    def print_thoughts(self, thoughts: dict) -> None:
+        self.console(f'\033[92mRole:\033[0m {thoughts["role"]}')
+        self.console(f'\033[92mPhase:\033[0m {thoughts["phase"]}')
+        self.console(f'\033[92mTests:\033[0m {thoughts["tests_status"]}')
+        self.console(f'\033[92mThought:\033[0m {thoughts["text"]}')
+        self.console(f'\033[92mReasoning:\033[0m {thoughts["reasoning"]}')
+        self.console(f'\033[92mCriticism:\033[0m {thoughts["criticism"]}')
+        if isinstance(thoughts["kanban"]["done"], list):
+            self.console(f'\033[92mDone:\033[0m\n' + '\n'.join('- ' + item for item in thoughts["kanban"]["done"]))
+        else:
+            self.console(f'\033[92mDone:\033[0m\n{thoughts["kanban"]["done"]}')
+        self.console(f'\033[92mInProg:\033[0m {thoughts["kanban"]["in_progress"]}')
+        if isinstance(thoughts["kanban"]["todo"], list):
+            self.console(f'\033[92mTodo:\033[0m\n' + '\n'.join('- ' + item for item in thoughts["kanban"]["todo"]))
+        else:
+            self.console(f'\033[92mTodo:\033[0m\n{thoughts["kanban"]["todo"]}')
+
+    def _feed_reply_chunk(self, repairer: JSONRepairer, content: str) -> Tuple[bool, Optional[dict]]:
+        """Feed a streamed chunk, printing the thoughts once complete. Returns whether to stop and the printed thoughts."""
+        printed_thoughts = None
+        for key, value in repairer.feed(content):
+            if key == "thoughts" and isinstance(value, dict):
+                try:
+                    self.print_thoughts(value)
+                    printed_thoughts = value
+                except (KeyError, TypeError):
+                    pass
+        if repairer.complete:
+            return True, printed_thoughts
+        if repairer.error:
+            self.console(f"Aborting the response: {repairer.error}")
+            return True, printed_thoughts
+        return False, printed_thoughts
+
+    def _stream_reply(self, inputs: dict) -> Tuple[str, JSONRepairer, Optional[dict]]:
+        """Stream the reply, printing the thoughts as soon as they are complete.
+
+        Generation is stopped as soon as the thoughts and the command have been
+        received, or as soon as the output can no longer be repaired into a reply.
+        Returns the reply text, the repairer that consumed it and the thoughts that
+        were printed, if any.
+        """
+        messages = self.chain.prompt.format_messages(**inputs)
+        repairer = JSONRepairer()
+        printed_thoughts = None
+        with closing(self.chain.llm.stream(messages)) as stream:
+            for chunk in stream:
+                done, thoughts = self._feed_reply_chunk(repairer, chunk.content)
+                printed_thoughts = thoughts or printed_thoughts
+                if done:
+                    break
+        return repairer.result(), repairer, printed_thoughts
+
+    async def _astream_reply(self, inputs: dict) -> Tuple[str, JSONRepairer, Optional[dict]]:
+        """Async _stream_reply."""
+        messages = self.chain.prompt.format_messages(**inputs)
+        repairer = JSONRepairer()
+        printed_thoughts = None
+        stream = self.chain.llm.astream(messages)
+        try:
+            async for chunk in stream:
+                done, thoughts = self._feed_reply_chunk(repairer, chunk.content)
+                printed_thoughts = thoughts or printed_thoughts
+                if done:
+                    break
+        finally:
+            await stream.aclose()
+        return repairer.result(), repairer, printed_thoughts
+
+    def _call_functions(self, inputs: dict) -> str:
+        """Get the next command as a function call, converted to the json response format."""
+        messages = self.chain.prompt.format_messages(**inputs)
+        message = self.chain.llm.predict_messages(messages, functions=self.functions)
+        return function_call_to_reply(message)
+
+    async def _acall_functions(self, inputs: dict) -> str:
+        messages = self.chain.prompt.format_messages(**inputs)
+        message = await self.chain.llm.apredict_messages(messages, functions=self.functions)
+        return function_call_to_reply(message)
+
+    def _step_inputs(self, goals: List[str], user_input: str) -> dict:
+        return dict(
+            goals=goals,
+            messages=self.chat_history_memory.messages,
+            memory=self.memory_writer,
+            file_index=self.file_index,
+            user_input=user_input,
+            response_format="json",
         )
 
-        # Interaction Loop
-        loop_count = 0
-
-        while True:
-            human_message = ""
-
-            # Discontinue if continuous limit is reached
-            loop_count += 1
-
-            # Send message to AI, get response
-            assistant_reply = self.chain.run(
-                goals=goals,
-                messages=self.chat_history_memory.messages,
-                memory=self.memory,
-                user_input=user_input,
-                response_format="json",
+    def _reply(self, inputs: dict, loop_count: int) -> Generator[tuple, Any, Tuple[str, Optional[JSONRepairer], Optional[dict]]]:
+        """Send the prompt to the AI, returning its reply, the repairer and the thoughts printed while streaming."""
+        repairer = None
+        streamed_thoughts = None
+        if self.functions is not None:
+            assistant_reply = yield "call_functions", inputs
+            self.console(f"\033[91mStep Number:\033[0m {loop_count}")
+        elif self.streaming:
+            self.console(f"\033[91mStep Number:\033[0m {loop_count}")
+            assistant_reply, repairer, streamed_thoughts = yield "stream_reply", inputs
+        else:
+            assistant_reply = yield "predict", inputs
+            self.console(f"\033[91mStep Number:\033[0m {loop_count}")
+        return assistant_reply.strip(), repairer, streamed_thoughts
+
+    def _parse_reply(
+        self, assistant_reply: str, repairer: Optional[JSONRepairer], streamed_thoughts: Optional[dict]
+    ) -> Tuple[Optional[dict], Optional[str]]:
+        """Parse and print the reply. Returns it, or the user input asking for a new one."""
+        try:
+            parsed = self.reply_parser.parse(assistant_reply, repairer=repairer)
+        except ReplyParseError as e:
+            self.console(f"Exception occurred: {e}")
+            self.console(assistant_reply)
+            if e.missing_key:
+                return None, (
+                    f"{assistant_reply}\n"
+                    f"The response is missing the key '{e.missing_key}'. Determine the next step "
+                    f"and respond using the json format as specified in Response Format section."
+                )
+            return None, (
+                f"{assistant_reply}\n"
+                f"The response is not a valid json. Determine the next step "
+                f"and respond using the json format as specified in Response Format section:"
             )
 
-            print(f"\033[91mStep Number:\033[0m {loop_count}")
-
-            start_index = assistant_reply.find('{')
-            end_index = assistant_reply.rfind('}')
-
-            extracted_assistant_reply = assistant_reply.strip()
-            if start_index != -1 and end_index != -1 and start_index < end_index:
-                extracted_assistant_reply = assistant_reply[start_index:end_index + 1]
-
-            assistant_reply = extracted_assistant_reply.strip()
+        if parsed:
             try:
-                parsed = json.loads(assistant_reply, strict=False)
-            except json.JSONDecodeError:
-                preprocessed_text = re.sub(r'(?<!\\)\\(?!["\\/bfnrt]|u[0-9a-fA-F]{4})', r"\\\\", assistant_reply)
-                try:
-                    parsed = json.loads(preprocessed_text, strict=False)
-                except Exception as e:
-                    print(f"Exception occurred: {e}")
-                    print(preprocessed_text)
-                    user_input = (
-                        f"{assistant_reply}\n"
-                        f"The response is not a valid json. Determine the next step "
-                        f"and respond using the json format as specified in Response Format section:"
-                    )
-                    continue
-
-            if parsed:
-                try:
-                    print(f'\033[92mRole:\033[0m {parsed["thoughts"]["role"]}')
-                    print(f'\033[92mPhase:\033[0m {parsed["thoughts"]["phase"]}')
-                    print(f'\033[92mTests:\033[0m {parsed["thoughts"]["tests_status"]}')
-                    print(f'\033[92mThought:\033[0m {parsed["thoughts"]["text"]}')
-                    print(f'\033[92mReasoning:\033[0m {parsed["thoughts"]["reasoning"]}')
-                    print(f'\033[92mCriticism:\033[0m {parsed["thoughts"]["criticism"]}')
-                    if isinstance(parsed["thoughts"]["kanban"]["done"], list):
-                        print(f'\033[92mDone:\033[0m\n' + '\n'.join('- ' + item for item in parsed["thoughts"]["kanban"]["done"]))
-                    else:
-                        print(f'\033[92mDone:\033[0m\n{parsed["thoughts"]["kanban"]["done"]}')
-                    print(f'\033[92mInProg:\033[0m {parsed["thoughts"]["kanban"]["in_progress"]}')
-                    if isinstance(parsed["thoughts"]["kanban"]["todo"], list):
-                        print(f'\033[92mTodo:\033[0m\n' + '\n'.join('- ' + item for item in parsed["thoughts"]["kanban"]["todo"]))
-                    else:
-                        print(f'\033[92mTodo:\033[0m\n{parsed["thoughts"]["kanban"]["todo"]}')
-                    if parsed["command"]["name"] == "cli":
-                      commands = parsed['command']['args']['commands']
-                      command_str = " && ".join(commands) if isinstance(commands, list) else commands
-                      print(f"\033[92mAction:\033[0m executing cli commands '{command_str}'")
-
-                except KeyError as e:
-                  print(f"Missing key: {e}")
-                  print(assistant_reply)
-                  user_input = (
-                      f"{assistant_reply}\n"
-                      f"The response is missing the key '{e}'. Determine the next step "
-                      f"and respond using the json format as specified in Response Forwat section."
-                  )
-                  continue
-
-            self.chat_history_memory.add_message(HumanMessage(content=user_input))
-            self.chat_history_memory.add_message(AIMessage(content=json.dumps(parsed)))
-
-            # Get command name and arguments
-            action = self.output_parser.parse(assistant_reply)
-
-            tools = {t.name: t for t in self.tools}
-            if action.name == FINISH_NAME or "finish " in parsed["thoughts"]["kanban"]["in_progress"].lower():
-                return action.args.get("response", "Goals completed! Exiting.") 
+                if streamed_thoughts is None or streamed_thoughts != parsed["thoughts"]:
+                    self.print_thoughts(parsed["thoughts"])
+                if parsed["command"]["name"] == "cli":
+                  self.console(f"\033[92mAction:\033[0m executing cli commands '{self._command_str(parsed)}'")
+
+            except KeyError as e:
+              self.console(f"Missing key: {e}")
+              self.console(assistant_reply)
+              return None, (
+                  f"{assistant_reply}\n"
+                  f"The response is missing the key '{e}'. Determine the next step "
+                  f"and respond using the json format as specified in Response Forwat section."
+              )
+        return parsed, None
+
+    @staticmethod
+    def _command_str(parsed: dict) -> str:
+        commands = parsed['command']['args']['commands']
+        return " && ".join(commands) if isinstance(commands, list) else commands
+
+    def _is_finish(self, action, parsed: dict) -> bool:
+        return action.name == FINISH_NAME or "finish " in parsed["thoughts"]["kanban"]["in_progress"].lower()
+
+    def _print_stats(self) -> None:
+        if self.chain.verbose and isinstance(self.token_counter, TokenCounterCache):
+            self.console(f"\033[92mToken cache:\033[0m {self.token_counter.stats()}")
+        if self.chain.verbose:
+            self.console(f"\033[92mReply parser:\033[0m {self.reply_parser.stats}")
+            self.console(f"\033[92mOutput parsers:\033[0m {self.output_parsers.stats}")
+            self.console(f"\033[92mSummary tiers:\033[0m {self.text_summarizer.stats}")
+            if self.test_runner is not None:
+                self.console(f"\033[92mTest runs:\033[0m {self.test_runner.stats}")
+            if self.speculator is not None:
+                self.console(f"\033[92mSpeculative tests:\033[0m hit rate {self.speculator.hit_rate:.2f}, {self.speculator.stats}")
+            if self.text_summarizer.cache is not None:
+                self.console(f"\033[92mSummary cache:\033[0m {self.text_summarizer.cache.stats()}")
+            if self.step_timings:
+                self.console(f"\033[92mStep timings:\033[0m {self.timing_summary()}")
+            if self.history_compactor is not None:
+                self.console(f"\033[92mHistory compaction:\033[0m {self.history_compactor.stats}")
+            if self.checkpoints is not None:
+                self.console(f"\033[92mCheckpoints:\033[0m {self.checkpoints.stats}")
+            self.console(f"\033[92mMemory writes:\033[0m {self.memory_writer.stats}")
+            for queue in self.background_queues:
+                self.console(f"\033[92mBackground {queue.name}:\033[0m {queue.stats}")
+
+    def timing_summary(self) -> dict:
+        """Average seconds per step spent in each phase of the loop."""
+        phases = {}
+        for timings in self.step_timings:
+            for phase, seconds in timings.items():
+                phases[phase] = phases.get(phase, 0.0) + seconds
+        return {phase: round(seconds / len(self.step_timings), 4) for phase, seconds in phases.items()}
+
+    @contextmanager
+    def _timed(self, timings: dict, phase: str):
+        start = time.perf_counter()
+        try:
+            with tracing.span(f"step.{phase}"):
+                yield
+        finally:
+            timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - start
+
+    @contextmanager
+    def _timed_reply(self, timings: dict):
+        """Time getting the reply as "llm", less the time spent formatting the prompt, timed as "prompt"."""
+        formatted = getattr(self.chain.prompt, "format_seconds", 0.0)
+        with self._timed(timings, "llm"):
+            yield
+        prompt_seconds = getattr(self.chain.prompt, "format_seconds", 0.0) - formatted
+        timings["prompt"] = timings.get("prompt", 0.0) + prompt_seconds
+        timings["llm"] -= prompt_seconds
+
+    def _condense_cli_output(self, parsed: dict, observation: str) -> Optional[Tuple[str, str, str]]:
+        """Condense the output of the cli tool locally, returning it with its tier and the human message.
+
+        Returns None when the output has to be summarized.
+        """
+        commands = parsed['command']['args']['commands']
+        command_report = self.output_parsers.parse(commands, observation)
+        if command_report is not None:
+            human_message = ""
+            if command_report.tests_failed:
+                human_message = "However, the tests have failed. Try harder. "
+            elif command_report.tests_ran:
+                human_message = "All tests have passed. Good job! "
+            if command_report.tests_ran and self.test_runner is not None and self.test_runner.last_run_related:
+                human_message += "Only the tests related to the changed files were run. "
+            return command_report.format(), "parsed", human_message
+        if 'npm test' in self._command_str(parsed):
+            summarized_observation = self.parse_npm_test_output(observation)
+
+            # print(f'-----------\n{observation}\n---------')
+
+            if 'FAIL' in summarized_observation:
+                human_message = "However, the tests have failed. Try harder. "
+            else:
+                human_message = "All tests have passed. Good job! "
+            return summarized_observation, "parsed", human_message
+        return None
+
+    def _action_result(self, action, summarized_observation: str) -> str:
+        if action.name in {t.name for t in self.tools}:
+            return f"The {action.name} tool returned: {summarized_observation}"
+        elif action.name == "ERROR":
+            return f"Error: {action.args}. "
+        return (
+            f"Unknown command '{action.name}'. "
+            f"Please refer to the 'COMMANDS' list for available "
+        )
 
-            if action.name in tools:
-                tool = tools[action.name]
+    @staticmethod
+    def _tool_error(e: Exception, action) -> str:
+        if isinstance(e, ValidationError):
+            return f"Validation Error in args: {str(e)}, args: {action.args}"
+        return f"Error: {str(e)}, {type(e).__name__}, args: {action.args}"
+
+    def _act(self, action, parsed: dict, timings: dict) -> Generator[tuple, Any, Tuple[str, str, str, str]]:
+        """Run the tool of the action. Returns the observation, its summary, the summary tier and the human message."""
+        tools = {t.name: t for t in self.tools}
+        observation = summarized_observation = ""
+        summary_tier = "passthrough"
+        human_message = ""
+        if action.name in tools:
+            with self._timed(timings, "tool"):
                 try:
-                    observation = tool.run(action.args)
-                except ValidationError as e:
-                    observation = (
-                        f"Validation Error in args: {str(e)}, args: {action.args}"
-                    )
+                    observation = yield "tool", tools[action.name], action.args
                 except Exception as e:
-                    observation = (
-                        f"Error: {str(e)}, {type(e).__name__}, args: {action.args}"
-                    )
-
-                if action.name == "cli":
-                    if 'npm test' in command_str:
-                        summarized_observation = self.parse_npm_test_output(observation)
-
-                        # print(f'-----------\n{observation}\n---------')
-
-                        if 'FAIL' in summarized_observation:
-                            human_message = "However, the tests have failed. Try harder. "
-                        else:
-                            human_message = "All tests have passed. Good job! "
+                    observation = self._tool_error(e, action)
+            summarized_observation = observation
+            if action.name == "cli":
+                with self._timed(timings, "summarize"):
+                    condensed = self._condense_cli_output(parsed, observation)
+                    if condensed is not None:
+                        summarized_observation, summary_tier, human_message = condensed
                     else:
-                        summarized_observation = self.summarize_text(observation)
-                else:
-                    summarized_observation = observation
-
-                result = f"The {tool.name} tool returned: {summarized_observation}"
+                        summarized_observation, summary_tier = yield "summarize", observation
+        return observation, summarized_observation, summary_tier, human_message
+
+    def _record_step(
+        self, loop_count: int, parsed: dict, observation: str, summarized_observation: str, summary_tier: str
+    ) -> Tuple[str, str, str]:
+        """Print the step and update the file index. Returns the step memory, its code and the file path."""
+        parsed_memory_to_add = {
+            "step": loop_count,
+            "role": parsed['thoughts']['role'],
+            "phase": parsed['thoughts']['phase'],
+            "tests_status": parsed['thoughts']['tests_status'],
+            "thought": parsed['thoughts']['text'],
+            "reasoning": parsed['thoughts']['reasoning'],
+            "criticism": parsed['thoughts']['criticism'],
+            "kanban": {
+              "todo": parsed["thoughts"]["kanban"]["todo"],
+              "in_progress": parsed["thoughts"]["kanban"]["in_progress"],
+              "done": parsed["thoughts"]["kanban"]["done"],
+            }
+        }
+
+        code_str = ""
+        file_path = ""
+        if parsed["command"]["name"] == "read_file":
+            code_str = f"\n```\n// {parsed['command']['args']['file_path']}\n{observation}\n```"
+            file_path = parsed["command"]["args"]["file_path"]
+
+            parsed_memory_to_add["Action"] = f'reading file {file_path}'
+            parsed_memory_to_add["Result"] = code_str
+
+            self.console(f'\033[92mAction:\033[0m reading file {file_path}')
+            self.console(f'\033[92mCode:\033[0m{code_str}\n')
+        elif parsed["command"]["name"] == "write_file":
+            code_str = f"\n```\n// {parsed['command']['args']['file_path']}\n{parsed['command']['args']['text']}\n```"
+            file_path = parsed["command"]["args"]["file_path"]
+
+            parsed_memory_to_add["Action"] = f'writing file {file_path}'
+            parsed_memory_to_add["Result"] = f'successfully written'
+
+            self.console(f'\033[92mAction:\033[0m writing file {file_path}')
+            self.console(f'\033[92mCode:\033[0m{code_str}\n')
+        elif parsed["command"]["name"] == "cli":
+            parsed_memory_to_add["Action"] = f"executing cli commands '{self._command_str(parsed)}'"
+            parsed_memory_to_add["Result"] = f"\n{summarized_observation}"
+
+            self.console(f'\033[92mResult ({summary_tier}):\033[0m\n{summarized_observation}\n')
+
+        if code_str:
+            self.file_index.update(file_path, code_str, loop_count)
+        if self.test_runner is not None and parsed["command"]["name"] == "write_file":
+            self.test_runner.notify_changed(file_path)
+        if self.speculator is not None and parsed["command"]["name"] == "write_file":
+            # Run the tests while the next reply is generated
+            self.speculator.start()
+
+        memory_to_add = f'```json\n{json.dumps(parsed_memory_to_add, indent=4)}\n```'
+        return memory_to_add, code_str, file_path
+
+    @staticmethod
+    def _next_user_input(loop_count: int, human_message: str) -> str:
+        return (
+            f"You have completed step {loop_count}. {human_message}"
+            f"Determine the next step and respond using the json specified in Response Format section."
+        )
 
-            elif action.name == "ERROR":
-                result = f"Error: {action.args}. "
-            else:
-                result = (
-                    f"Unknown command '{action.name}'. "
-                    f"Please refer to the 'COMMANDS' list for available "
-                )
+    @staticmethod
+    def _first_user_input() -> str:
+        return (
+            "You are at the first step. Determine which next command to use, "
+            "and respond using the json as specified in Response Format section."
+        )
 
-            parsed_memory_to_add = {
-                "step": loop_count,
-                "role": parsed['thoughts']['role'],
-                "phase": parsed['thoughts']['phase'],
-                "tests_status": parsed['thoughts']['tests_status'],
-                "thought": parsed['thoughts']['text'],
-                "reasoning": parsed['thoughts']['reasoning'],
-                "criticism": parsed['thoughts']['criticism'],
-                "kanban": {
-                  "todo": parsed["thoughts"]["kanban"]["todo"],
-                  "in_progress": parsed["thoughts"]["kanban"]["in_progress"],
-                  "done": parsed["thoughts"]["kanban"]["done"],
-                }
-            }
+    def _save_checkpoint(self, timings: dict, loop_count: int, user_input: str, goals: List[str], parsed: dict) -> None:
+        if self.checkpoints is not None:
+            with self._timed(timings, "checkpoint"):
+                if self.checkpoints.memory_due(loop_count):
+                    self.memory_writer.flush()
+                self.checkpoints.save(self, loop_count, user_input, goals, parsed["thoughts"]["kanban"])
 
-            code_str = ""
-            file_path = ""
-            if parsed["command"]["name"] == "read_file":
-                code_str = f"\n```\n// {parsed['command']['args']['file_path']}\n{observation}\n```"
-                file_path = parsed["command"]["args"]["file_path"]
+    def run(self, goals: List[str], start_step: int = 0, user_input: Optional[str] = None) -> str:
+        """Run the loop from the step after start_step, e.g. one restored from a checkpoint."""
+        with tracing.span("agent.run", start_step=start_step):
+            try:
+                return self._run(goals, start_step, user_input)
+            finally:
+                # The step memories of a batch still pending when the loop exits early
+                self.memory_writer.flush()
 
-                parsed_memory_to_add["Action"] = f'reading file {file_path}'
-                parsed_memory_to_add["Result"] = code_str
+    def _loop(self, goals: List[str], start_step: int, user_input: Optional[str]) -> Generator[tuple, Any, str]:
+        """The interaction loop, shared by run() and arun().
 
-                print(f'\033[92mAction:\033[0m reading file {file_path}')
-                print(f'\033[92mCode:\033[0m{code_str}\n')
-            elif parsed["command"]["name"] == "write_file":
-                code_str = f"\n```\n// {parsed['command']['args']['file_path']}\n{parsed['command']['args']['text']}\n```"
-                file_path = parsed["command"]["args"]["file_path"]
+        Every call that differs between the two, like getting the reply, running a tool
+        or adding the step memory, is yielded as a (name, *args) effect, and its result
+        sent back by the driver, _drive() or _adrive(). An exception raised by an effect
+        is thrown back in at the yield.
+        """
+        user_input = user_input or self._first_user_input()
 
-                parsed_memory_to_add["Action"] = f'writing file {file_path}'
-                parsed_memory_to_add["Result"] = f'successfully written'
+        # Interaction Loop
+        loop_count = start_step
 
-                print(f'\033[92mAction:\033[0m writing file {file_path}')
-                print(f'\033[92mCode:\033[0m{code_str}\n')
-            elif parsed["command"]["name"] == "cli":
-                parsed_memory_to_add["Action"] = f"executing cli commands '{command_str}'"
-                parsed_memory_to_add["Result"] = f"\n{summarized_observation}"
+        while True:
+            # Discontinue if continuous limit is reached
+            loop_count += 1
+            timings: dict = {}
+            step_start = time.perf_counter()
+            step = tracing.start_span("step", step=loop_count)
 
-                print(f'\033[92mResult:\033[0m\n{summarized_observation}\n')
+            # Send message to AI, get response
+            with self._timed_reply(timings):
+                inputs = self._step_inputs(goals, user_input)
+                assistant_reply, repairer, streamed_thoughts = yield from self._reply(inputs, loop_count)
+            with self._timed(timings, "parse"):
+                parsed, retry_input = self._parse_reply(assistant_reply, repairer, streamed_thoughts)
+            yield "render", timings
+            if retry_input is not None:
+                step.end("retry")
+                user_input = retry_input
+                continue
+
+            with self._timed(timings, "history"):
+                self.chat_history_memory.add_message(HumanMessage(content=user_input))
+                self.chat_history_memory.add_message(AIMessage(content=json.dumps(parsed)))
 
-            memory_to_add = f'```json\n{json.dumps(parsed_memory_to_add, indent=4)}\n```'
+            # Get command name and arguments
+            action = self.output_parser.parse(json.dumps(parsed))
+            step.set(command=action.name)
+            if self._is_finish(action, parsed):
+                yield "finish", timings
+                step.end()
+                self._print_stats()
+                yield "render", timings
+                return action.args.get("response", "Goals completed! Exiting.")
+
+            observation, summarized_observation, summary_tier, human_message = yield from self._act(action, parsed, timings)
+            result = self._action_result(action, summarized_observation)
+            memory_to_add, code_str, file_path = self._record_step(
+                loop_count, parsed, observation, summarized_observation, summary_tier
+            )
 
             if self.feedback_tool is not None:
-                feedback = f"\n{self.feedback_tool.run('Input: ')}"
-                if feedback in {"q", "stop"}:
-                    print("EXITING")
+                feedback = f"\n{(yield 'feedback', timings)}"
+                if feedback.strip() in {"q", "stop"}:
+                    step.end()
+                    self.console("EXITING")
                     return "EXITING"
                 memory_to_add += f"\nFeedback: {feedback}"
 
-            self.memory.add_documents([Document(page_content=memory_to_add)])
-            self.chat_history_memory.add_message(SystemMessage(content=result, additional_kwargs={'metadata': memory_to_add, 'code': code_str, 'file_path': file_path}))
-
-            user_input = (
-                f"You have completed step {loop_count}. {human_message}"
-                f"Determine the next step and respond using the json specified in Response Format section."
-            )
+            with self._timed(timings, "history"):
+                self.chat_history_memory.add_message(SystemMessage(content=result, additional_kwargs={'metadata': memory_to_add, 'code': code_str, 'file_path': file_path, 'summary_tier': summary_tier}))
+            yield "remember", timings, Document(page_content=memory_to_add)
+
+            if self.history_compactor is not None:
+                with self._timed(timings, "compact"):
+                    self.history_compactor.compact(self.chat_history_memory.messages)
+
+            user_input = self._next_user_input(loop_count, human_message)
+            if self.checkpoints is not None:
+                yield "checkpoint", timings, loop_count
+                self._save_checkpoint(timings, loop_count, user_input, goals, parsed)
+            timings["total"] = time.perf_counter() - step_start
+            self.step_timings.append(timings)
+            step.end()
+
+    @staticmethod
+    def _drive(loop: Generator[tuple, Any, str], effects: Dict[str, Callable]) -> str:
+        """Run the loop, calling its effects."""
+        result: Any = None
+        error: Optional[BaseException] = None
+        while True:
+            try:
+                name, *args = loop.throw(error) if error is not None else loop.send(result)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, error = effects[name](*args), None
+            except BaseException as e:
+                result, error = None, e
+
+    @staticmethod
+    async def _adrive(loop: Generator[tuple, Any, str], effects: Dict[str, Callable]) -> str:
+        """Run the loop, awaiting its effects."""
+        result: Any = None
+        error: Optional[BaseException] = None
+        while True:
+            try:
+                name, *args = loop.throw(error) if error is not None else loop.send(result)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, error = await effects[name](*args), None
+            except BaseException as e:
+                result, error = None, e
+
+    def _run(self, goals: List[str], start_step: int, user_input: Optional[str]) -> str:
+        def remember(timings: dict, document: Document) -> None:
+            with self._timed(timings, "memory"):
+                self.memory_writer.add(document)
+
+        effects = {
+            "call_functions": self._call_functions,
+            "stream_reply": self._stream_reply,
+            "predict": lambda inputs: self.chain.run(**inputs),
+            "tool": lambda tool, args: tool.run(args),
+            "summarize": self.summarize_text_tiered,
+            "feedback": lambda timings: self.feedback_tool.run("Input: "),
+            "remember": remember,
+            "render": lambda timings: None,
+            "finish": lambda timings: self.memory_writer.flush(),
+            "checkpoint": lambda timings, loop_count: None,
+        }
+        return self._drive(self._loop(goals, start_step, user_input), effects)
+
+    async def arun(
+        self, goals: List[str], queue_size: int = 8, start_step: int = 0, user_input: Optional[str] = None
+    ) -> str:
+        """Async run. The embedding of the step memory, the chat history writes and the console
+        output are moved to background queues of up to queue_size jobs, flushed before returning
+        and before the vector memory is checkpointed.
+        """
+        with tracing.span("agent.run", start_step=start_step):
+            try:
+                return await self._arun(goals, queue_size, start_step, user_input)
+            finally:
+                # The step memories of a batch still pending when the loop exits early
+                await asyncio.to_thread(self.memory_writer.flush)
+
+    async def _arun(self, goals: List[str], queue_size: int, start_step: int, user_input: Optional[str]) -> str:
+        history = self.chat_history_memory
+        if not isinstance(history, (ChatMessageHistory, CachedChatMessageHistory, JournalChatMessageHistory)):
+            history = CachedChatMessageHistory(history)
+        original_history, self.chat_history_memory = self.chat_history_memory, history
+        lines: List[str] = []
+        self.console = lines.append
+
+        async def render() -> None:
+            if lines:
+                text = "\n".join(lines)
+                lines.clear()
+                await console.submit(print, text)
+
+        async def persist() -> None:
+            if isinstance(history, CachedChatMessageHistory) and history.pending:
+                await writer.submit(history.flush)
+
+        async def render_step(timings: dict) -> None:
+            with self._timed(timings, "background"):
+                await render()
+
+        async def feedback(timings: dict) -> str:
+            await render()
+            await console.flush()
+            return await asyncio.to_thread(self.feedback_tool.run, "Input: ")
+
+        async def remember(timings: dict, document: Document) -> None:
+            with self._timed(timings, "background"):
+                await embedder.submit(self.memory_writer.add, document)
+                await persist()
+                await render()
+
+        async def finish(timings: dict) -> None:
+            await persist()
+            await writer.flush()
+            await embedder.submit(self.memory_writer.flush)
+            await embedder.flush()
+
+        async def checkpoint(timings: dict, loop_count: int) -> None:
+            with self._timed(timings, "background"):
+                await writer.flush()
+                if self.checkpoints.memory_due(loop_count):
+                    await embedder.flush()
+
+        effects = {
+            "call_functions": self._acall_functions,
+            "stream_reply": self._astream_reply,
+            "predict": lambda inputs: self.chain.arun(**inputs),
+            "tool": lambda tool, args: tool.arun(args),
+            "summarize": self.text_summarizer.asummarize_tiered,
+            "feedback": feedback,
+            "remember": remember,
+            "render": render_step,
+            "finish": finish,
+            "checkpoint": checkpoint,
+        }
+        try:
+            async with BackgroundQueue("console", queue_size) as console, \
+                    BackgroundQueue("history", queue_size) as writer, \
+                    BackgroundQueue("memory", queue_size) as embedder:
+                self.background_queues = [console, writer, embedder]
+                try:
+                    return await self._adrive(self._loop(goals, start_step, user_input), effects)
+                finally:
+                    # What the step printed since its last render, e.g. when the loop exits early
+                    await render()
+        finally:
+            self.console = print
+            if history is not original_history:
+                history.flush()
+                self.chat_history_memory = original_history
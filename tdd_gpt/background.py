@@ -0,0 +1,55 @@
+import asyncio
+import time
+from contextlib import suppress
+from typing import Any, Callable, Optional
+
+
+class BackgroundQueue:
+    """Runs blocking jobs in a background task, in the order they were submitted.
+
+    submit() returns as soon as the job is queued and only waits when maxsize
+    jobs are already pending, so a slow consumer slows the producer down instead
+    of piling up work. The jobs run in a thread, one at a time. A failing job is
+    counted and printed, it does not stop the queue. Used as an async context
+    manager, the queue is flushed on exit.
+    """
+
+    def __init__(self, name: str, maxsize: int = 8):
+        self.name = name
+        self.maxsize = maxsize
+        self.stats = {"jobs": 0, "errors": 0, "seconds": 0.0, "waited": 0.0}
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self) -> "BackgroundQueue":
+        self._queue = asyncio.Queue(self.maxsize)
+        self._task = asyncio.create_task(self._work())
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.flush()
+        self._task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._task
+
+    async def submit(self, fn: Callable[..., Any], *args: Any) -> None:
+        start = time.perf_counter()
+        await self._queue.put((fn, args))
+        self.stats["waited"] += time.perf_counter() - start
+
+    async def flush(self) -> None:
+        await self._queue.join()
+
+    async def _work(self) -> None:
+        while True:
+            fn, args = await self._queue.get()
+            start = time.perf_counter()
+            try:
+                await asyncio.to_thread(fn, *args)
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"\033[91mBackground {self.name} failed:\033[0m {type(e).__name__}: {e}")
+            finally:
+                self.stats["jobs"] += 1
+                self.stats["seconds"] += time.perf_counter() - start
+                self._queue.task_done()
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain.schema import BaseMessage, Document
+
+from file_index import step_from_metadata
+from history import JournalChatMessageHistory
+from speculation import SKIP_DIRS
+
+CHECKPOINT_VERSION = 1
+STATE_FILE = "state.json"
+
+
+@dataclass
+class Checkpoint:
+    step: int
+    user_input: str
+    goals: List[str]
+    messages: int
+    kanban: dict
+    manifest: Dict[str, str]
+    history_path: Optional[str] = None
+    memory_dir: Optional[str] = None
+    memory_step: int = 0
+    memories: int = 0
+    created: float = field(default_factory=time.time)
+    version: int = CHECKPOINT_VERSION
+
+
+def file_digest(path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class CheckpointManager:
+    """Saves the state of an agent run after every step, so a crashed run can be resumed.
+
+    The state file holds the completed step, the user input of the next one,
+    the goals, the number of chat history messages, the kanban and the hashes
+    of the workspace files. The vector memory is saved every memory_every
+    steps, or persisted in place for a DiskFAISS memory; on resume, the memories
+    of the later steps it lacks are added back from the step metadata in the
+    chat history, which has to be persistent, e.g. a JournalChatMessageHistory. The state file is replaced atomically, so a
+    crash while saving leaves the previous checkpoint.
+    """
+
+    def __init__(self, directory: str, workspace: str, memory_every: int = 10):
+        self.directory = os.path.abspath(directory)
+        self.workspace = os.path.abspath(workspace)
+        self.memory_every = memory_every
+        self.last: Optional[Checkpoint] = None
+        self._memory_step: Optional[int] = None
+        self.stats = {"saves": 0, "memory_saves": 0, "seconds": 0.0}
+        # (mtime, size, digest) of the workspace files, so only changed files are hashed again
+        self._hashes: Dict[str, Tuple[int, int, str]] = {}
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def state_path(self) -> str:
+        return os.path.join(self.directory, STATE_FILE)
+
+    def manifest(self) -> Dict[str, str]:
+        """Digests of the workspace files, by path relative to the workspace."""
+        manifest = {}
+        hashes = {}
+        for directory, dirs, files in os.walk(self.workspace):
+            dirs[:] = [d for d in dirs if d not in SKIP_DIRS and os.path.join(directory, d) != self.directory]
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                    cached = self._hashes.get(path)
+                    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+                        digest = cached[2]
+                    else:
+                        digest = file_digest(path)
+                except OSError:
+                    continue
+                hashes[path] = (stat.st_mtime_ns, stat.st_size, digest)
+                manifest[os.path.relpath(path, self.workspace)] = digest
+        self._hashes = hashes
+        return manifest
+
+    def memory_due(self, step: int) -> bool:
+        return self._memory_step is None or step - self._memory_step >= self.memory_every
+
+    def save(self, agent: Any, step: int, user_input: str, goals: List[str], kanban: dict) -> Checkpoint:
+        start = time.perf_counter()
+        history = agent.chat_history_memory
+        memory_dir = self.last.memory_dir if self.last else None
+        memory_step = self.last.memory_step if self.last else 0
+        memories = self.last.memories if self.last else 0
+        vectorstore = getattr(agent.memory, "vectorstore", None)
+        if self.memory_due(step):
+            self._memory_step = step
+            memories = len(getattr(vectorstore, "index_to_docstore_id", {}))
+            if hasattr(vectorstore, "persist"):
+                vectorstore.persist()
+                memory_dir, memory_step = None, step
+                self.stats["memory_saves"] += 1
+            elif hasattr(vectorstore, "save_local"):
+                memory_dir, memory_step = f"memory-{step:06d}", step
+                vectorstore.save_local(os.path.join(self.directory, memory_dir))
+                self.stats["memory_saves"] += 1
+
+        checkpoint = Checkpoint(
+            step=step,
+            user_input=user_input,
+            goals=goals,
+            # A journal holds every message, the list in memory may be compacted
+            messages=len(history) if isinstance(history, JournalChatMessageHistory) else len(history.messages),
+            kanban=kanban,
+            manifest=self.manifest(),
+            history_path=getattr(history, "path", None),
+            memory_dir=memory_dir,
+            memory_step=memory_step,
+            memories=memories,
+        )
+        if isinstance(history, JournalChatMessageHistory):
+            history.sync()
+        tmp = f"{self.state_path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(asdict(checkpoint), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.state_path)
+
+        # The previous memory is only removed once the new state points to the new one
+        for name in os.listdir(self.directory):
+            if name.startswith("memory-") and name != memory_dir:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+        self.last = checkpoint
+        self.stats["saves"] += 1
+        self.stats["seconds"] += time.perf_counter() - start
+        return checkpoint
+
+    def load(self) -> Optional[Checkpoint]:
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        if state.get("version") != CHECKPOINT_VERSION:
+            raise ValueError(f"Unsupported checkpoint version {state.get('version')} in {self.state_path}")
+        self.last = Checkpoint(**state)
+        self._memory_step = self.last.memory_step
+        return self.last
+
+    def restore_memory(self, checkpoint: Checkpoint, vectorstore: Any, messages: List[BaseMessage]) -> Any:
+        """Load the saved vector memory, then add the memories of the steps completed after it.
+
+        A persistent memory may already hold some of them, after the memories it held
+        at the checkpoint; those are not added twice.
+        """
+        if checkpoint.memory_dir:
+            vectorstore = type(vectorstore).load_local(os.path.join(self.directory, checkpoint.memory_dir), vectorstore.embeddings)
+        documents = []
+        for m in messages:
+            metadata = m.additional_kwargs.get("metadata") if m.type == "system" else None
+            if metadata and (step_from_metadata(metadata) or 0) > checkpoint.memory_step:
+                documents.append(Document(page_content=metadata))
+        if documents:
+            ids = vectorstore.index_to_docstore_id
+            stored = {vectorstore.docstore.search(ids[i]).page_content for i in range(checkpoint.memories, len(ids))}
+            documents = [document for document in documents if document.page_content not in stored]
+        if documents:
+            vectorstore.add_documents(documents)
+        return vectorstore
+
+    def changed_files(self, checkpoint: Checkpoint) -> List[str]:
+        """Workspace files added, removed or modified since the checkpoint."""
+        current = self.manifest()
+        paths = set(current) | set(checkpoint.manifest)
+        return sorted(path for path in paths if current.get(path) != checkpoint.manifest.get(path))
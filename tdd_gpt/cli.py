@@ -1,7 +1,14 @@
+import codecs
+import os
 import select
+import signal
 import subprocess
+import tempfile
+import threading
+import time
+import uuid
 import asyncio
-from typing import List, Optional, Type, Union
+from typing import Any, Dict, List, Optional, Tuple, Type, Union
 
 from pydantic import BaseModel, Field, root_validator
 
@@ -11,6 +18,9 @@ from langchain.callbacks.manager import (
 )
 from langchain.tools.base import BaseTool
 
+import tracing
+from output_parsers import split_cli_output
+
 import platform
 
 def _get_platform() -> str:
@@ -23,40 +33,293 @@ def _get_platform() -> str:
 class CommandTimeout(Exception):
     pass
 
-def run_command_with_timeout(cmd, timeout_sec):
+# Bytes read from the pipe at a time
+READ_CHUNK_BYTES = 64 * 1024
+
+# Output kept by default, about 50k tokens
+DEFAULT_MAX_OUTPUT_BYTES = 200 * 1024
+
+# Share of the kept output taken from the beginning, the rest is the end
+HEAD_FRACTION = 0.25
+
+# How far to move a cut to land on a line boundary
+MAX_LINE_ALIGN_BYTES = 1024
+
+# Seconds between checks of the cancel event of a running command
+CANCEL_POLL_SEC = 0.05
+
+
+class OutputBuffer:
+    """Keep the head and the tail of a stream of bytes, up to max_bytes in total.
+
+    The head is decoded incrementally as it arrives; the tail is trimmed in
+    amortized constant time and decoded once, starting at a character boundary.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_OUTPUT_BYTES):
+        self.head_bytes = int(max_bytes * HEAD_FRACTION)
+        self.tail_bytes = max_bytes - self.head_bytes
+        self.total_bytes = 0
+        self._head: List[str] = []
+        self._head_size = 0
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._tail = bytearray()
+
+    def write(self, data: bytes) -> None:
+        self.total_bytes += len(data)
+        if self._head_size < self.head_bytes:
+            taken = data[:self.head_bytes - self._head_size]
+            self._head.append(self._decoder.decode(taken))
+            self._head_size += len(taken)
+            data = data[len(taken):]
+        if data:
+            self._tail += data
+            if len(self._tail) > 2 * self.tail_bytes:
+                del self._tail[:len(self._tail) - self.tail_bytes]
+
+    @property
+    def elided_bytes(self) -> int:
+        return max(self.total_bytes - self._head_size - self.tail_bytes, 0)
+
+    def getvalue(self) -> str:
+        head = "".join(self._head)
+        if not self.elided_bytes:
+            return head + self._decoder.decode(bytes(self._tail), final=True)
+
+        tail = bytes(self._tail[-self.tail_bytes:])
+        # Land the cuts on line boundaries when one is close
+        newline = head.rfind("\n", len(head) - min(MAX_LINE_ALIGN_BYTES, len(head) // 2))
+        if newline != -1:
+            head = head[:newline + 1]
+        newline = tail.find(b"\n", 0, min(MAX_LINE_ALIGN_BYTES, len(tail) // 2))
+        if newline != -1:
+            tail = tail[newline + 1:]
+        else:
+            tail = tail.lstrip(bytes(range(0x80, 0xC0)))  # continuation bytes of a cut character
+        elided = self.total_bytes - len(head.encode("utf-8", errors="replace")) - len(tail)
+        marker = f"... ({elided} bytes of output elided) ...\n"
+        return head + ("" if head.endswith("\n") else "\n") + marker + tail.decode("utf-8", errors="replace")
+
+
+def _kill(proc: subprocess.Popen) -> None:
+    """Kill the shell and everything it started."""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        proc.kill()
+
+
+def run_command_with_timeout(cmd, timeout_sec, max_output_bytes=DEFAULT_MAX_OUTPUT_BYTES, cwd=None, cancel=None, env=None):
     """Run cmd in the shell and return the output. 
     If there's no activity on stdout for timeout_sec, return a timeout message.
+    Only the head and the tail of the output are kept, up to max_output_bytes.
+    When the cancel event is set, the command is killed and a cancellation message returned.
+    env replaces the environment of the shell, as ShellSession.environment() returns it.
     """
     # If cmd is a list, join the elements into a single string
     if isinstance(cmd, list):
         cmd = ' && '.join(cmd)
 
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
+    proc = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True, start_new_session=True, cwd=cwd, env=env
+    )
+    fd = proc.stdout.fileno()
+    os.set_blocking(fd, False)
+
+    output = OutputBuffer(max_output_bytes)
+    poll_sec = timeout_sec if cancel is None else min(timeout_sec, CANCEL_POLL_SEC)
+    deadline = time.monotonic() + timeout_sec
+    try:
+        while True:
+            if cancel is not None and cancel.is_set():
+                _kill(proc)
+                proc.wait()
+                return f"Command '{cmd}' was cancelled {output.getvalue()}"
 
-    output = ''
-    while True:
-        # Wait for output or a timeout
-        reads = [proc.stdout.fileno()]
-        ret = select.select(reads, [], [], timeout_sec)
+            # Wait for output or a timeout
+            ret = select.select([fd], [], [], poll_sec)
 
-        if proc.stdout.fileno() in ret[0]:
-            # There's output to read
-            line = proc.stdout.readline()
-            if line:
-                output += line.decode()
+            if fd in ret[0]:
+                # There's output to read, take whatever is available, partial lines included
+                try:
+                    chunk = os.read(fd, READ_CHUNK_BYTES)
+                except BlockingIOError:
+                    continue
+                if chunk:
+                    output.write(chunk)
+                    deadline = time.monotonic() + timeout_sec
+                else:
+                    # No more output, break the loop
+                    break
+            elif time.monotonic() < deadline:
+                continue
             else:
-                # No more output, break the loop
-                break
-        else:
-            # Timeout with no output, kill the process
-            proc.kill()
-            return f"Command '{cmd}' timed out after {timeout_sec} seconds of inactivity on stdout {output}"
+                # Timeout with no output, kill the process
+                _kill(proc)
+                proc.wait()
+                return f"Command '{cmd}' timed out after {timeout_sec} seconds of inactivity on stdout {output.getvalue()}"
+        exit_code = proc.wait()
+    finally:
+        if proc.poll() is None:
+            # Interrupted, e.g. by Ctrl-C which the new session of the command does not get
+            _kill(proc)
+            proc.wait()
+        proc.stdout.close()
+        tracing.annotate(output_bytes=output.total_bytes)
 
     # Check for errors
-    if proc.poll():
-        return f"Command '{cmd}' failed with error: {output}"
+    tracing.annotate(exit_code=exit_code)
+    if exit_code:
+        return f"Command '{cmd}' failed with error: {output.getvalue()}"
+
+    return f"Command '{cmd}' succeeded with the following output:\n{output.getvalue()}"
+
+class ShellSession:
+    """A long-lived bash session that runs the commands of every step.
+
+    The working directory, environment variables and activated virtualenvs carry
+    over between steps. Each command is passed through a quoted heredoc and eval,
+    so a syntax error cannot desynchronize the session, and is followed by a
+    sentinel line with its exit status and the working directory, which marks
+    the end of its output. The exported environment is saved after every command,
+    for environment() to return it. The inactivity timeout is the same as for a single
+    command; when it expires the session is killed, and a new one is started in
+    the last known working directory on the next run.
+    """
+
+    def __init__(self, cwd: Optional[str] = None, shell: str = "/bin/bash"):
+        self.cwd = os.path.abspath(cwd or os.getcwd())
+        self.shell = shell
+        self.sentinel = f"__tddgpt_{uuid.uuid4().hex}__"
+        self._marker = f"\n{self.sentinel}:".encode()
+        self._env_path = os.path.join(tempfile.gettempdir(), f"{self.sentinel}.env")
+        self._proc: Optional[subprocess.Popen] = None
+        self._lock = threading.Lock()
+
+    @property
+    def alive(self) -> bool:
+        return self._proc is not None and self._proc.poll() is None
+
+    def start(self) -> None:
+        self._remove_environment()
+        self._proc = subprocess.Popen(
+            [self.shell],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            cwd=self.cwd if os.path.isdir(self.cwd) else None,
+            start_new_session=True,
+        )
+        os.set_blocking(self._proc.stdout.fileno(), False)
+
+    def _script(self, cmd: str) -> bytes:
+        return (
+            f"IFS= read -r -d '' __tddgpt_cmd <<'{self.sentinel}'\n"
+            f"{cmd}\n"
+            f"{self.sentinel}\n"
+            f'eval "$__tddgpt_cmd" < /dev/null\n'
+            f"__tddgpt_status=$?\n"
+            # command -p and >| work after the commands changed PATH or set noclobber
+            f"command -p env -0 >| '{self._env_path}' 2> /dev/null\n"
+            f"printf '\\n%s:%s:%s\\n' '{self.sentinel}' \"$__tddgpt_status\" \"$PWD\"\n"
+        ).encode()
+
+    def run(self, cmd, timeout_sec, max_output_bytes=DEFAULT_MAX_OUTPUT_BYTES) -> str:
+        """Run cmd in the session and return the output, formatted like run_command_with_timeout."""
+        # If cmd is a list, join the elements into a single string
+        if isinstance(cmd, list):
+            cmd = ' && '.join(cmd)
+
+        with self._lock:
+            if not self.alive:
+                self.start()
+            proc = self._proc
+            try:
+                proc.stdin.write(self._script(cmd))
+                proc.stdin.flush()
+            except BrokenPipeError:
+                self._proc = None
+                return f"Command '{cmd}' failed with error: the shell session exited, a new one will be started in {self.cwd}"
+
+            fd = proc.stdout.fileno()
+            output = OutputBuffer(max_output_bytes)
+            pending = b""
+            while True:
+                # Wait for output or a timeout
+                ret = select.select([fd], [], [], timeout_sec)
+                if fd not in ret[0]:
+                    # Timeout with no output, kill the session
+                    self.close()
+                    output.write(pending)
+                    return (
+                        f"Command '{cmd}' timed out after {timeout_sec} seconds of inactivity on stdout {output.getvalue()}\n"
+                        f"The shell session was killed, a new one will be started in {self.cwd}."
+                    )
+                try:
+                    chunk = os.read(fd, READ_CHUNK_BYTES)
+                except BlockingIOError:
+                    continue
+                if not chunk:
+                    # The commands exited the shell
+                    output.write(pending)
+                    self.close()
+                    return (
+                        f"Command '{cmd}' failed with error: {output.getvalue()}\n"
+                        f"The shell session exited, a new one will be started in {self.cwd}."
+                    )
+
+                data = pending + chunk
+                start = data.find(self._marker)
+                if start == -1:
+                    # Hold back what could be the beginning of the sentinel
+                    keep = len(self._marker)
+                    output.write(data[:-keep])
+                    pending = data[-keep:]
+                    continue
+                end = data.find(b"\n", start + len(self._marker))
+                if end == -1:
+                    pending = data
+                    continue
+                output.write(data[:start])
+                status, _, cwd = data[start + len(self._marker):end].decode("utf-8", errors="replace").partition(":")
+                self.cwd = cwd or self.cwd
+                break
+
+        tracing.annotate(exit_code=int(status) if status.isdigit() else status, output_bytes=output.total_bytes)
+        # Check for errors
+        if status != "0":
+            return f"Command '{cmd}' failed with error: {output.getvalue()}"
+
+        return f"Command '{cmd}' succeeded with the following output:\n{output.getvalue()}"
+
+    def environment(self) -> Optional[Dict[str, str]]:
+        """Exported variables of the session after its last command, None before its first one."""
+        try:
+            with open(self._env_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        variables = (entry.decode("utf-8", errors="surrogateescape").partition("=") for entry in data.split(b"\0") if entry)
+        return {name: value for name, _, value in variables}
+
+    def _remove_environment(self) -> None:
+        try:
+            os.remove(self._env_path)
+        except FileNotFoundError:
+            pass
+
+    def close(self) -> None:
+        proc, self._proc = self._proc, None
+        # A new session starts from the environment of this process again
+        self._remove_environment()
+        if proc is None:
+            return
+        if proc.poll() is None:
+            _kill(proc)
+        proc.wait()
+        proc.stdin.close()
+        proc.stdout.close()
 
-    return f"Command '{cmd}' succeeded with the following output:\n{output}"
 
 class CLIInput(BaseModel):
     """Commands for the CLI tool."""
@@ -85,14 +348,42 @@ class CLITool(BaseTool):
     args_schema: Type[BaseModel] = CLIInput
     """Schema for input arguments."""
 
+    timeout: int = 60
+    """Seconds without output after which the commands are killed."""
+
+    max_output_bytes: int = DEFAULT_MAX_OUTPUT_BYTES
+    """Bytes of output kept, from its beginning and its end."""
+
+    session: Optional[ShellSession] = None
+    """Persistent shell session to run the commands in, instead of a new shell for every step."""
+
+    test_runner: Optional[Any] = None
+    """TestRunner for the test commands, which limits them to the tests related to the changed files."""
+
+    speculator: Optional[Any] = None
+    """TestSpeculator whose background test run is returned when the same test command is requested."""
+
     def _run(
         self,
         commands: Union[str, List[str]],
         run_manager: Optional[CallbackManagerForToolRun] = None,
     ) -> str:
         """Run commands and return final output."""
-        output = run_command_with_timeout(commands, 60)
-        return output
+        with tracing.span("cli.run", commands=commands) as span:
+            output, source = self._run_commands(commands)
+            span.set(status=split_cli_output(output)[0], source=source, result_bytes=len(output))
+            return output
+
+    def _run_commands(self, commands: Union[str, List[str]]) -> Tuple[str, str]:
+        if self.speculator is not None:
+            output = self.speculator.claim(commands)
+            if output is not None:
+                return output, "speculated"
+        if self.test_runner is not None and self.test_runner.handles(commands):
+            return self.test_runner.run(commands, self.timeout, self.max_output_bytes), "test_runner"
+        if self.session is not None:
+            return self.session.run(commands, self.timeout, self.max_output_bytes), "session"
+        return run_command_with_timeout(commands, self.timeout, self.max_output_bytes), "shell"
 
     async def _arun(
         self,
@@ -100,6 +391,8 @@ class CLITool(BaseTool):
         run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
     ) -> str:
         """Run commands asynchronously and return final output."""
-        return await asyncio.get_event_loop().run_in_executor(
-            None, run_command_with_timeout, commands, 60
-        )
+        # to_thread rather than run_in_executor, so the command is traced within the step
+        with tracing.span("cli.run", commands=commands) as span:
+            output, source = await asyncio.to_thread(self._run_commands, commands)
+            span.set(status=split_cli_output(output)[0], source=source, result_bytes=len(output))
+            return output
@@ -0,0 +1,136 @@
+"""Local stand-ins for the OpenAI models, used to exercise the agent without network access."""
+import asyncio
+import json
+import re
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Union
+
+from pydantic import Field
+
+from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import ChatResult
+from langchain.schema.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain.schema.output import ChatGeneration, ChatGenerationChunk
+
+from function_calling import format_functions
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def approximate_token_count(text: str) -> int:
+    """Count words and punctuation, a close enough stand-in for tiktoken offline."""
+    return len(TOKEN_PATTERN.findall(text))
+
+
+class ScriptedChatModel(BaseChatModel):
+    """Chat model that replays a script of responses, in order.
+
+    A response is either the text of the reply or a dict with the name and the
+    arguments of a function call. Responses are streamed in chunks of chunk_size
+    characters. latency is slept before every response and token_latency after
+    every streamed chunk, without blocking the event loop in the async methods.
+    With repeat the script starts over once exhausted. The approximate prompt
+    and completion tokens of every call are recorded in usage, the functions
+    counted as the API renders them in the prompt.
+    """
+
+    responses: List[Union[str, Dict[str, Any]]]
+    chunk_size: int = 8
+    latency: float = 0.0
+    token_latency: float = 0.0
+    repeat: bool = False
+    i: int = 0
+    usage: List[Dict[str, int]] = Field(default_factory=list)
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted-chat-model"
+
+    def get_num_tokens(self, text: str) -> int:
+        return approximate_token_count(text)
+
+    def _next_message(self, messages: List[BaseMessage], **kwargs: Any) -> AIMessage:
+        if self.i >= len(self.responses) and self.repeat:
+            self.i = 0
+        if self.i >= len(self.responses):
+            raise IndexError(f"ScriptedChatModel ran out of responses after {self.i} calls")
+        response = self.responses[self.i]
+        self.i += 1
+
+        if isinstance(response, dict):
+            function_call = {"name": response["name"], "arguments": json.dumps(response["arguments"])}
+            message = AIMessage(content="", additional_kwargs={"function_call": function_call})
+            completion = function_call["name"] + function_call["arguments"]
+        else:
+            message = AIMessage(content=response)
+            completion = response
+
+        prompt = "".join(m.content for m in messages)
+        if kwargs.get("functions"):
+            prompt += format_functions(kwargs["functions"])
+        self.usage.append({
+            "prompt_tokens": approximate_token_count(prompt),
+            "completion_tokens": approximate_token_count(completion),
+        })
+        return message
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if self.latency:
+            time.sleep(self.latency)
+        message = self._next_message(messages, **kwargs)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        if self.latency:
+            time.sleep(self.latency)
+        response = self._next_message(messages, **kwargs).content
+        for start in range(0, len(response), self.chunk_size):
+            if self.token_latency:
+                time.sleep(self.token_latency)
+            chunk = response[start:start + self.chunk_size]
+            yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk)
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        message = self._next_message(messages, **kwargs)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        response = self._next_message(messages, **kwargs).content
+        for start in range(0, len(response), self.chunk_size):
+            if self.token_latency:
+                await asyncio.sleep(self.token_latency)
+            chunk = response[start:start + self.chunk_size]
+            yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk)
@@ -0,0 +1,81 @@
+import json
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from langchain.schema import BaseMessage, SystemMessage
+
+
+@dataclass
+class FileEntry:
+    file_path: str
+    code: str
+    tokens: int
+    step: int
+
+
+def parse_metadata(metadata: str) -> dict:
+    """Parse the json block stored in a step's metadata, or return an empty dict."""
+    start_index = metadata.find('{')
+    end_index = metadata.rfind('}')
+    if start_index == -1 or end_index <= start_index:
+        return {}
+    try:
+        parsed = json.loads(metadata[start_index:end_index + 1], strict=False)
+    except json.JSONDecodeError:
+        return {}
+    return parsed if isinstance(parsed, dict) else {}
+
+
+def step_from_metadata(metadata: str) -> Optional[int]:
+    """Extract the step number from the json block stored in a step's metadata."""
+    step = parse_metadata(metadata).get("step")
+    return step if isinstance(step, int) else None
+
+
+class FileIndex:
+    """Latest content of every file the agent has read or written.
+
+    Maintained incrementally by the agent as read_file/write_file steps complete,
+    so the prompt does not have to rescan the whole chat history on every step.
+    """
+
+    def __init__(self, token_counter: Callable[[str], int]):
+        self.token_counter = token_counter
+        self._entries: "OrderedDict[str, FileEntry]" = OrderedDict()
+
+    def update(self, file_path: str, code: str, step: int) -> None:
+        if len(code.strip()) == 0:
+            return
+        self._entries[file_path] = FileEntry(file_path, code, self.token_counter(code), step)
+        self._entries.move_to_end(file_path)
+
+    def rebuild(self, messages: List[BaseMessage]) -> None:
+        """Rebuild the index from the system messages of a chat history."""
+        self._entries.clear()
+        step = 0
+        for m in messages:
+            if not isinstance(m, SystemMessage):
+                continue
+            step = step_from_metadata(m.additional_kwargs.get("metadata") or "") or step + 1
+            if "code" in m.additional_kwargs and "file_path" in m.additional_kwargs:
+                self.update(m.additional_kwargs["file_path"], m.additional_kwargs["code"], step)
+
+    @classmethod
+    def from_messages(cls, messages: List[BaseMessage], token_counter: Callable[[str], int]) -> "FileIndex":
+        file_index = cls(token_counter)
+        file_index.rebuild(messages)
+        return file_index
+
+    def entries(self) -> List[FileEntry]:
+        """Return the entries, most recently touched first."""
+        return list(reversed(self._entries.values()))
+
+    def get(self, file_path: str) -> Optional[FileEntry]:
+        return self._entries.get(file_path)
+
+    def __contains__(self, file_path: str) -> bool:
+        return file_path in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
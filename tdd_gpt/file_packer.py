@@ -0,0 +1,177 @@
+import os
+import re
+from functools import lru_cache
+from typing import Callable, List, Optional, Tuple
+
+from file_index import FileEntry
+
+SKELETON_PATTERN = re.compile(
+    r"^\s*("
+    r"import\s|from\s+\S+\s+import\s|export\s|module\.exports|exports\.\w+\s*=|"
+    r"(async\s+)?def\s|class\s|@\w|(async\s+)?function[\s*]|"
+    r"(const|let|var)\s+\w+\s*=\s*(async\s*)?(\(|function|\w+\s*=>|require\()|"
+    r"(describe|it|test)\("
+    r")"
+)
+
+# Number of buckets the token budget is divided into for the knapsack
+BUDGET_BUCKETS = 512
+
+# Value of a skeleton relative to the full file
+SKELETON_VALUE = 0.4
+
+# Below this ratio of the highest to the lowest score, the files are packed greedily
+SIMILAR_VALUES = 1.1
+
+# Only the densest files whose smallest choices add up to this many budgets go to the knapsack
+CANDIDATE_BUDGETS = 2
+
+
+@lru_cache(maxsize=1024)
+def skeleton(code: str) -> str:
+    """Reduce a rendered code block to its imports, exports and signatures, cached as files are packed every step."""
+    lines = code.strip().split("\n")
+    if len(lines) >= 3 and lines[0].startswith("```") and lines[1].startswith("// ") and lines[-1] == "```":
+        header, body = lines[:2], lines[2:-1]
+    else:
+        header, body = [], lines
+    kept = [line.rstrip() for line in body if SKELETON_PATTERN.match(line)]
+    note = "// (skeleton: bodies omitted, read the file to see the full content)"
+    if not header:
+        return "\n".join([note] + kept)
+    return "\n" + "\n".join(header + [note] + kept + ["```"])
+
+
+def is_referenced(file_path: str, text: str) -> bool:
+    return bool(text) and (file_path in text or os.path.basename(file_path) in text)
+
+
+def score_file(entry: FileEntry, current_step: int, in_progress: str, failing_output: str) -> float:
+    """Score a file by recency and by whether the current task or failing tests refer to it."""
+    score = 1.0 + 1.0 / (1 + max(0, current_step - entry.step))
+    if is_referenced(entry.file_path, in_progress):
+        score += 2.0
+    if is_referenced(entry.file_path, failing_output):
+        score += 1.5
+    return score
+
+
+def pack_files(
+    entries: List[FileEntry],
+    budget: int,
+    token_counter: Callable[[str], int],
+    in_progress: str = "",
+    failing_output: str = "",
+    skeleton_min_tokens: Optional[int] = 400,
+) -> List[Tuple[FileEntry, str, int]]:
+    """Choose the files (or file skeletons) that maximize the total score within the token budget.
+
+    Each file is either sent in full, degraded to a skeleton (only files of at least
+    skeleton_min_tokens tokens, None disables skeletons) or dropped. The choice is a
+    multiple-choice knapsack solved over a bucketed budget, which never overshoots it.
+    When all the scores are within SIMILAR_VALUES of each other the files are packed
+    greedily instead, and otherwise only the densest candidates go to the knapsack.
+    Returns (entry, code, tokens) tuples in the order of the given entries.
+    """
+    if budget <= 0 or not entries:
+        return []
+    if sum(entry.tokens for entry in entries) <= budget:
+        return [(entry, entry.code, entry.tokens) for entry in entries]
+
+    current_step = max(entry.step for entry in entries)
+    options = []
+    for entry in entries:
+        value = score_file(entry, current_step, in_progress, failing_output)
+        choices = [(value, entry.code, entry.tokens)]
+        if skeleton_min_tokens is not None and entry.tokens >= skeleton_min_tokens:
+            skeleton_code = skeleton(entry.code)
+            skeleton_tokens = token_counter(skeleton_code)
+            if skeleton_tokens < entry.tokens:
+                choices.append((value * SKELETON_VALUE, skeleton_code, skeleton_tokens))
+        options.append(choices)
+
+    values = [choices[0][0] for choices in options]
+    if max(values) <= SIMILAR_VALUES * min(values):
+        selected = _pack_greedy(options, budget)
+    else:
+        candidates = _candidates(options, budget)
+        selected = [None] * len(entries)
+        for n, choice in zip(candidates, _pack_knapsack([options[n] for n in candidates], budget)):
+            selected[n] = choice
+
+    return [
+        (entry, choice[1], choice[2])
+        for entry, choice in zip(entries, selected)
+        if choice is not None
+    ]
+
+
+def _density(choices: List[Tuple[float, str, int]]) -> float:
+    return max(value / max(1, tokens) for value, _, tokens in choices)
+
+
+def _pack_greedy(options: List[List[Tuple[float, str, int]]], budget: int) -> List[Optional[Tuple[float, str, int]]]:
+    """Take the files by decreasing score per token, each in full if it fits, else as a skeleton."""
+    selected: List[Optional[Tuple[float, str, int]]] = [None] * len(options)
+    for n in sorted(range(len(options)), key=lambda n: -_density(options[n])):
+        for choice in options[n]:
+            if choice[2] <= budget:
+                selected[n] = choice
+                budget -= choice[2]
+                break
+    return selected
+
+
+def _candidates(options: List[List[Tuple[float, str, int]]], budget: int) -> List[int]:
+    """Indexes of the files worth a place in the knapsack, in their given order.
+
+    The files are taken by decreasing score per token until their smallest choices add
+    up to CANDIDATE_BUDGETS budgets. A file that does not fit on its own is never one.
+    """
+    kept = []
+    tokens = 0
+    for n in sorted(range(len(options)), key=lambda n: -_density(options[n])):
+        smallest = min(choice[2] for choice in options[n])
+        if smallest > budget:
+            continue
+        if tokens >= CANDIDATE_BUDGETS * budget:
+            break
+        kept.append(n)
+        tokens += smallest
+    return sorted(kept)
+
+
+def _pack_knapsack(options: List[List[Tuple[float, str, int]]], budget: int) -> List[Optional[Tuple[float, str, int]]]:
+    """Solve the multiple-choice knapsack over a bucketed budget."""
+    bucket = max(1, -(-budget // BUDGET_BUCKETS))
+    capacity = budget // bucket
+    best = [0.0] * (capacity + 1)
+    picks = []
+    for choices in options:
+        weights = [-(-tokens // bucket) for _, _, tokens in choices]
+        new_best = best[:]
+        pick = [-1] * (capacity + 1)
+        for i, (value, _, _) in enumerate(choices):
+            w = weights[i]
+            if w > capacity:
+                continue
+            # Taking choice i at capacity c adds its value to the best of c - w, one pass over the list
+            merged = [
+                (taken, i) if taken > kept else (kept, previous)
+                for taken, kept, previous in zip([b + value for b in best], new_best[w:], pick[w:])
+            ]
+            new_best[w:] = [b for b, _ in merged]
+            pick[w:] = [p for _, p in merged]
+        picks.append((pick, weights))
+        best = new_best
+
+    # Walk back through the choices to recover the selection
+    selected: List[Optional[Tuple[float, str, int]]] = [None] * len(options)
+    c = capacity
+    for n in range(len(options) - 1, -1, -1):
+        pick, weights = picks[n]
+        i = pick[c]
+        if i >= 0:
+            selected[n] = options[n][i]
+            c -= weights[i]
+    return selected
@@ -0,0 +1,121 @@
+import json
+from typing import Any, Dict, List
+
+from langchain.schema.messages import AIMessage
+from langchain.tools.base import BaseTool
+from langchain.tools.convert_to_openai import format_tool_to_openai_function
+from langchain_experimental.autonomous_agents.autogpt.prompt_generator import FINISH_NAME
+
+from reply_parser import JSONRepairer
+
+# Compact version of the thoughts in the json response format
+THOUGHTS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "role": {"type": "string"},
+        "phase": {"type": "string"},
+        "tests_status": {"type": "string", "enum": ["failing", "passing"]},
+        "text": {"type": "string", "description": "thoughts, reasoning and self-criticism"},
+        "kanban": {
+            "type": "object",
+            "properties": {
+                "todo": {"type": "array", "items": {"type": "string"}},
+                "in_progress": {"type": "string", "description": "action for this step"},
+                "done": {"type": "array", "items": {"type": "string"}},
+            },
+        },
+    },
+    "required": ["role", "phase", "tests_status", "text", "kanban"],
+}
+
+FINISH_FUNCTION = {
+    "name": FINISH_NAME,
+    "description": "Formally conclude the project once all tasks are completed and verified",
+    "parameters": {
+        "type": "object",
+        "properties": {"response": {"type": "string", "description": "final summary of the project"}},
+        "required": ["response"],
+    },
+}
+
+
+def with_thoughts(function: Dict[str, Any]) -> Dict[str, Any]:
+    """Add the thoughts argument to a function description."""
+    parameters = dict(function["parameters"])
+    parameters["properties"] = {"thoughts": THOUGHTS_SCHEMA, **parameters.get("properties", {})}
+    parameters["required"] = ["thoughts"] + list(parameters.get("required", []))
+    return {**function, "parameters": parameters}
+
+
+def build_functions(tools: List[BaseTool]) -> List[Dict[str, Any]]:
+    """Describe the tools and the finish command as OpenAI functions."""
+    functions = [format_tool_to_openai_function(tool) for tool in tools]
+    return [with_thoughts(dict(function)) for function in functions + [FINISH_FUNCTION]]
+
+
+def _format_type(schema: Dict[str, Any], indent: str) -> str:
+    if "enum" in schema:
+        return " | ".join(json.dumps(value) for value in schema["enum"])
+    kind = schema.get("type")
+    if kind == "array":
+        return f"{_format_type(schema.get('items', {}), indent)}[]"
+    if kind == "object" and schema.get("properties"):
+        inner = indent + "  "
+        return "{\n" + _format_properties(schema, inner) + f"\n{indent}}}"
+    return {"integer": "number", "object": "object"}.get(kind, kind or "any")
+
+
+def _format_properties(schema: Dict[str, Any], indent: str) -> str:
+    required = set(schema.get("required", []))
+    lines = []
+    for name, prop in schema.get("properties", {}).items():
+        if prop.get("description"):
+            lines.append(f"{indent}// {prop['description']}")
+        optional = "" if name in required else "?"
+        lines.append(f"{indent}{name}{optional}: {_format_type(prop, indent)},")
+    return "\n".join(lines)
+
+
+def format_functions(functions: List[Dict[str, Any]]) -> str:
+    """Render the functions the way the API adds them to the system message, where they are billed as prompt tokens."""
+    lines = ["# Tools", "", "## functions", "", "namespace functions {", ""]
+    for function in functions:
+        if function.get("description"):
+            lines.append(f"// {function['description']}")
+        parameters = function.get("parameters", {})
+        if parameters.get("properties"):
+            lines.append(f"type {function['name']} = (_: {{")
+            lines.append(_format_properties(parameters, ""))
+            lines.append("}) => any;")
+        else:
+            lines.append(f"type {function['name']} = () => any;")
+        lines.append("")
+    lines.append("} // namespace functions")
+    return "\n".join(lines)
+
+
+def loads_arguments(arguments: str) -> Dict[str, Any]:
+    try:
+        return json.loads(arguments, strict=False)
+    except json.JSONDecodeError:
+        repairer = JSONRepairer()
+        repairer.feed(arguments)
+        repairer.finish()
+        return repairer.values
+
+
+def function_call_to_reply(message: AIMessage) -> str:
+    """Convert a function call into a reply in the json response format.
+
+    Replies without a function call are returned as they are, so they can still be
+    parsed as json.
+    """
+    function_call = message.additional_kwargs.get("function_call")
+    if not function_call:
+        return message.content
+    args = loads_arguments(function_call.get("arguments") or "{}")
+    thoughts = args.pop("thoughts", {}) if isinstance(args, dict) else {}
+    if isinstance(thoughts, dict):
+        thoughts.setdefault("reasoning", "")
+        thoughts.setdefault("criticism", "")
+    return json.dumps({"thoughts": thoughts, "command": {"name": function_call.get("name"), "args": args}})
@@ -0,0 +1,411 @@
+import json
+import os
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional
+
+from langchain.schema import BaseChatMessageHistory
+from langchain.schema.messages import BaseMessage, SystemMessage, messages_from_dict, messages_to_dict
+
+from file_index import parse_metadata
+
+
+class CachedChatMessageHistory(BaseChatMessageHistory):
+    """Keeps the messages of a chat history in memory, and writes the new ones to it on flush().
+
+    Reading the messages never touches the underlying history, so a slow one,
+    such as a file rewritten on every message, can be written in the background
+    while the agent goes on.
+    """
+
+    def __init__(self, history: BaseChatMessageHistory):
+        self.history = history
+        self._messages: List[BaseMessage] = list(history.messages)
+        self._pending: List[BaseMessage] = []
+        self._lock = threading.Lock()
+
+    @property
+    def messages(self) -> List[BaseMessage]:  # type: ignore
+        return self._messages
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def add_message(self, message: BaseMessage) -> None:
+        with self._lock:
+            self._messages.append(message)
+            self._pending.append(message)
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for message in pending:
+            self.history.add_message(message)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._messages = []
+            self._pending = []
+        self.history.clear()
+
+
+class JournalChatMessageHistory(BaseChatMessageHistory):
+    """Chat history in an append-only JSONL journal, one message per line.
+
+    add_message() appends the line and flushes it to the OS; the journal is
+    fsynced every sync_every messages or sync_interval seconds, and on close().
+    A sidecar index file holds the byte offset of every line, so opening a
+    journal only re-reads its last indexed line and what follows: a line torn
+    by a crash is cut off, and lines the index missed are indexed again. The
+    messages are decoded on first access. A JSON file written by
+    FileChatMessageHistory at path is converted on open.
+    """
+
+    def __init__(self, path: str, sync_every: int = 32, sync_interval: float = 1.0):
+        self.path = path
+        self.index_path = f"{path}.idx"
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.recovered_bytes = 0
+        self._offsets = array("Q")
+        self._messages: Optional[List[BaseMessage]] = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._lock = threading.Lock()
+        if os.path.exists(path) and self._is_legacy_file():
+            with open(path, encoding="utf-8") as f:
+                self._rewrite(messages_from_dict(json.load(f)))
+        self._recover()
+        self._open()
+
+    def _open(self) -> None:
+        self._file = open(self.path, "ab")
+        self._size = self._file.tell()
+        self._index = open(self.index_path, "ab")
+
+    def _is_legacy_file(self) -> bool:
+        with open(self.path, "rb") as f:
+            return f.read(64).lstrip()[:1] == b"["
+
+    @staticmethod
+    def _encode(item: dict) -> bytes:
+        return (json.dumps(item, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+    @staticmethod
+    def _is_message_line(line: bytes) -> bool:
+        if not line.endswith(b"\n"):
+            return False
+        try:
+            item = json.loads(line)
+        except ValueError:
+            return False
+        return isinstance(item, dict) and "type" in item
+
+    def _recover(self) -> None:
+        """Check the tail of the journal against the index, cutting off a torn last line."""
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        offsets = array("Q")
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "rb") as f:
+                data = f.read()
+            offsets.frombytes(data[:len(data) - len(data) % offsets.itemsize])
+        indexed = len(offsets)
+        rebuilt = False
+
+        # Keep the offsets that can be line starts, the last one is read again
+        valid = 0
+        while valid < len(offsets) and offsets[valid] < size and (valid == 0 or offsets[valid] > offsets[valid - 1]):
+            valid += 1
+        del offsets[valid:]
+        start = offsets.pop() if offsets else 0
+
+        with open(self.path, "ab+") as f:
+            if start:
+                f.seek(start - 1)
+                if f.read(1) != b"\n":
+                    # The index does not match the journal, index it all again
+                    del offsets[:]
+                    start = 0
+                    rebuilt = True
+            f.seek(start)
+            position = start
+            for line in f:
+                if not self._is_message_line(line):
+                    break
+                offsets.append(position)
+                position += len(line)
+            if position < size:
+                self.recovered_bytes = size - position
+                f.truncate(position)
+        if rebuilt or len(offsets) != indexed:
+            self._write_index(offsets)
+        self._offsets = offsets
+
+    def _write_index(self, offsets: array) -> None:
+        tmp = f"{self.index_path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(offsets.tobytes())
+        os.replace(tmp, self.index_path)
+
+    def _rewrite(self, messages: List[BaseMessage]) -> None:
+        """Replace the journal and its index with messages."""
+        if os.path.exists(self.index_path):
+            # Without an index, a crash before the new one is written means a full scan, not a wrong index
+            os.remove(self.index_path)
+        tmp = f"{self.path}.tmp"
+        offsets = array("Q")
+        position = 0
+        with open(tmp, "wb") as f:
+            for item in messages_to_dict(messages):
+                line = self._encode(item)
+                offsets.append(position)
+                f.write(line)
+                position += len(line)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self._write_index(offsets)
+        self._offsets = offsets
+
+    @property
+    def messages(self) -> List[BaseMessage]:  # type: ignore
+        with self._lock:
+            if self._messages is None:
+                self._file.flush()
+                with open(self.path, "rb") as f:
+                    self._messages = messages_from_dict([json.loads(line) for line in f])
+            return self._messages
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def tail(self, n: int) -> List[BaseMessage]:
+        """The last n messages, read through the index without decoding the others."""
+        with self._lock:
+            if self._messages is not None:
+                return self._messages[-n:] if n else []
+            if not n or not self._offsets:
+                return []
+            self._file.flush()
+            with open(self.path, "rb") as f:
+                f.seek(self._offsets[max(len(self._offsets) - n, 0)])
+                return messages_from_dict([json.loads(line) for line in f])
+
+    def add_message(self, message: BaseMessage) -> None:
+        line = self._encode(messages_to_dict([message])[0])
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self._offsets.append(self._size)
+            self._index.write(self._offsets[-1:].tobytes())
+            self._size += len(line)
+            if self._messages is not None:
+                self._messages.append(message)
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every or time.monotonic() - self._last_sync >= self.sync_interval:
+                self._sync()
+
+    def _sync(self) -> None:
+        self._index.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def sync(self) -> None:
+        with self._lock:
+            self._sync()
+
+    def compact(self) -> int:
+        """Rewrite the journal without the code of files read or written again later.
+
+        Returns the bytes saved. The chat history keeps every step, and the file
+        index rebuilt from it is the same.
+        """
+        messages = self.messages
+        latest = {}
+        for i, m in enumerate(messages):
+            if isinstance(m, SystemMessage) and m.additional_kwargs.get("code"):
+                latest[m.additional_kwargs.get("file_path")] = i
+        compacted = []
+        for i, m in enumerate(messages):
+            if isinstance(m, SystemMessage) and m.additional_kwargs.get("code") and latest[m.additional_kwargs.get("file_path")] != i:
+                m = SystemMessage(
+                    content=m.content,
+                    additional_kwargs={key: value for key, value in m.additional_kwargs.items() if key != "code"},
+                )
+            compacted.append(m)
+
+        with self._lock:
+            size = self._size
+            self._file.close()
+            self._index.close()
+            self._rewrite(compacted)
+            self._open()
+            self._messages = compacted
+            return size - self._size
+
+    def truncate(self, count: int) -> None:
+        """Drop the messages after the first count, e.g. those of a step that did not complete."""
+        with self._lock:
+            if count >= len(self._offsets):
+                return
+            self._size = self._offsets[count]
+            self._file.truncate(self._size)
+            del self._offsets[count:]
+            self._index.close()
+            self._write_index(self._offsets)
+            self._index = open(self.index_path, "ab")
+            self._messages = None
+            self._sync()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._file.truncate(0)
+            self._index.truncate(0)
+            self._size = 0
+            self._offsets = array("Q")
+            self._messages = []
+            self._sync()
+
+    def close(self) -> None:
+        with self._lock:
+            self._sync()
+            os.fsync(self._index.fileno())
+            self._file.close()
+            self._index.close()
+
+
+def _message_size(message: BaseMessage) -> int:
+    return len(message.content) + sum(len(value) for value in message.additional_kwargs.values() if isinstance(value, str))
+
+
+def _result_status(content: str) -> str:
+    head = content[:400].lower()
+    for status in ("timed out", "failed", "error", "succeeded", "passed", "written"):
+        if status in head:
+            return status
+    return "done"
+
+
+class HistoryCompactor:
+    """Bounds the messages a chat history keeps in memory.
+
+    The most recent steps are kept verbatim, up to max_messages messages and
+    max_bytes of content. Each older step is collapsed into one system message
+    with its step number, action, file path and result status. The code of a
+    file is only kept in the latest message that has it, so the file index
+    rebuilt from the compacted messages is the same. compact() works in place
+    on the list returned by the messages of ChatMessageHistory,
+    CachedChatMessageHistory and JournalChatMessageHistory; a journal still
+    holds every message on disk.
+    """
+
+    def __init__(self, max_messages: Optional[int] = None, max_bytes: Optional[int] = None):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.stats = {"runs": 0, "steps_collapsed": 0}
+        # The list compacted last, how many of its first messages are collapsed steps,
+        # and which of those keep the code of a file
+        self._list_id: Optional[int] = None
+        self._done = 0
+        self._code_records: Dict[str, int] = {}
+        # Sizes of the messages kept verbatim, by id
+        self._sizes: Dict[int, int] = {}
+
+    def _size(self, message: BaseMessage) -> int:
+        size = self._sizes.get(id(message))
+        if size is None:
+            size = self._sizes[id(message)] = _message_size(message)
+        return size
+
+    def _window_start(self, messages: List[BaseMessage], done: int) -> int:
+        """Index of the first message kept verbatim, always keeping the last step."""
+        count = size = 0
+        start = end = len(messages)
+        while end > done:
+            begin = end - 1
+            while begin > done and not messages[begin - 1].type == "system":
+                begin -= 1
+            count += end - begin
+            size += sum(self._size(m) for m in messages[begin:end])
+            over = (self.max_messages is not None and count > self.max_messages) or (
+                self.max_bytes is not None and size > self.max_bytes
+            )
+            if over and start < len(messages):
+                break
+            start = end = begin
+        return start
+
+    def _collapse(self, step: List[BaseMessage], keep_code: bool) -> SystemMessage:
+        system = step[-1]
+        metadata = parse_metadata(system.additional_kwargs.get("metadata") or "")
+        record = {"step": metadata.get("step"), "Action": metadata.get("Action", "none"), "Result": _result_status(system.content)}
+        additional_kwargs = {"metadata": f"```json\n{json.dumps(record)}\n```", "compacted": True}
+        file_path = system.additional_kwargs.get("file_path")
+        if file_path:
+            additional_kwargs["file_path"] = file_path
+            if keep_code and system.additional_kwargs.get("code"):
+                additional_kwargs["code"] = system.additional_kwargs["code"]
+        if "summary_tier" in system.additional_kwargs:
+            additional_kwargs["summary_tier"] = system.additional_kwargs["summary_tier"]
+        return SystemMessage(
+            content=f"Step {record['step']}: {record['Action']} ({record['Result']})",
+            additional_kwargs=additional_kwargs,
+        )
+
+    def _collapsed_prefix(self, messages: List[BaseMessage]) -> int:
+        """Length of the collapsed steps at the start of messages, remembering those with code."""
+        if self._list_id == id(messages) and self._done <= len(messages):
+            return self._done
+        self._code_records = {}
+        self._sizes = {}
+        done = 0
+        while done < len(messages) and messages[done].additional_kwargs.get("compacted"):
+            if messages[done].additional_kwargs.get("code"):
+                self._code_records[messages[done].additional_kwargs["file_path"]] = done
+            done += 1
+        return done
+
+    def compact(self, messages: List[BaseMessage]) -> None:
+        if self.max_messages is None and self.max_bytes is None:
+            return
+        self.stats["runs"] += 1
+        done = self._collapsed_prefix(messages)
+        start = self._window_start(messages, done)
+
+        # Latest message with the code of each file, among those not collapsed yet
+        latest: Dict[str, int] = {}
+        for i in range(done, len(messages)):
+            m = messages[i]
+            if m.type == "system" and m.additional_kwargs.get("code"):
+                latest[m.additional_kwargs.get("file_path")] = i
+        for file_path in latest:
+            k = self._code_records.pop(file_path, None)
+            if k is not None:
+                # A later message has a newer version of the file
+                m = messages[k]
+                messages[k] = SystemMessage(
+                    content=m.content,
+                    additional_kwargs={key: value for key, value in m.additional_kwargs.items() if key != "code"},
+                )
+
+        collapsed: List[BaseMessage] = []
+        step: List[BaseMessage] = []
+        for i in range(done, start):
+            step.append(messages[i])
+            self._sizes.pop(id(messages[i]), None)
+            if messages[i].type != "system":
+                continue
+            file_path = messages[i].additional_kwargs.get("file_path")
+            record = self._collapse(step, keep_code=bool(file_path) and latest.get(file_path) == i)
+            if "code" in record.additional_kwargs:
+                self._code_records[file_path] = done + len(collapsed)
+            collapsed.append(record)
+            step = []
+        if collapsed:
+            messages[done:start] = collapsed
+            self.stats["steps_collapsed"] += len(collapsed)
+        self._list_id = id(messages)
+        self._done = done + len(collapsed)
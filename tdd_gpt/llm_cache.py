@@ -0,0 +1,245 @@
+import json
+import os
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import ChatResult
+from langchain.schema.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain.schema.output import ChatGeneration, ChatGenerationChunk
+
+from summary_cache import digest, normalize_output
+
+MODES = ("record", "replay", "read-through")
+
+
+class CacheMissError(LookupError):
+    """A replayed call has no recorded response."""
+
+
+class LLMCache:
+    """Responses of the chat models recorded in an append-only JSONL transcript.
+
+    Calls are keyed by the model, the temperature and the hash of the messages, with
+    the functions and stop words. With normalize, the messages are normalized like the
+    summary cache normalizes command outputs, so that a replay matches calls whose
+    command outputs differ only in timings, temporary paths and ids; prompts that differ
+    only there then share their responses. In record mode every call goes to the model
+    and is appended; in replay mode every call must have been recorded, a miss raises
+    CacheMissError; in read-through mode misses go to the model and are appended. A call
+    recorded several times replays its responses in order. Once they are used up the
+    call is a miss, as the run no longer follows the recorded one. A line torn by a
+    crash is cut off on open.
+    """
+
+    def __init__(self, path: str, mode: str = "read-through", normalize: bool = False):
+        if mode not in MODES:
+            raise ValueError(f"Unknown LLM cache mode {mode}, expected one of {', '.join(MODES)}")
+        self.path = path
+        self.mode = mode
+        self.normalize = normalize
+        self.stats = {"hits": 0, "misses": 0, "recorded": 0, "replayed_seconds": 0.0}
+        self._responses: Dict[str, List[dict]] = {}
+        self._cursors: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._recover()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def _recover(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            with open(self.path, "ab") as f:
+                f.truncate(end)
+        for line in data[:end].splitlines():
+            item = json.loads(line)
+            self._responses.setdefault(item["key"], []).append(item)
+
+    def __len__(self) -> int:
+        return sum(len(responses) for responses in self._responses.values())
+
+    def key(self, model: str, temperature: Optional[float], messages: List[BaseMessage], **params: Any) -> str:
+        contents = [
+            [message.type, normalize_output(message.content) if self.normalize else message.content, message.additional_kwargs.get("function_call")]
+            for message in messages
+        ]
+        call = {"model": model, "temperature": temperature, "messages": contents, **params}
+        return digest(json.dumps(call, sort_keys=True, default=str))
+
+    def get(self, key: str) -> Optional[AIMessage]:
+        """Return the next recorded response of the call, or None when the model must be called."""
+        if self.mode == "record":
+            return None
+        with self._lock:
+            responses = self._responses.get(key, [])
+            cursor = self._cursors.get(key, 0)
+            if cursor >= len(responses):
+                self.stats["misses"] += 1
+                if self.mode == "replay":
+                    raise CacheMissError(f"No recorded response left for the call {key} in {self.path}, {len(responses)} recorded")
+                return None
+            self._cursors[key] = cursor + 1
+            item = responses[cursor]
+            self.stats["hits"] += 1
+            self.stats["replayed_seconds"] += item.get("elapsed", 0.0)
+        return AIMessage(content=item["content"], additional_kwargs=item["additional_kwargs"])
+
+    def put(self, key: str, model: str, message: BaseMessage, elapsed: float) -> None:
+        item = {
+            "key": key,
+            "model": model,
+            "content": message.content,
+            "additional_kwargs": message.additional_kwargs,
+            "elapsed": round(elapsed, 3),
+            "created": time.time(),
+        }
+        with self._lock:
+            self._file.write(json.dumps(item) + "\n")
+            self._file.flush()
+            responses = self._responses.setdefault(key, [])
+            responses.append(item)
+            # A new recording is replayed after the ones already consumed in this run
+            self._cursors[key] = len(responses)
+            self.stats["recorded"] += 1
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+
+class RecordReplayChatModel(BaseChatModel):
+    """Chat model answering from an LLMCache, and calling the wrapped model on the calls to record.
+
+    Replayed responses are streamed in one chunk. A recorded stream is stored as it
+    was consumed, so a stream the agent stopped once the reply was complete is
+    replayed up to the same point.
+    """
+
+    llm: BaseChatModel
+    llm_cache: LLMCache
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    @property
+    def _llm_type(self) -> str:
+        return "record-replay-chat-model"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"model_name": self.model}
+
+    @property
+    def model(self) -> str:
+        return getattr(self.llm, "model_name", None) or self.llm._llm_type
+
+    def get_num_tokens(self, text: str) -> int:
+        return self.llm.get_num_tokens(text)
+
+    def get_num_tokens_from_messages(self, messages: List[BaseMessage]) -> int:
+        return self.llm.get_num_tokens_from_messages(messages)
+
+    def _key(self, messages: List[BaseMessage], stop: Optional[List[str]], **kwargs: Any) -> str:
+        return self.llm_cache.key(self.model, getattr(self.llm, "temperature", None), messages, stop=stop, **kwargs)
+
+    def _call(self, key: str, messages: List[BaseMessage], stop: Optional[List[str]], run_manager: Any, **kwargs: Any) -> BaseMessage:
+        start = time.perf_counter()
+        message = self.llm._generate(messages, stop=stop, run_manager=run_manager, **kwargs).generations[0].message
+        self.llm_cache.put(key, self.model, message, time.perf_counter() - start)
+        return message
+
+    async def _acall(self, key: str, messages: List[BaseMessage], stop: Optional[List[str]], run_manager: Any, **kwargs: Any) -> BaseMessage:
+        start = time.perf_counter()
+        result = await self.llm._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        message = result.generations[0].message
+        self.llm_cache.put(key, self.model, message, time.perf_counter() - start)
+        return message
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        key = self._key(messages, stop, **kwargs)
+        message = self.llm_cache.get(key)
+        if message is None:
+            message = self._call(key, messages, stop, run_manager, **kwargs)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        key = self._key(messages, stop, **kwargs)
+        message = self.llm_cache.get(key)
+        if message is None:
+            message = await self._acall(key, messages, stop, run_manager, **kwargs)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        key = self._key(messages, stop, **kwargs)
+        message = self.llm_cache.get(key)
+        if message is None and type(self.llm)._stream is BaseChatModel._stream:
+            message = self._call(key, messages, stop, run_manager, **kwargs)
+        if message is not None:
+            yield _chunk(message)
+            return
+        start = time.perf_counter()
+        received = AIMessageChunk(content="")
+        try:
+            for chunk in self.llm._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                received += chunk.message
+                yield chunk
+        except GeneratorExit:
+            # Stopped by the caller once it had the whole reply
+            self.llm_cache.put(key, self.model, received, time.perf_counter() - start)
+            raise
+        self.llm_cache.put(key, self.model, received, time.perf_counter() - start)
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        key = self._key(messages, stop, **kwargs)
+        message = self.llm_cache.get(key)
+        if message is None and type(self.llm)._astream is BaseChatModel._astream:
+            message = await self._acall(key, messages, stop, run_manager, **kwargs)
+        if message is not None:
+            yield _chunk(message)
+            return
+        start = time.perf_counter()
+        received = AIMessageChunk(content="")
+        try:
+            async for chunk in self.llm._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                received += chunk.message
+                yield chunk
+        except GeneratorExit:
+            # Stopped by the caller once it had the whole reply
+            self.llm_cache.put(key, self.model, received, time.perf_counter() - start)
+            raise
+        self.llm_cache.put(key, self.model, received, time.perf_counter() - start)
+
+
+def _chunk(message: BaseMessage) -> ChatGenerationChunk:
+    return ChatGenerationChunk(message=AIMessageChunk(content=message.content, additional_kwargs=message.additional_kwargs))
@@ -1,15 +1,26 @@
 from agent import TddGPTAgent
-from cli import CLITool
+from summary_cache import SummaryCache
+from llm_cache import MODES as LLM_CACHE_MODES, LLMCache, RecordReplayChatModel
+from cli import CLITool, ShellSession
+from test_runner import TestRunner
+from speculation import TestSpeculator
+from history import HistoryCompactor, JournalChatMessageHistory
+from checkpoint import CheckpointManager
+from memory_writer import HashingEmbeddings, MemoryWriter
+from vector_memory import INDEX_TYPES, DiskFAISS
+import trace_report
+import tracing
 from langchain.chat_models import ChatOpenAI
 from langchain.tools.file_management.write import WriteFileTool
 from langchain.tools.file_management.read import ReadFileTool
 from langchain.vectorstores import FAISS
 from langchain.docstore import InMemoryDocstore
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.memory.chat_message_histories import FileChatMessageHistory
+from langchain.embeddings import HuggingFaceEmbeddings, OpenAIEmbeddings
 import faiss
 import argparse
+import asyncio
 import os
+import sys
 import base64
 from openai import OpenAI
 import re
@@ -20,53 +31,200 @@ def parse_args():
     parser.add_argument('--model', type=str, default='gpt-4', help='Model parameter for the agent')
     parser.add_argument('--prompt', type=str, default="", help='User stories for the app or file path')
     parser.add_argument('--debug', action='store_true', help='Enable debug mode')
-    parser.add_argument('--chat_history_file', type=str, help='Path to chat history file')
+    parser.add_argument('--chat_history_file', type=str, help='Path to chat history file, an append-only JSONL journal (a JSON history file is converted)')
+    parser.add_argument('--compact_chat_history', action='store_true', help='Compact the chat history file, dropping the code of files read or written again later, and exit')
     parser.add_argument('--output_dir', type=str, default=os.getcwd(), help='Output directory for the files generated by the agent')
     parser.add_argument('--temperature', type=float, default=0.2, help='Temperature parameter for the model')
     parser.add_argument('--context_window', type=int, default=4096, help='Context window size for the agent')
     parser.add_argument('--image_file', type=str, default='', help='An image of the desired UI')
+    parser.add_argument('--stream', action='store_true', help='Stream the responses and dispatch commands as soon as they are complete')
+    parser.add_argument('--function_calling', action='store_true', help='Pass the commands as functions instead of asking for a json response: about as many prompt tokens, the function specs replacing the commands and the response format in the prompt, and about 15%% fewer completion tokens')
+    parser.add_argument('--persistent_shell', action='store_true', help='Run the cli commands of every step in one shell session that keeps the working directory and the environment')
+    parser.add_argument('--related_tests', action='store_true', help='Only run the tests related to the files written since the last passing run, unless --all is passed to the test command')
+    parser.add_argument('--speculative_tests', action='store_true', help='Run the last test command in the background after each write_file step, and reuse its result if the same command is requested next')
+    parser.add_argument('--history_max_messages', type=int, help='Keep at most this many recent chat history messages verbatim in memory, older steps are collapsed into one line each')
+    parser.add_argument('--history_max_bytes', type=int, help='Keep at most this many bytes of recent chat history messages verbatim in memory, older steps are collapsed into one line each')
+    parser.add_argument('--checkpoint_dir', type=str, help='Save a checkpoint of the run in this directory after every step, the chat history defaults to history.jsonl in it')
+    parser.add_argument('--checkpoint_memory_every', type=int, default=10, help='Save the vector memory with the checkpoint every this many steps, the memories of the steps in between are restored from the chat history')
+    parser.add_argument('--resume', action='store_true', help='Resume the run from the checkpoint in --checkpoint_dir, at the step after the last completed one')
+    parser.add_argument('--embeddings', choices=['openai', 'hashing', 'huggingface'], default='openai', help='Embeddings of the agent memory: the OpenAI API, local word hashing, or a local sentence-transformers model')
+    parser.add_argument('--embedding_model', type=str, default='sentence-transformers/all-MiniLM-L6-v2', help='Model of the huggingface embeddings')
+    parser.add_argument('--memory_batch_size', type=int, default=16, help='Embed the step memories in batches of this many steps')
+    parser.add_argument('--memory_max_delay', type=float, default=30.0, help='Embed the pending step memories once the oldest has waited this many seconds, checked when the next step memory is added')
+    parser.add_argument('--memory_tokens', type=int, default=600, help='Token budget of the past steps retrieved from the memory for the task in progress, 0 to leave them out of the prompt')
+    parser.add_argument('--memory_dir', type=str, help='Keep the agent memory in this directory, to reuse it across runs and projects')
+    parser.add_argument('--memory_index', choices=INDEX_TYPES, default='ivf', help='Approximate index the memory in --memory_dir migrates to once it is large')
+    parser.add_argument('--memory_migrate_at', type=int, default=50000, help='Number of memories at which the exact index of --memory_dir is migrated to --memory_index')
+    parser.add_argument('--async_loop', action='store_true', help='Run the agent loop on asyncio, with the memory embeddings, the chat history writes and the console output in the background')
+    parser.add_argument('--summary_passthrough_tokens', type=int, default=300, help='Command outputs up to this many tokens are not summarized')
+    parser.add_argument('--summary_extractive_tokens', type=int, default=6000, help='Command outputs up to this many tokens are summarized locally, larger ones by the LLM')
+    parser.add_argument('--summary_concurrency', type=int, default=8, help='Maximum number of chunks of a large output summarized at the same time')
+    parser.add_argument('--summary_cache_file', type=str, help='Path to a SQLite file caching the summaries of command outputs across runs')
+    parser.add_argument('--llm_cache_file', type=str, help='Path to a JSONL transcript of the responses of the agent and summarizer models, to record a run and replay it offline')
+    parser.add_argument('--llm_cache_mode', choices=LLM_CACHE_MODES, default='read-through', help='record: call the models and append every response; replay: answer every call from the transcript, failing on a miss; read-through: call the models on misses only. Replay with --embeddings hashing runs offline')
+    parser.add_argument('--llm_cache_normalize', action='store_true', help='Key the cached calls on their messages with the timings, temporary paths and ids normalized, so that a replay matches a run whose command outputs differ only in those. Prompts that differ only there share their responses')
+    parser.add_argument('--trace_file', type=str, help='Append a JSONL trace of the run to this file: the wall and CPU time of every step, prompt, command, summary and memory write, and the tokens of every model call. Print its hot spots with `tdd-gpt trace-report FILE`')
+    parser.add_argument('--trace_otel', action='store_true', help='Also export the trace through OpenTelemetry to the OTLP/HTTP endpoint of the OTEL_EXPORTER_OTLP_* variables')
     
     # Parse the arguments
     return parser.parse_args()
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'trace-report':
+        trace_report.main(sys.argv[2:])
+        return
+
     # Parse the arguments
     args = parse_args()
 
+    if args.trace_file or args.trace_otel:
+        # Set before the models are built, their calls are traced through callbacks
+        tracing.set_tracer(tracing.Tracer(args.trace_file, exporters=[tracing.OTelExporter()] if args.trace_otel else []))
+
+    checkpoints = None
+    checkpoint = None
+    chat_history_file = args.chat_history_file
+    if args.checkpoint_dir:
+        checkpoints = CheckpointManager(args.checkpoint_dir, args.output_dir, memory_every=args.checkpoint_memory_every)
+        if args.resume:
+            checkpoint = checkpoints.load()
+            if checkpoint is None:
+                print(f"\033[91mNo checkpoint to resume in {args.checkpoint_dir}\033[0m")
+                return
+            chat_history_file = checkpoint.history_path or chat_history_file
+        chat_history_file = chat_history_file or os.path.join(args.checkpoint_dir, "history.jsonl")
+    elif args.resume:
+        print("\033[91m--resume requires --checkpoint_dir\033[0m")
+        return
+
     chat_history_memory = None
-    if args.chat_history_file:
-        chat_history_memory = FileChatMessageHistory(args.chat_history_file)
+    if chat_history_file:
+        chat_history_memory = JournalChatMessageHistory(chat_history_file)
+        if chat_history_memory.recovered_bytes:
+            print(f"\033[93mChat history:\033[0m dropped {chat_history_memory.recovered_bytes} bytes of a torn last message")
+        if checkpoint is not None:
+            # Messages of the step interrupted after the checkpoint, it is run again
+            dropped = len(chat_history_memory) - checkpoint.messages
+            chat_history_memory.truncate(checkpoint.messages)
+            if dropped:
+                print(f"\033[93mChat history:\033[0m dropped {dropped} messages written after the checkpoint")
+        if args.compact_chat_history:
+            saved = chat_history_memory.compact()
+            print(f"\033[92mChat history:\033[0m compacted {len(chat_history_memory)} messages, {saved} bytes saved")
+            chat_history_memory.close()
+            return
+
+    history_compactor = None
+    if args.history_max_messages or args.history_max_bytes:
+        history_compactor = HistoryCompactor(max_messages=args.history_max_messages, max_bytes=args.history_max_bytes)
+
+    summary_cache = None
+    if args.summary_cache_file:
+        summary_cache = SummaryCache(args.summary_cache_file)
+
+    llm_cache = None
+    if args.llm_cache_file:
+        llm_cache = LLMCache(args.llm_cache_file, mode=args.llm_cache_mode, normalize=args.llm_cache_normalize)
+        print(f"\033[92mLLM cache:\033[0m {len(llm_cache)} responses in {args.llm_cache_file}, {args.llm_cache_mode} mode")
+        if args.llm_cache_mode == 'replay':
+            # The models are never called, only their tokenizers are used
+            os.environ.setdefault("OPENAI_API_KEY", "replay")
 
     if not os.path.exists(args.output_dir):
       os.makedirs(args.output_dir)
 
+    shell_session = ShellSession(cwd=args.output_dir) if args.persistent_shell else None
+    test_runner = TestRunner(session=shell_session, cwd=args.output_dir) if args.related_tests else None
+    speculator = None
+    if args.speculative_tests:
+        speculator = TestSpeculator(
+            root=args.output_dir,
+            session=test_runner.session if test_runner is not None else shell_session,
+            test_runner=test_runner,
+        )
+
     tools = [
-        CLITool(),
+        CLITool(session=shell_session, test_runner=test_runner, speculator=speculator),
         WriteFileTool(),
         ReadFileTool(),
     ]
 
     # Define your embedding model
-    embeddings_model = OpenAIEmbeddings()
+    if args.embeddings == 'hashing':
+        embeddings_model = HashingEmbeddings()
+        embedding_size = embeddings_model.size
+    elif args.embeddings == 'huggingface':
+        embeddings_model = HuggingFaceEmbeddings(model_name=args.embedding_model)
+        embedding_size = len(embeddings_model.embed_query("size"))
+    else:
+        embeddings_model = OpenAIEmbeddings()
+        embedding_size = 1536
+
+    disk_memory = None
+    if args.memory_dir:
+        # Load the persistent vectorstore, or create it empty
+        disk_memory = DiskFAISS.open(
+            args.memory_dir,
+            embeddings_model,
+            embedding_size,
+            migrate_at=args.memory_migrate_at,
+            index_type=args.memory_index,
+        )
+        print(f"\033[92mMemory:\033[0m {disk_memory.index.ntotal} memories in {args.memory_dir}")
+        vectorstore = disk_memory
+    else:
+        # Initialize the vectorstore as empty
+        index = faiss.IndexFlatL2(embedding_size)
+        vectorstore = FAISS(embeddings_model, index, InMemoryDocstore({}), {})
+    if checkpoint is not None:
+        vectorstore = checkpoints.restore_memory(checkpoint, vectorstore, chat_history_memory.messages)
+        changed = checkpoints.changed_files(checkpoint)
+        if changed:
+            print(f"\033[93mFiles changed since the checkpoint:\033[0m {', '.join(changed)}")
 
-    # Initialize the vectorstore as empty
-    embedding_size = 1536
-    index = faiss.IndexFlatL2(embedding_size)
-    vectorstore = FAISS(embeddings_model, index, InMemoryDocstore({}), {})
+    memory = vectorstore.as_retriever()
+    memory_writer = MemoryWriter(memory, batch_size=args.memory_batch_size, max_delay=args.memory_max_delay)
+
+    llm = ChatOpenAI(model=args.model, temperature=args.temperature)
+    if llm_cache is not None:
+        llm = RecordReplayChatModel(llm=llm, llm_cache=llm_cache)
+    llm.callbacks = tracing.callbacks()
 
     # Initialize the agent
     agent = TddGPTAgent.from_llm_and_tools(
         output_dir=args.output_dir,
         tools=tools,
-        llm=ChatOpenAI(model=args.model, temperature=args.temperature),
-        memory=vectorstore.as_retriever(),
+        llm=llm,
+        memory=memory,
         chat_history_memory=chat_history_memory,
         context_window=args.context_window,
+        streaming=args.stream,
+        response_mode="functions" if args.function_calling else "json",
+        summary_passthrough_tokens=args.summary_passthrough_tokens,
+        summary_extractive_tokens=args.summary_extractive_tokens,
+        summary_cache=summary_cache,
+        summary_concurrency=args.summary_concurrency,
+        history_compactor=history_compactor,
+        checkpoints=checkpoints,
+        memory_writer=memory_writer,
+        memory_tokens=args.memory_tokens,
+        llm_cache=llm_cache,
     )
 
     # Set verbose to be true if debug argument is passed
     agent.chain.verbose = args.debug
 
+    if checkpoint is not None:
+        print(f"\033[92mResuming at step {checkpoint.step + 1}\033[0m")
+        try:
+            if args.async_loop:
+                asyncio.run(agent.arun(checkpoint.goals, start_step=checkpoint.step, user_input=checkpoint.user_input))
+            else:
+                agent.run(checkpoint.goals, start_step=checkpoint.step, user_input=checkpoint.user_input)
+        finally:
+            close(speculator, shell_session, test_runner, summary_cache, chat_history_memory, memory_writer, disk_memory, llm_cache, tracing.get_tracer())
+        return
+
     prompt = args.prompt
     if os.path.isfile(prompt):
         with open(prompt, 'r') as file:
@@ -122,7 +280,23 @@ def main():
 
     print(f'\033[92mPrompt:\033[0m\n{prompt}\n')
 
-    agent.run([prompt])
+    try:
+        if args.async_loop:
+            asyncio.run(agent.arun([prompt]))
+        else:
+            agent.run([prompt])
+    finally:
+        close(speculator, shell_session, test_runner, summary_cache, chat_history_memory, memory_writer, disk_memory, llm_cache, tracing.get_tracer())
+
+def close(*resources):
+    for resource in resources:
+        if resource is not None:
+            resource.close()
+        if isinstance(resource, LLMCache):
+            stats = resource.stats
+            print(f"\033[92mLLM cache:\033[0m {stats['hits']} hits, {stats['misses']} misses, {stats['recorded']} recorded, {stats['replayed_seconds']:.1f}s of model calls replayed")
+        if isinstance(resource, tracing.Tracer) and resource.path:
+            print(f"\033[92mTrace:\033[0m {resource.path}, print its hot spots with `tdd-gpt trace-report {resource.path}`")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,162 @@
+import re
+import threading
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+from pydantic import BaseModel
+
+from langchain.schema import Document
+from langchain.schema.embeddings import Embeddings
+from langchain.vectorstores.base import VectorStoreRetriever
+
+import tracing
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+class HashingEmbeddings(Embeddings, BaseModel):
+    """Local embeddings hashing the words and word pairs of a text into size buckets.
+
+    No model and no network: a text is embedded in well under a millisecond and the same text
+    always gets the same vector, across processes too, so a saved index stays valid.
+    Texts sharing file names, commands and words end up close, which is what the step
+    memories are searched by. The vectors are L2 normalized.
+    """
+
+    size: int = 1024
+
+    def _features(self, text: str) -> List[str]:
+        words = WORD_PATTERN.findall(text.lower())
+        return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+    def _embed(self, text: str) -> List[float]:
+        hashes = np.fromiter((zlib.crc32(f.encode("utf-8")) for f in self._features(text)), dtype=np.uint32)
+        vector = np.zeros(self.size, dtype=np.float32)
+        # The top bit picks the sign, so unrelated features cancel out instead of piling up
+        np.add.at(vector, hashes % self.size, np.where(hashes >> 31, -1.0, 1.0).astype(np.float32))
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class MemoryWriter:
+    """Buffers the step memories and adds them to the vector memory in batches.
+
+    add() only adds the pending documents once batch_size of them are pending or
+    the oldest one has waited max_delay seconds, so one embeddings request covers
+    many steps instead of one request per step. There is no timer: max_delay is only
+    checked by add(). The agent flushes before finishing, when its loop exits on an
+    error or an interrupt, and before the vector memory is saved with a checkpoint;
+    close() flushes too. With a batch_size of 1 every document is added right away.
+
+    search() also scores the pending documents, so the latest steps are retrieved
+    before they are added. A pending document is embedded on its first search, in the
+    same request as the query, and its vector is reused when it is added, so nothing
+    is embedded twice. search() holds the same lock, as a FAISS index cannot be
+    searched while added to.
+    """
+
+    def __init__(self, memory: VectorStoreRetriever, batch_size: int = 1, max_delay: float = 30.0):
+        self.memory = memory
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.stats = {"documents": 0, "batches": 0, "seconds": 0.0}
+        self._pending: List[Document] = []
+        # Vectors of the pending documents already embedded by a search, None for the others
+        self._pending_vectors: List[Optional[List[float]]] = []
+        self._oldest = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def add(self, document: Document) -> None:
+        with self._lock:
+            if not self._pending:
+                self._oldest = time.monotonic()
+            self._pending.append(document)
+            self._pending_vectors.append(None)
+            if len(self._pending) >= self.batch_size or time.monotonic() - self._oldest >= self.max_delay:
+                self._flush()
+
+    def _flush(self) -> None:
+        if not self._pending:
+            return
+        start = time.perf_counter()
+        documents, self._pending = self._pending, []
+        vectors, self._pending_vectors = self._pending_vectors, []
+        with tracing.span("memory.embed", documents=len(documents), input_bytes=sum(len(document.page_content) for document in documents)):
+            vectorstore = self.memory.vectorstore
+            if any(vector is not None for vector in vectors) and hasattr(vectorstore, "add_embeddings"):
+                missing = [i for i, vector in enumerate(vectors) if vector is None]
+                if missing:
+                    embedded = vectorstore.embeddings.embed_documents([documents[i].page_content for i in missing])
+                    for i, vector in zip(missing, embedded):
+                        vectors[i] = vector
+                vectorstore.add_embeddings(
+                    [(document.page_content, vector) for document, vector in zip(documents, vectors)],
+                    metadatas=[document.metadata for document in documents],
+                )
+            else:
+                self.memory.add_documents(documents)
+        self.stats["documents"] += len(documents)
+        self.stats["batches"] += 1
+        self.stats["seconds"] += time.perf_counter() - start
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def close(self) -> None:
+        self.flush()
+
+    def search(self, query: str, k: int = 4) -> List[Document]:
+        """Documents most similar to the query, among those added and those pending."""
+        vectorstore = self.memory.vectorstore
+        with self._lock:
+            new = [document for document, vector in zip(self._pending, self._pending_vectors) if vector is None]
+        # Embedded outside the lock, a batch can be added meanwhile
+        if new:
+            # The query is embedded like a document, in the same request as the new pending ones
+            vectors = vectorstore.embeddings.embed_documents([document.page_content for document in new] + [query])
+            embedding = vectors.pop()
+        else:
+            embedding = vectorstore.embeddings.embed_query(query)
+        embedded: Dict[int, List[float]] = {id(document): vector for document, vector in zip(new, vectors)} if new else {}
+
+        with self._lock:
+            for i, document in enumerate(self._pending):
+                if self._pending_vectors[i] is None and id(document) in embedded:
+                    self._pending_vectors[i] = embedded[id(document)]
+            results = vectorstore.similarity_search_with_score_by_vector(embedding, k=k)
+            pending = [(document, vector) for document, vector in zip(self._pending, self._pending_vectors) if vector is not None]
+        if not pending:
+            return [document for document, _ in results]
+        results += self._score_pending(vectorstore, embedding, pending)
+        inner_product = getattr(vectorstore.index, "metric_type", faiss.METRIC_L2) == faiss.METRIC_INNER_PRODUCT
+        results.sort(key=lambda result: -result[1] if inner_product else result[1])
+        return [document for document, _ in results[:k]]
+
+    @staticmethod
+    def _score_pending(vectorstore, embedding: List[float], pending: List[Tuple[Document, List[float]]]) -> List[Tuple[Document, float]]:
+        """Scores of the pending documents, as the index of the vector store scores the added ones."""
+        query = np.array(embedding, dtype=np.float32)
+        vectors = np.array([vector for _, vector in pending], dtype=np.float32)
+        if getattr(vectorstore, "_normalize_L2", False):
+            query = query / (np.linalg.norm(query) or 1.0)
+            vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        if getattr(vectorstore.index, "metric_type", faiss.METRIC_L2) == faiss.METRIC_INNER_PRODUCT:
+            scores = vectors @ query
+        else:
+            # Squared distances, like the L2 indexes of FAISS
+            scores = ((vectors - query) ** 2).sum(axis=1)
+        return [(document, float(score)) for (document, _), score in zip(pending, scores)]
@@ -0,0 +1,703 @@
+"""Deterministic parsers for the output of test runners and build tools.
+
+Output that the registered parsers understand is reported to the agent as a
+structured summary, without a summarization call.
+"""
+import json
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple, Union
+
+ANSI_PATTERN = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]")
+CLI_STATUS_PATTERN = re.compile(
+    r"^Command '.*?' (succeeded with the following output:|failed with error:|"
+    r"timed out after \d+ seconds of inactivity on stdout)",
+    re.S,
+)
+LOCATION_PATTERN = re.compile(r"([\w@.~/\\-]*[\w-]\.(?:[cm]?[jt]sx?|py)):(\d+)")
+# A line of source code quoted in an error, like "> 12 | expect(...)"
+CODE_FRAME_PATTERN = re.compile(r"^\s*>?\s*\d+\s*\|")
+COUNT_PATTERN = re.compile(r"(\d+) ([a-z]+)")
+COMMAND_SEPARATOR_PATTERN = re.compile(r"&&|\|\||;")
+# Commands that print nothing when they succeed
+SILENT_COMMAND_PATTERN = re.compile(r"^\s*(\w+=\S*\s+)*(cd|mkdir|touch|rm|mv|cp|export|chmod|ln|true)\b")
+# Lines npm prints before running a script
+NPM_SCRIPT_PATTERN = re.compile(r"^> ")
+# npm commands that run a script of the package, which npm announces with "> package@version script"
+NPM_RUN_PATTERN = re.compile(r"\bnpm (?:run(?:-script)? )?(?!(?:install|i|ci|add|exec|init)\b)([\w:.-]+)")
+
+MAX_FAILURES = 10
+MAX_MESSAGE_CHARS = 300
+
+
+def strip_ansi(text: str) -> str:
+    return ANSI_PATTERN.sub("", text)
+
+
+def split_cli_output(observation: str) -> Tuple[str, str]:
+    """Split the output of the cli tool into the status of the commands and their output."""
+    match = CLI_STATUS_PATTERN.match(observation)
+    if not match:
+        return "succeeded", observation
+    status = match.group(1).split(" with")[0].split(" after")[0]
+    return status, observation[match.end():].lstrip(" ")
+
+
+def find_location(text: str, file_path: Optional[str] = None) -> Tuple[Optional[str], Optional[int]]:
+    """Find the first file:line in text outside of node_modules and site-packages."""
+    for match in LOCATION_PATTERN.finditer(text):
+        path = match.group(1)
+        if "node_modules" in path or "site-packages" in path or path.startswith("node:"):
+            continue
+        if file_path and not (path.endswith(file_path) or file_path.endswith(path)):
+            continue
+        return path, int(match.group(2))
+    return None, None
+
+
+def short_message(text: str) -> str:
+    """First lines of an error message, up to its stack trace or code frame, on a single line."""
+    lines = []
+    for line in strip_ansi(text).split("\n"):
+        if CODE_FRAME_PATTERN.match(line):
+            break
+        line = line.strip()
+        if line.startswith("at ") or line.startswith("❯ "):
+            break
+        if line:
+            lines.append(line)
+    message = " ".join(lines)
+    if len(message) > MAX_MESSAGE_CHARS:
+        message = message[:MAX_MESSAGE_CHARS] + "..."
+    return message
+
+
+def count_words(line: str) -> Dict[str, int]:
+    """'2 failed, 5 passed, 7 total' -> {'failed': 2, 'passed': 5, 'total': 7}"""
+    counts = {}
+    for number, word in COUNT_PATTERN.findall(line):
+        counts[word] = counts.get(word, 0) + int(number)
+    return counts
+
+
+def plural(count: int, word: str) -> str:
+    return f"{count} {word}{'' if count == 1 else 's'}"
+
+
+@dataclass
+class Failure:
+    name: str
+    message: str = ""
+    file: Optional[str] = None
+    line: Optional[int] = None
+
+    def format(self) -> str:
+        location = ""
+        if self.file:
+            location = f" ({self.file}:{self.line})" if self.line else f" ({self.file})"
+        message = f": {self.message}" if self.message else ""
+        return f"- {self.name}{location}{message}"
+
+
+@dataclass
+class OutputReport:
+    """Structured result of a test run, type check, lint or install."""
+
+    tool: str
+    kind: str  # test, build, lint or install
+    passed: int = 0
+    failed: int = 0
+    skipped: int = 0
+    warnings: int = 0
+    failures: List[Failure] = field(default_factory=list)
+    notes: List[str] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed and not self.failures
+
+    def summary(self) -> str:
+        if self.kind == "test":
+            parts = [f"{self.passed} passed", f"{self.failed} failed"]
+            if self.skipped:
+                parts.append(f"{self.skipped} skipped")
+        elif self.kind == "install":
+            parts = self.notes or ["failed" if self.failures else "done"]
+        else:
+            parts = [plural(self.failed, "error")]
+            if self.warnings:
+                parts.append(plural(self.warnings, "warning"))
+        return ", ".join(parts)
+
+    def format(self) -> str:
+        lines = [f"{self.tool}: {self.summary()}"]
+        lines += [failure.format() for failure in self.failures[:MAX_FAILURES]]
+        if len(self.failures) > MAX_FAILURES:
+            lines.append(f"- ... and {len(self.failures) - MAX_FAILURES} more")
+        return "\n".join(lines)
+
+
+@dataclass
+class CommandReport:
+    """Reports for every command in one call of the cli tool."""
+
+    status: str
+    reports: List[OutputReport]
+
+    @property
+    def tests_ran(self) -> bool:
+        return any(report.kind == "test" for report in self.reports)
+
+    @property
+    def tests_failed(self) -> bool:
+        return any(report.kind == "test" and not report.ok for report in self.reports)
+
+    def format(self) -> str:
+        return "\n".join([f"The commands {self.status}."] + [report.format() for report in self.reports])
+
+
+class OutputParser:
+    """Parser for the output of one tool.
+
+    command_pattern selects the commands the parser applies to. start_pattern, if
+    any, matches the first line the tool prints, where its output starts among the
+    output of chained commands. parse() returns None when the output is not
+    recognized, so the next parser can be tried.
+    """
+
+    name: str = ""
+    kind: str = "test"
+    command_pattern: re.Pattern = re.compile(r"$^")
+    start_pattern: Optional[re.Pattern] = None
+
+    def matches(self, command: str) -> bool:
+        return bool(self.command_pattern.search(command))
+
+    def parse(self, output: str) -> Optional[OutputReport]:
+        raise NotImplementedError
+
+
+TEST_COMMAND_PATTERN = re.compile(r"\b(npm|yarn|pnpm)( run)? test\b|\b(jest|vitest|mocha)\b")
+
+
+class JestJsonParser(OutputParser):
+    """jest --json, and the jest compatible json reporter of vitest."""
+
+    name = "jest"
+    command_pattern = TEST_COMMAND_PATTERN
+    start_pattern = re.compile(r'^\s*\{\s*"num\w+Test', re.M)
+
+    def parse(self, output: str) -> Optional[OutputReport]:
+        data = self._find_json(output)
+        if data is None:
+            return None
+        report = OutputReport(
+            tool="vitest" if "vitest" in output[:200] else self.name,
+            kind=self.kind,
+            passed=data.get("numPassedTests", 0),
+            failed=data.get("numFailedTests", 0),
+            skipped=data.get("numPendingTests", 0) + data.get("numTodoTests", 0),
+        )
+        for suite in data.get("testResults", []):
+            file_path = suite.get("name")
+            failed_tests = [t for t in suite.get("assertionResults", []) if t.get("status") == "failed"]
+            for test in failed_tests:
+                messages = "\n".join(test.get("failureMessages") or [])
+                line = (test.get("location") or {}).get("line")
+                if line is None:
+                    _, line = find_location(messages, file_path)
+                report.failures.append(Failure(
+                    name=test.get("fullName") or test.get("title", ""),
+                    message=short_message(messages),
+                    file=file_path,
+                    line=line,
+                ))
+            if suite.get("status") == "failed" and not failed_tests:
+                message = suite.get("message") or suite.get("failureMessage") or ""
+                _, line = find_location(message, file_path)
+                report.failures.append(Failure(
+                    name="Test suite failed to run",
+                    message=short_message(message.split("●", 1)[-1]),
+                    file=file_path,
+                    line=line,
+                ))
+        return report
+
+    def _find_json(self, output: str) -> Optional[dict]:
+        decoder = json.JSONDecoder()
+        for match in re.finditer(r'\{\s*"num\w+Test', output):
+            try:
+                data, _ = decoder.raw_decode(output, match.start())
+            except json.JSONDecodeError:
+                continue
+            if "numTotalTests" in data:
+                return data
+        return None
+
+
+def condense_jest_output(test_output: str) -> str:
+    """Keep the suite results, failures, expectations and totals of the jest text output."""
+    lines = test_output.strip().split("\n")
+    parsed_output = []
+    inside_console_error_block = False
+    inside_console_details = False
+    console_line_count = 0
+    in_expect_block = False
+    after_received = False
+
+    for line in lines:
+        if line.startswith("PASS") or line.startswith("FAIL"):
+            parsed_output.append(line + ("\n" if line.startswith("PASS") else ""))
+            inside_console_error_block = False
+            inside_console_details = False
+            in_expect_block = False  # Reset the expect block flag
+            after_received = False  # Reset the after_received flag
+
+        elif line.startswith("  ●"):
+            parsed_output.append(line)
+            inside_console_error_block = "Console" in line
+            if inside_console_error_block:
+                inside_console_details = True
+
+        elif "Error: " in line:
+            parsed_output.append(f"    {line.strip()}")
+
+        elif line.startswith("    expect("):
+            parsed_output.append(line.strip())
+            in_expect_block = True  # Set flag to capture the next few lines
+
+        elif in_expect_block and ("Expected element" in line or "Received:" in line or "Test todo" in line or "Number of calls:" in line):
+            parsed_output.append(f"    {line.strip()}")
+            if "Received:" in line:
+                after_received = True  # Flag to capture the line after "Received:"
+
+        elif after_received:  # If the flag is True, capture the next line
+            parsed_output.append(f"    {line.strip()}")
+            after_received = False  # Reset the flag
+
+        elif "Expected:" in line or "Received:" in line:
+            if not inside_console_error_block:
+                parsed_output.append(f"    {line.strip()}")
+
+        elif line.startswith("    >"):
+            parsed_output.append(f"    {line}\n")
+
+        elif inside_console_error_block and inside_console_details:
+            if "console.error" in line:
+                parsed_output.append("  ● console.error")
+            elif "Warning:" in line or "Error:" in line:
+                parsed_output.append(f"    {line.strip()}")
+            elif console_line_count < 1:
+                parsed_output.append(f"    {line.strip()}")
+                console_line_count += 1
+
+        elif "Test Suites:" in line or "Tests:" in line:
+            parsed_output.append(line)
+
+    return "\n".join(parsed_output)
+
+
+class JestTextParser(OutputParser):
+    """The default reporter of jest, as printed by npm test."""
+
+    name = "jest"
+    command_pattern = TEST_COMMAND_PATTERN
+    start_pattern = re.compile(r"^(?:Determining test suites|(?:PASS|FAIL) \S)", re.M)
+    TOTALS_PATTERN = re.compile(r"^Tests:\s+(.*\d+ total)", re.M)
+    SOURCE_LINE_PATTERN = re.compile(r"^\s*>\s*(\d+) \|", re.M)
+
+    def parse(self, output: str) -> Optional[OutputReport]:
+        output = strip_ansi(output)
+        totals = self.TOTALS_PATTERN.search(output)
+        if not totals:
+            return None
+        counts = count_words(totals.group(1))
+        report = OutputReport(
+            tool=self.name,
+            kind=self.kind,
+            passed=counts.get("passed", 0),
+            failed=counts.get("failed", 0),
+            skipped=counts.get("skipped", 0) + counts.get("todo", 0),
+        )
+        suite = None
+        block: List[str] = []
+        for line in output.split("\n") + ["Test Suites:"]:
+            if line.startswith(("PASS ", "FAIL ", "  ● ", "Test Suites:")):
+                self._add_failure(report, suite, block)
+                block = []
+            if line.startswith(("PASS ", "FAIL ")):
+                suite = line.split()[1]
+            elif line.startswith("  ● ") and "Console" not in line:
+                block = [line]
+            elif block:
+                block.append(line)
+        return report
+
+    def _add_failure(self, report: OutputReport, suite: Optional[str], block: List[str]) -> None:
+        if not block:
+            return
+        name = block[0].strip()[2:].strip()
+        text = "\n".join(block[1:])
+        file_path, line = find_location(text, suite) if suite else find_location(text)
+        if line is None:
+            source_line = self.SOURCE_LINE_PATTERN.search(text)
+            file_path, line = suite, int(source_line.group(1)) if source_line else None
+        report.failures.append(Failure(name=name, message=short_message(text), file=file_path or suite, line=line))
+
+
+class VitestParser(OutputParser):
+    """The default reporter of vitest."""
+
+    name = "vitest"
+    command_pattern = TEST_COMMAND_PATTERN
+    start_pattern = re.compile(r"^\s*RUN\s+v\d", re.M)
+    TOTALS_PATTERN = re.compile(r"^\s*Tests\s+(.*\(\d+\))", re.M)
+    FAIL_PATTERN = re.compile(r"^\s*FAIL\s+(\S+)(?:\s+>\s+(.+?))?(?:\s+\[.*\])?\s*$")
+    LOCATION_LINE_PATTERN = re.compile(r"^\s*❯\s+(\S+?):(\d+)")
+
+    def parse(self, output: str) -> Optional[OutputReport]:
+        output = strip_ansi(output)
+        if not re.search(r"^\s*Test Files\s+", output, re.M):
+            return None
+        totals = self.TOTALS_PATTERN.search(output)
+        counts = count_words(totals.group(1)) if totals else {}
+        report = OutputReport(
+            tool=self.name,
+            kind=self.kind,
+            passed=counts.get("passed", 0),
+            failed=counts.get("failed", 0),
+            skipped=counts.get("skipped", 0) + counts.get("todo", 0),
+        )
+        seen = set()
+        lines = output.split("\n")
+        for i, line in enumerate(lines):
+            match = self.FAIL_PATTERN.match(line)
+            if not match:
+                continue
+            file_path, name = match.group(1), match.group(2) or "Test suite failed to run"
+            if (file_path, name) in seen:
+                continue
+            seen.add((file_path, name))
+            failure = Failure(name=name, file=file_path)
+            for following in lines[i + 1:i + 40]:
+                if self.FAIL_PATTERN.match(following):
+                    break
+                location = self.LOCATION_LINE_PATTERN.match(following)
+                if location and failure.line is None and "node_modules" not in location.group(1):
+                    failure.line = int(location.group(2))
+                elif not failure.message and following.strip() and not following.strip().startswith("⎯"):
+                    failure.message = short_message(following)
+            report.failures.append(failure)
+        return report
+
+
+class MochaParser(OutputParser):
+    """The spec reporter of mocha."""
+
+    name = "mocha"
+    command_pattern = TEST_COMMAND_PATTERN
+    PASSING_PATTERN = re.compile(r"^\s*(\d+) passing\b", re.M)
+    FAILURE_PATTERN = re.compile(r"^\s*\d+\) (.*)$")
+
+    def parse(self, output: str) -> Optional[OutputReport]:
+        output = strip_ansi(output)
+        passing = self.PASSING_PATTERN.search(output)
+        if not passing:
+            return None
+        failing = re.search(r"^\s*(\d+) failing\b", output, re.M)
+        pending = re.search(r"^\s*(\d+) pending\b", output, re.M)
+        report = OutputReport(
+            tool=self.name,
+            kind=self.kind,
+            passed=int(passing.group(1)),
+            failed=int(failing.group(1)) if failing else 0,
+            skipped=int(pending.group(1)) if pending else 0,
+        )
+        if not failing:
+            return report
+
+        blocks: List[List[str]] = []
+        for line in output[failing.end():].split("\n"):
+            if self.FAILURE_PATTERN.match(line):
+                blocks.append([line])
+            elif blocks:
+                blocks[-1].append(line)
+        for block in blocks:
+            name_parts = [self.FAILURE_PATTERN.match(block[0]).group(1).strip()]
+            rest = block[1:]
+            while not name_parts[-1].endswith(":") and rest:
+                name_parts.append(rest.pop(0).strip())
+            name = " ".join(part for part in name_parts if part).rstrip(":")
+            file_path, line = find_location("\n".join(rest))
+            report.failures.append(Failure(name=name, message=short_message("\n".join(rest)), file=file_path, line=line))
+        return report
+
+
+class PytestParser(OutputParser):
+    name = "pytest"
+    command_pattern = re.compile(r"\bpytest\b")
+    start_pattern = re.compile(r"^=+ test session starts =+$", re.M)
+    TOTALS_PATTERN = re.compile(r"^(?:=+ )?((?:\d+ \w+(?:, )?)+) in [\d.]+s\b", re.M)
+    SHORT_SUMMARY_PATTERN = re.compile(r"^(FAILED|ERROR) (\S+)(?: - (.*))?$", re.M)
+    SECTION_PATTERN = re.compile(r"^_{3,} (.+?) _{3,}$", re.M)
+
+    def parse(self, output: str) -> Optional[OutputReport]:
+        output = strip_ansi(output)
+        totals = self.TOTALS_PATTERN.search(output)
+        if not totals:
+            return None
+        counts = count_words(totals.group(1))
+        report = OutputReport(
+            tool=self.name,
+            kind=self.kind,
+            passed=counts.get("passed", 0),
+            failed=counts.get("failed", 0) + counts.get("error", 0) + counts.get("errors", 0),
+            skipped=counts.get("skipped", 0) + counts.get("xfailed", 0),
+        )
+        sections = self._sections(output)
+        for _, node_id, message in self.SHORT_SUMMARY_PATTERN.findall(output):
+            file_path = node_id.split("::")[0]
+            section = sections.get(node_id.split("::")[-1], "")
+            locations = re.findall(rf"^{re.escape(file_path)}:(\d+): ", section, re.M)
+            if not message:
+                errors = re.findall(r"^E\s+(.*)$", section, re.M)
+                message = errors[0] if errors else ""
+            report.failures.append(Failure(
+                name=node_id,
+                message=message.strip()[:MAX_MESSAGE_CHARS],
+                file=file_path,
+                line=int(locations[-1]) if locations else None,
+            ))
+        return report
+
+    def _sections(self, output: str) -> Dict[str, str]:
+        headers = list(self.SECTION_PATTERN.finditer(output))
+        sections = {}
+        for i, header in enumerate(headers):
+            end = headers[i + 1].start() if i + 1 < len(headers) else len(output)
+            sections[header.group(1).split(".")[-1]] = output[header.end():end]
+        return sections
+
+
+def leftover_lines(output: str, *patterns: re.Pattern) -> List[str]:
+    """Non-empty lines that none of the patterns, nor the npm script header, match."""
+    return [
+        line for line in strip_ansi(output).split("\n")
+        if line.strip() and not NPM_SCRIPT_PATTERN.match(line) and not any(p.search(line) for p in patterns)
+    ]
+
+
+class TscParser(OutputParser):
+    name = "tsc"
+    kind = "build"
+    command_pattern = re.compile(r"\btsc\b")
+    ERROR_PATTERNS = [
+        re.compile(r"^(?P<file>.+?)\((?P<line>\d+),\d+\): error (?P<code>TS\d+): (?P<message>.*)$"),
+        re.compile(r"^(?P<file>.+?):(?P<line>\d+):\d+ - error (?P<code>TS\d+): (?P<message>.*)$"),
+        re.compile(r"^error (?P<code>TS\d+): (?P<message>.*)$"),
+    ]
+    OTHER_PATTERN = re.compile(r"^Found \d+ errors?|^Errors\s+Files|^\s+|^\d+\s")
+
+    def parse(self, output: str) -> Optional[OutputReport]:
+        output = strip_ansi(output)
+        report = OutputReport(tool=self.name, kind=self.kind)
+        for line in output.split("\n"):
+            for pattern in self.ERROR_PATTERNS:
+                match = pattern.match(line.strip())
+                if match:
+                    error = match.groupdict()
+                    report.failures.append(Failure(
+                        name=error["code"],
+                        message=error["message"].strip(),
+                        file=error.get("file"),
+                        line=int(error["line"]) if error.get("line") else None,
+                    ))
+                    break
+        report.failed = len(report.failures)
+        if not report.failures and leftover_lines(output, self.OTHER_PATTERN):
+            return None
+        return report
+
+
+class EslintParser(OutputParser):
+    """The stylish formatter of eslint."""
+
+    name = "eslint"
+    kind = "lint"
+    command_pattern = re.compile(r"\beslint\b|\b(npm|yarn|pnpm)( run)? lint\b")
+    PROBLEM_PATTERN = re.compile(r"^\s+(\d+):(\d+)\s+(error|warning)\s+(.*?)(?:\s{2,}([\w@/-]+))?\s*$")
+    FILE_PATTERN = re.compile(r"^\S.*\.\w+$")
+    OTHER_PATTERN = re.compile(r"^✖ \d+ problems?|potentially fixable")
+
+    def parse(self, output: str) -> Optional[OutputReport]:
+        output = strip_ansi(output)
+        report = OutputReport(tool=self.name, kind=self.kind)
+        file_path = None
+        unknown = False
+        for line in output.split("\n"):
+            problem = self.PROBLEM_PATTERN.match(line)
+            if problem:
+                line_number, _, severity, message, rule = problem.groups()
+                if severity == "warning":
+                    report.warnings += 1
+                    continue
+                report.failures.append(Failure(
+                    name=rule or "error",
+                    message=message,
+                    file=file_path,
+                    line=int(line_number),
+                ))
+            elif self.FILE_PATTERN.match(line) and not NPM_SCRIPT_PATTERN.match(line) and not self.OTHER_PATTERN.search(line):
+                file_path = line.strip()
+            elif line.strip() and not NPM_SCRIPT_PATTERN.match(line) and not self.OTHER_PATTERN.search(line):
+                unknown = True
+        report.failed = len(report.failures)
+        if unknown and not report.failures and not report.warnings:
+            return None
+        return report
+
+
+class NpmInstallParser(OutputParser):
+    name = "npm install"
+    kind = "install"
+    command_pattern = re.compile(r"\bnpm (install|i|ci|add)\b")
+    RESULT_PATTERN = re.compile(r"^(added \d+ packages?.*|removed \d+ packages?.*|changed \d+ packages?.*|up to date.*)$", re.M)
+    ERROR_PATTERN = re.compile(r"^npm (ERR!|error) ?(.*)$", re.M)
+
+    def parse(self, output: str) -> Optional[OutputReport]:
+        output = strip_ansi(output)
+        results = self.RESULT_PATTERN.findall(output)
+        errors = [
+            message.strip() for _, message in self.ERROR_PATTERN.findall(output)
+            if message.strip() and not message.strip().isdigit() and not message.startswith("A complete log")
+        ]
+        if not results and not errors:
+            return None
+        report = OutputReport(tool=self.name, kind=self.kind, notes=[re.sub(r" in [\d.]+m?s$", "", r) for r in results])
+        if errors:
+            report.failures.append(Failure(name="npm install", message=short_message("\n".join(errors[:5]))))
+        return report
+
+
+class PipInstallParser(OutputParser):
+    name = "pip install"
+    kind = "install"
+    command_pattern = re.compile(r"\bpip3? install\b")
+    start_pattern = re.compile(r"^(?:Collecting|Requirement already satisfied|Obtaining|Looking in indexes) ", re.M)
+    INSTALLED_PATTERN = re.compile(r"^Successfully installed (.*)$", re.M)
+    ERROR_PATTERN = re.compile(r"^ERROR: (.*)$", re.M)
+
+    def parse(self, output: str) -> Optional[OutputReport]:
+        output = strip_ansi(output)
+        installed = self.INSTALLED_PATTERN.findall(output)
+        errors = self.ERROR_PATTERN.findall(output)
+        satisfied = "Requirement already satisfied" in output
+        if not installed and not errors and not satisfied:
+            return None
+        notes = [f"installed {' '.join(installed)}"] if installed else ["requirements already satisfied"]
+        report = OutputReport(tool=self.name, kind=self.kind, notes=notes)
+        if errors:
+            report.failures.append(Failure(name="pip install", message=short_message("\n".join(errors[:5]))))
+        return report
+
+
+class OutputParserRegistry:
+    """Ordered registry of output parsers.
+
+    parse() returns a CommandReport when every command is either silent or
+    recognized by one of the parsers that apply to it, and None otherwise, in
+    which case the output still has to be summarized.
+    """
+
+    def __init__(self, parsers: Optional[List[OutputParser]] = None):
+        self.parsers: List[OutputParser] = list(parsers or [])
+        self.stats = {"parsed": 0, "unparsed": 0}
+
+    def register(self, parser: OutputParser, first: bool = False) -> OutputParser:
+        if first:
+            self.parsers.insert(0, parser)
+        else:
+            self.parsers.append(parser)
+        return parser
+
+    def parse_command(self, command: str, output: str) -> Optional[OutputReport]:
+        for parser in self.parsers:
+            if parser.matches(command):
+                report = parser.parse(output)
+                if report is not None:
+                    return report
+        return None
+
+    def split_output(self, commands: List[str], output: str) -> List[str]:
+        """Split the output of chained commands into the output of each command.
+
+        The output of a command starts at the header npm prints before its script, or
+        at the first line of a parser that applies to it, whichever comes first after
+        the start of the previous command. A command whose start is not found shares
+        the output of the previous one.
+        """
+        starts: List[Optional[int]] = [0]
+        last = 0
+        for command in commands[1:]:
+            patterns = [parser.start_pattern for parser in self.parsers if parser.start_pattern and parser.matches(command)]
+            script = NPM_RUN_PATTERN.search(command)
+            if script:
+                patterns.append(re.compile(rf"^> \S+@\S* {re.escape(script.group(1))}\s*$", re.M))
+            matches = [match.start() for match in (pattern.search(output, last + 1) for pattern in patterns) if match]
+            start = min(matches) if matches else None
+            starts.append(start)
+            last = start if start is not None else last
+
+        outputs = []
+        for i, start in enumerate(starts):
+            begin = next(s for s in reversed(starts[:i + 1]) if s is not None)
+            end = next((s for s in starts[i + 1:] if s is not None), len(output))
+            outputs.append(output[begin:end])
+        return outputs
+
+    def parse(self, commands: Union[str, List[str]], observation: str) -> Optional[CommandReport]:
+        report = self._parse(commands, observation)
+        self.stats["parsed" if report else "unparsed"] += 1
+        return report
+
+    def _parse(self, commands: Union[str, List[str]], observation: str) -> Optional[CommandReport]:
+        if isinstance(commands, str):
+            commands = [commands]
+        status, output = split_cli_output(observation)
+        parts = [part.strip() for command in commands for part in COMMAND_SEPARATOR_PATTERN.split(command)]
+
+        parsed_parts = []
+        for part in parts:
+            if not part:
+                continue
+            if not any(parser.matches(part) for parser in self.parsers):
+                if SILENT_COMMAND_PATTERN.match(part):
+                    continue
+                return None
+            parsed_parts.append(part)
+
+        reports = []
+        for part, part_output in zip(parsed_parts, self.split_output(parsed_parts, output)):
+            report = self.parse_command(part, part_output)
+            if report is None:
+                return None
+            reports.append(report)
+
+        # A failure the parsers did not explain has to be summarized
+        if not reports or (status != "succeeded" and all(report.ok for report in reports)):
+            return None
+        return CommandReport(status=status, reports=reports)
+
+
+def default_registry() -> OutputParserRegistry:
+    return OutputParserRegistry([
+        JestJsonParser(),
+        VitestParser(),
+        MochaParser(),
+        JestTextParser(),
+        PytestParser(),
+        TscParser(),
+        EslintParser(),
+        NpmInstallParser(),
+        PipInstallParser(),
+    ])
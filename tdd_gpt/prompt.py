@@ -4,13 +4,17 @@ import time
 import json
 from typing import Any, Callable, List, Optional, Tuple
 
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 
 from langchain.prompts.chat import BaseChatPromptTemplate
-from langchain.schema import BaseMessage, HumanMessage, SystemMessage
+from langchain.schema import BaseMessage, Document, HumanMessage, SystemMessage
 from langchain.tools.base import BaseTool
 from langchain.vectorstores.base import VectorStoreRetriever
 from summarizer import TextSummarizer
+from file_index import FileIndex, parse_metadata
+from file_packer import pack_files
+from step_retrieval import FETCH_FACTOR, past_step_query, select_past_steps
+import tracing
 
 
 class TddGPTPrompt(BaseChatPromptTemplate, BaseModel):
@@ -18,13 +22,58 @@ class TddGPTPrompt(BaseChatPromptTemplate, BaseModel):
     token_counter: Callable[[str], int]
     send_token_limit: int = 4096
     output_dir: Optional[str] = None  
+    file_packing: str = "knapsack"
+    """How the Files section is fitted into the budget: 'knapsack' or 'legacy'."""
+    skeleton_min_tokens: Optional[int] = 400
+    """Files at least this large may be sent as a skeleton instead of being dropped."""
+    response_mode: str = "json"
+    """'json' to describe the commands and the response format in the prompt, 'functions' when they are passed as functions."""
+    persistent_shell: bool = False
+    """Whether the cli tool keeps the working directory and the environment between steps."""
+    related_tests: bool = False
+    """Whether the test commands only run the tests related to the changed files."""
+    memory_tokens: int = 0
+    """Token sub-budget of the past steps retrieved from the memory for the task in progress; 0 to leave them out."""
+    memory_k: int = 8
+    """Maximum number of past steps shown, before fitting them into memory_tokens."""
+
+    # (key, rendered prompt prefix, token count) of the last constructed prefix
+    _prefix_cache: Optional[Tuple[tuple, str, int]] = PrivateAttr(default=None)
+    # Seconds spent formatting the messages, for the step timings
+    _format_seconds: float = PrivateAttr(default=0.0)
+
+    @property
+    def format_seconds(self) -> float:
+        return self._format_seconds
 
     @property
     def summarizer(self) -> TextSummarizer:
         return TextSummarizer(summary_type="memory")
 
+    def _os_name(self) -> str:
+        return 'MacOS' if platform.system() == 'Darwin' else platform.system()
+
+    def _prefix_key(self, goals: List[str]) -> tuple:
+        output_dir = os.path.abspath(self.output_dir) if self.output_dir else os.getcwd()
+        tools_key = tuple((tool.name, tool.description, tool.args_schema) for tool in self.tools)
+        return (tuple(goals), tools_key, output_dir, self._os_name(), self.response_mode, self.persistent_shell, self.related_tests)
+
+    def prompt_prefix(self, goals: List[str]) -> Tuple[str, int]:
+        """Return the static system prompt and its token count.
+
+        The prefix only depends on the goals, the tools, the output directory, the
+        platform, the response mode and whether the shell is persistent and the
+        tests are limited to the related ones, so it is rendered and tokenized once
+        and reused on every step until one of those changes.
+        """
+        key = self._prefix_key(goals)
+        if self._prefix_cache is None or self._prefix_cache[0] != key:
+            content = self.construct_full_prompt(goals)
+            self._prefix_cache = (key, content, self.token_counter(content))
+        return self._prefix_cache[1], self._prefix_cache[2]
+
     def construct_full_prompt(self, goals: List[str]) -> str:
-        os_name = 'MacOS' if platform.system() == 'Darwin' else platform.system()
+        os_name = self._os_name()
         self.output_dir = os.path.abspath(self.output_dir) if self.output_dir else os.getcwd()
 
         prompt_start = [
@@ -46,9 +95,18 @@ class TddGPTPrompt(BaseChatPromptTemplate, BaseModel):
         return full_prompt
 
     def format_messages(self, **kwargs: Any) -> List[BaseMessage]:
+        start = time.perf_counter()
+        try:
+            with tracing.span("prompt.format") as span:
+                messages = self._format_messages(**kwargs)
+                span.set(messages=len(messages), prompt_bytes=sum(len(message.content) for message in messages))
+                return messages
+        finally:
+            self._format_seconds += time.perf_counter() - start
+
+    def _format_messages(self, **kwargs: Any) -> List[BaseMessage]:
         # Create the base prompt
-        base_prompt = SystemMessage(content=self.construct_full_prompt(kwargs["goals"]))
-        used_tokens = self.token_counter(base_prompt.content)
+        base_prompt_content, used_tokens = self.prompt_prefix(kwargs["goals"])
 
         # Get user input and its tokens
         user_input = kwargs["user_input"]
@@ -57,17 +115,13 @@ class TddGPTPrompt(BaseChatPromptTemplate, BaseModel):
         # Get previous messages
         previous_messages = kwargs["messages"]
 
-        # Extract code context from previous system messages
-        code_context = {}
-        for m in reversed(previous_messages):
-            if isinstance(m, SystemMessage):
-                if "code" in m.additional_kwargs and "file_path" in m.additional_kwargs:
-                    if len(m.additional_kwargs['code'].strip()) > 0:
-                        file_path = m.additional_kwargs["file_path"]
-                        code = m.additional_kwargs["code"]
-                        if file_path not in code_context:
-                            code_context[file_path] = code
-        code_context_tokens = sum([self.token_counter(code) for code in code_context.values()])
+        # Get the code context from the file index, most recently touched file first
+        file_index = kwargs.get("file_index")
+        if file_index is None:
+            file_index = FileIndex.from_messages(previous_messages, self.token_counter)
+        code_context = {entry.file_path: entry.code for entry in file_index.entries()}
+        code_tokens = {entry.file_path: entry.tokens for entry in file_index.entries()}
+        code_context_tokens = sum(code_tokens.values())
 
         # Get the last system message
         last_system_message = next((
@@ -83,22 +137,71 @@ class TddGPTPrompt(BaseChatPromptTemplate, BaseModel):
         # Calculate the available tokens, considering the last step
         available_tokens = self.send_token_limit - used_tokens - input_message_tokens - last_step_tokens
 
+        # Retrieve the past steps relevant to the task in progress and reserve their sub-budget
+        in_progress, failing_output = self._packing_focus(last_step)
+        past_steps = self._retrieve_past_steps(kwargs.get("memory"), in_progress, failing_output)
+        reserved_tokens = min(self.memory_tokens, max(available_tokens, 0)) if past_steps else 0
+        available_tokens -= reserved_tokens
+
         # Fit as much code context as possible based on available tokens
-        while code_context_tokens > available_tokens:
-            file_path_to_remove = next(iter(code_context))
-            code_context_tokens -= self.token_counter(code_context.pop(file_path_to_remove))
+        if self.file_packing == "legacy":
+            while code_context_tokens > available_tokens:
+                file_path_to_remove = next(iter(code_context))
+                code_context.pop(file_path_to_remove)
+                code_context_tokens -= code_tokens[file_path_to_remove]
+        else:
+            packed = pack_files(
+                file_index.entries(),
+                available_tokens,
+                self.token_counter,
+                in_progress=in_progress,
+                failing_output=failing_output,
+                skeleton_min_tokens=self.skeleton_min_tokens,
+            )
+            code_context = {entry.file_path: code for entry, code, _ in packed}
 
         code_context_str = "\n".join([code for code in code_context.values()]).strip() if len(code_context) > 0 else "None"
-        prompt_suffix = f"## Files:\n>>>>\n{code_context_str}\n<<<<\n\n## Last Step:\n{last_step}\n"
+        prompt_suffix = f"## Files:\n>>>>\n{code_context_str}\n<<<<\n\n"
+        records, _ = select_past_steps(
+            past_steps,
+            reserved_tokens,
+            self.token_counter,
+            last_step=parse_metadata(last_step),
+            files=code_context,
+            limit=self.memory_k,
+        )
+        if records:
+            past_steps_str = "\n".join(records)
+            prompt_suffix += f"## Relevant Past Steps:\n{past_steps_str}\n\n"
+        prompt_suffix += f"## Last Step:\n{last_step}\n"
 
         # Compile the full prompt
-        full_prompt = base_prompt.content + prompt_suffix
+        full_prompt = base_prompt_content + prompt_suffix
 
         # Create a list of messages
         messages: List[BaseMessage] = [SystemMessage(content=full_prompt), HumanMessage(content=user_input)]
 
         return messages
     
+    def _retrieve_past_steps(self, memory: Any, in_progress: str, failing_output: str) -> List[Document]:
+        if not self.memory_tokens or memory is None or not in_progress:
+            return []
+        return memory.search(past_step_query(in_progress, failing_output), k=self.memory_k * FETCH_FACTOR)
+
+    @staticmethod
+    def _packing_focus(last_step: str) -> Tuple[str, str]:
+        """Return the in progress task and the failing test output of the last step."""
+        start_index = last_step.find('{')
+        end_index = last_step.rfind('}')
+        try:
+            step = json.loads(last_step[start_index:end_index + 1], strict=False)
+            in_progress = str(step["kanban"]["in_progress"])
+        except (json.JSONDecodeError, KeyError, TypeError):
+            return "", ""
+        result = str(step.get("Result", ""))
+        failing = "FAIL" in result or "fail" in str(step.get("tests_status", "")).lower()
+        return in_progress, result if failing else ""
+
     def get_prompt(self, tools: List[BaseTool]) -> str:
         workflow = [
             "### Design Phase:",
@@ -130,14 +233,21 @@ class TddGPTPrompt(BaseChatPromptTemplate, BaseModel):
             "- As the Programmer, finally commit all changes to git repo and finish the project.",
         ]
 
+        if self.persistent_shell:
+            cli_instruction = f"The cli tool runs in a persistent shell session that starts in {self.output_dir}. The working directory, environment variables and activated virtualenvs are kept between steps."
+        else:
+            cli_instruction = '**While running one or more cli commands, ALWAYS make sure that the first command is cd to the project directory.** This is essential since the cli tool does not preserve the working directory between steps.'
+
         instructions = [
             "No user assistance. Do not run any interactive cli commands (eg. code, npm start, etc.).",
-            '**While running one or more cli commands, ALWAYS make sure that the first command is cd to the project directory.** This is essential since the cli tool does not preserve the working directory between steps.',
+            cli_instruction,
             'Always use the full path to read/write any file or directory.',
             "Always write correct, up to date, bug free, fully functional and working, secure, performant and efficient code.",
             'Before reading any file, check if it is already available in the Files section.',
             'Exclusively use the commands listed in double quotes e.g. "command name"',
         ]
+        if self.related_tests:
+            instructions.append("Test runs only run the tests related to the files written since the last passing run. Add --all to the test command for the full suite, e.g. 'CI=true npm test -- --all'.")
 
         reactjs_instructions = [
             f"Use 'cd {self.output_dir} && CI=true npx create-react-app <app-name>' to initialize the project, if required.",
@@ -152,7 +262,7 @@ class TddGPTPrompt(BaseChatPromptTemplate, BaseModel):
 
         performance_evaluation = [
             "Regularly assess progress through the Kanban board, critiquing the plan from each role's perspective.",
-            "Ensure the first CLI command is always the cd to the project directory.",
+            "Ensure the cli commands run in the project directory." if self.persistent_shell else "Ensure the first CLI command is always the cd to the project directory.",
             "Check for consistent use of full paths in file/directory operations.",
             "Check for any placeholders, comments or TODOs in the code."
             "Check if all tests are in passing state before project completion."
@@ -181,6 +291,16 @@ class TddGPTPrompt(BaseChatPromptTemplate, BaseModel):
         commands_str = "\n".join(f"{i+1}. {tool.name}: {tool.description}, args json schema: {json.dumps(tool.args)}" for i, tool in enumerate(tools))
         performance_evaluation_str = "\n".join(f"{i+1}. {item}" for i, item in enumerate(performance_evaluation))
 
+        if self.response_mode == "functions":
+            prompt_string = (
+                f"## General Instructions:\n{instructions_str}\n\n"
+                f"## Workflow:\n{workflow_str}\n\n"
+                f"## ReactJS Instructions:\n{reactjs_instructions_str}\n\n"
+                f"## Performance Evaluation:\n{performance_evaluation_str}\n\n"
+                f"## Response Format:\nRespond by calling exactly one of the functions, with your thoughts and the kanban board in its thoughts argument.\n\n"
+            )
+            return prompt_string
+
         prompt_string = (
             f"## General Instructions:\n{instructions_str}\n\n"
             f"## Workflow:\n{workflow_str}\n\n"
@@ -0,0 +1,499 @@
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+# Stop looking for the response object after this much leading prose
+MAX_PREAMBLE_CHARS = 4000
+
+# How far to look past a quote inside a string to decide whether it closes the string
+MAX_LOOKAHEAD_CHARS = 80
+
+INVALID_ESCAPE_PATTERN = re.compile(r'(?<!\\)\\(?!["\\/bfnrt]|u[0-9a-fA-F]{4})')
+NUMBER_PATTERN = re.compile(r"-?\d+(\.\d+)?([eE][+-]?\d+)?")
+# What can follow the closing quote of a value inside an object: the next key, with or without the comma
+NEXT_KEY_PATTERN = re.compile(r'\s*(,\s*(["\'][^"\'\\\n]{0,64}["\']|[A-Za-z_]\w{0,63})|["\'][^"\'\\\n]{0,64}["\'])\s*:')
+NEXT_KEY_PREFIX_PATTERN = re.compile(
+    r'\s*(,\s*(["\'][^"\'\\\n]{0,64}(["\']\s*)?|[A-Za-z_]\w{0,63}\s*)?|["\'][^"\'\\\n]{0,64}(["\']\s*)?)?'
+)
+BAREWORDS = {"true": "true", "false": "false", "null": "null", "True": "true", "False": "false", "None": "null"}
+CONTROL_ESCAPES = {"\n": "\\n", "\r": "\\r", "\t": "\\t", "\b": "\\b", "\f": "\\f"}
+
+THOUGHTS_DEFAULTS = {
+    "role": "",
+    "phase": "",
+    "tests_status": "",
+    "text": "",
+    "reasoning": "",
+    "criticism": "",
+}
+
+
+class ReplyParseError(ValueError):
+    """The assistant reply could not be turned into a valid response."""
+
+    def __init__(self, message: str, missing_key: Optional[str] = None):
+        super().__init__(message)
+        self.missing_key = missing_key
+
+
+class JSONRepairer:
+    """Single pass, incremental repair of the json object in an assistant reply.
+
+    Skips leading prose and code fences, escapes raw control characters and stray
+    backslashes inside strings, converts single quoted strings and Python literals,
+    quotes bare words, inserts missing commas and colons, drops trailing commas,
+    and treats a quote inside a string as literal text unless what follows it can
+    only continue the object. finish() closes whatever a truncated reply left open.
+
+    Chunks can be fed as they are streamed: feed() returns (key, value) events for
+    every top-level key as soon as its value is complete, and error is set as soon
+    as the output can no longer be repaired.
+    """
+
+    def __init__(self):
+        self.values: Dict[str, Any] = {}
+        self.truncated_keys: List[str] = []
+        self.error: Optional[str] = None
+        self.done = False
+        self.truncated = False
+        self.truncated_value = False
+        self.repaired = False
+        self._raw: List[str] = []
+        self._pos = 0
+        self._out: List[str] = []
+        self._events: List[Tuple[str, Any]] = []
+        self._started = False
+        # Stack of [container, state] where container is '{' or '['
+        self._stack: List[List[str]] = []
+        self._quote: Optional[str] = None
+        self._is_key = False
+        self._escape = False
+        # Hex digits read so far after a \u escape
+        self._unicode: Optional[List[str]] = None
+        self._pending: Optional[List[str]] = None
+        self._bareword: Optional[List[str]] = None
+        self._key: Optional[str] = None
+        self._key_start = 0
+        self._value_start = 0
+
+    @property
+    def text(self) -> str:
+        return "".join(self._raw)
+
+    @property
+    def json(self) -> str:
+        return "".join(self._out)
+
+    @property
+    def complete(self) -> bool:
+        """True once the object is closed or both the thoughts and the command are parsed."""
+        return self.done or ("thoughts" in self.values and "command" in self.values)
+
+    def result(self) -> str:
+        """Return the reply received so far, as json if it was cut short after the command."""
+        if not self.done and self.complete:
+            return json.dumps(self.values)
+        return self.text
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        self._raw.extend(chunk)
+        self._run()
+        return self._take_events()
+
+    def finish(self) -> List[Tuple[str, Any]]:
+        """Close everything a truncated reply left open."""
+        if self.done or self.error is not None:
+            return self._take_events()
+        if not self._started:
+            self.error = "No json object found"
+            return self._take_events()
+        complete_keys = set(self.values)
+        self.truncated = True
+        self.repaired = True
+        if self._pending is not None:
+            self._resolve_pending(close=True)
+        if self._quote is not None:
+            self.truncated_value = True
+            self._quote = None
+            self._end_unicode_escape()
+            self._end_string()
+        if self._bareword is not None:
+            self.truncated_value = self._stack[-1][1] != "key_bareword" and self._bareword[0].isalpha()
+            self._end_bareword()
+        while self._stack and self.error is None:
+            container, state = self._stack[-1]
+            if state == "colon":
+                self._out.append(":")
+                state = "value"
+            if state == "value" and container == "{":
+                self.truncated_value = True
+                self._out.append("null")
+                self._end_value()
+            self._drop_trailing_comma()
+            self._close()
+        self.truncated_keys = [key for key in self.values if key not in complete_keys]
+        return self._take_events()
+
+    def _take_events(self) -> List[Tuple[str, Any]]:
+        events, self._events = self._events, []
+        return events
+
+    def _run(self) -> None:
+        while self._pos < len(self._raw) and not self.done and self.error is None:
+            c = self._raw[self._pos]
+            self._pos += 1
+            self._consume(c)
+
+    def _fail(self, message: str) -> None:
+        self.error = f"{message} at position {self._pos - 1}"
+
+    def _consume(self, c: str) -> None:
+        if not self._started:
+            if c == "{":
+                self._started = True
+                self._out.append("{")
+                self._stack.append(["{", "key_or_end"])
+            elif self._pos > MAX_PREAMBLE_CHARS:
+                self._fail("No json object found")
+        elif self._pending is not None:
+            self._pending.append(c)
+            decision = self._decide_pending()
+            if decision is not None:
+                self._resolve_pending(decision)
+        elif self._quote is not None:
+            self._consume_string(c)
+        elif self._bareword is not None:
+            if c.isalnum() or c in "._+-":
+                self._bareword.append(c)
+                return
+            self._end_bareword()
+            if self.error is None:
+                self._consume_structural(c)
+        else:
+            self._consume_structural(c)
+
+    def _consume_string(self, c: str) -> None:
+        if self._unicode is not None:
+            if c in "0123456789abcdefABCDEF":
+                self._unicode.append(c)
+                if len(self._unicode) == 4:
+                    self._out.append("\\u" + "".join(self._unicode))
+                    self._unicode = None
+                return
+            self._end_unicode_escape()
+        if self._escape:
+            self._escape = False
+            if c == "u":
+                self._unicode = []
+            elif c in '"\\/bfnrt':
+                self._out.append("\\" + c)
+            elif c == "'":
+                self._out.append("'")
+            else:
+                self.repaired = True
+                self._out.append("\\\\" + CONTROL_ESCAPES.get(c, c))
+        elif c == "\\":
+            self._escape = True
+        elif c == self._quote:
+            self._pending = []
+        elif c == '"':
+            self._out.append('\\"')
+        elif c in CONTROL_ESCAPES or ord(c) < 0x20:
+            self._out.append(CONTROL_ESCAPES.get(c) or f"\\u{ord(c):04x}")
+        else:
+            self._out.append(c)
+
+    def _end_unicode_escape(self) -> None:
+        """Keep a \\u not followed by 4 hex digits, like C:\\users, as a literal backslash."""
+        if self._unicode is not None:
+            self.repaired = True
+            self._out.append("\\\\u" + "".join(self._unicode))
+            self._unicode = None
+
+    def _decide_pending(self) -> Optional[bool]:
+        """Decide whether the quote before the pending characters closed the string."""
+        lookahead = "".join(self._pending)
+        stripped = lookahead.lstrip()
+        if not stripped:
+            return None if len(lookahead) < MAX_LOOKAHEAD_CHARS else False
+        first = stripped[0]
+        if self._is_key:
+            return first == ":"
+        if first in "}]":
+            return True
+        if self._stack[-1][0] == "[":
+            if first != ",":
+                return False
+            rest = stripped[1:].lstrip()
+            if not rest:
+                return None if len(lookahead) < MAX_LOOKAHEAD_CHARS else False
+            return rest[0] in "\"'{[-]}" or rest[0].isalnum()
+        if first == "," and stripped[1:].lstrip()[:1] == "}":
+            return True
+        if NEXT_KEY_PATTERN.match(lookahead):
+            return True
+        if NEXT_KEY_PREFIX_PATTERN.fullmatch(lookahead) and len(lookahead) < MAX_LOOKAHEAD_CHARS:
+            return None
+        return False
+
+    def _resolve_pending(self, close: bool) -> None:
+        pending, self._pending = self._pending, None
+        if close:
+            self._quote = None
+            self._end_string()
+        else:
+            self.repaired = True
+            self._out.append('\\"' if self._quote == '"' else "'")
+        # Replay the lookahead now that the string state is known
+        self._pos -= len(pending)
+        end = self._pos + len(pending)
+        while self._pos < end and not self.done and self.error is None:
+            c = self._raw[self._pos]
+            self._pos += 1
+            self._consume(c)
+
+    def _end_string(self) -> None:
+        self._out.append('"')
+        if not self._is_key:
+            self._end_value()
+            return
+        self._is_key = False
+        self._stack[-1][1] = "colon"
+        if len(self._stack) == 1:
+            try:
+                self._key = json.loads("".join(self._out[self._key_start:]))
+            except json.JSONDecodeError as e:
+                self._fail(f"Invalid key: {e}")
+
+    def _end_bareword(self) -> None:
+        word = "".join(self._bareword)
+        self._bareword = None
+        frame = self._stack[-1]
+        if frame[1] == "key_bareword":
+            self.repaired = True
+            self._out.append(json.dumps(word))
+            frame[1] = "colon"
+            if len(self._stack) == 1:
+                self._key = word
+            return
+        if word in BAREWORDS:
+            self.repaired = self.repaired or BAREWORDS[word] != word
+            self._out.append(BAREWORDS[word])
+        elif NUMBER_PATTERN.fullmatch(word):
+            self._out.append(word)
+        else:
+            self.repaired = True
+            self._out.append(json.dumps(word))
+        self._end_value()
+
+    def _end_value(self) -> None:
+        self._stack[-1][1] = "comma_or_end"
+        if len(self._stack) == 1:
+            self._emit()
+
+    def _start_string(self, quote: str, is_key: bool) -> None:
+        if quote == "'":
+            self.repaired = True
+        self._quote = quote
+        self._is_key = is_key
+        if is_key and len(self._stack) == 1:
+            self._key_start = len(self._out)
+        self._out.append('"')
+
+    def _drop_trailing_comma(self) -> None:
+        while self._out and self._out[-1].isspace():
+            self._out.pop()
+        if self._out and self._out[-1] == ",":
+            self.repaired = True
+            self._out.pop()
+
+    def _consume_structural(self, c: str) -> None:
+        if c.isspace():
+            self._out.append(c)
+            return
+        frame = self._stack[-1]
+        container, state = frame
+
+        if state == "colon":
+            if c == ":":
+                self._out.append(":")
+                frame[1] = "value"
+                return
+            # Missing colon
+            self.repaired = True
+            self._out.append(":")
+            state = frame[1] = "value"
+
+        if state == "comma_or_end":
+            if c == ",":
+                self._out.append(",")
+                frame[1] = "key" if container == "{" else "value"
+            elif (c == "}" and container == "{") or (c == "]" and container == "["):
+                self._close()
+            elif c in "}]":
+                self._fail(f"Unexpected {c!r}")
+            else:
+                # Missing comma
+                self.repaired = True
+                self._out.append(",")
+                frame[1] = "key" if container == "{" else "value"
+                self._consume_structural(c)
+            return
+
+        if state in ("key_or_end", "key"):
+            if c in "\"'":
+                self._start_string(c, is_key=True)
+            elif c == "}":
+                self._drop_trailing_comma()
+                self._close()
+            elif c.isalpha() or c == "_":
+                if len(self._stack) == 1:
+                    self._key_start = len(self._out)
+                frame[1] = "key_bareword"
+                self._bareword = [c]
+            else:
+                self._fail("Expected a key")
+            return
+
+        # state is "value" or "value_or_end"
+        if c == "]" and container == "[":
+            self._drop_trailing_comma()
+            self._close()
+            return
+        if len(self._stack) == 1:
+            self._value_start = len(self._out)
+        if c in "\"'":
+            self._start_string(c, is_key=False)
+        elif c in "{[":
+            frame[1] = "comma_or_end"
+            self._out.append(c)
+            self._stack.append([c, "key_or_end" if c == "{" else "value_or_end"])
+        elif c.isalnum() or c in "-_":
+            self._bareword = [c]
+        else:
+            self._fail(f"Unexpected {c!r}")
+
+    def _close(self) -> None:
+        container, _ = self._stack.pop()
+        self._out.append("}" if container == "{" else "]")
+        if not self._stack:
+            self.done = True
+        else:
+            self._end_value()
+
+    def _emit(self) -> None:
+        try:
+            value = json.loads("".join(self._out[self._value_start:]))
+        except json.JSONDecodeError as e:
+            self._fail(f"Invalid value for '{self._key}': {e}")
+            return
+        self.values[self._key] = value
+        self._events.append((self._key, value))
+
+
+def legacy_loads(text: str) -> Any:
+    """Parse the reply the way the agent used to: the outermost braces, then escaped backslashes."""
+    start_index = text.find('{')
+    end_index = text.rfind('}')
+    if start_index != -1 and end_index != -1 and start_index < end_index:
+        text = text[start_index:end_index + 1]
+    text = text.strip()
+    try:
+        return json.loads(text, strict=False)
+    except json.JSONDecodeError:
+        return json.loads(INVALID_ESCAPE_PATTERN.sub(r"\\\\", text), strict=False)
+
+
+def missing_key(parsed: Any) -> Optional[str]:
+    """Return the first key of the response format missing from parsed, if any."""
+    if not isinstance(parsed, dict):
+        return "thoughts"
+    thoughts = parsed.get("thoughts")
+    if not isinstance(thoughts, dict):
+        return "thoughts"
+    for key in THOUGHTS_DEFAULTS:
+        if key not in thoughts:
+            return key
+    kanban = thoughts.get("kanban")
+    if not isinstance(kanban, dict):
+        return "kanban"
+    for key in ("todo", "in_progress", "done"):
+        if key not in kanban:
+            return key
+    command = parsed.get("command")
+    if not isinstance(command, dict):
+        return "command"
+    for key in ("name", "args"):
+        if key not in command:
+            return key
+    return None
+
+
+class ReplyParser:
+    """Turns assistant replies into responses, repairing them instead of asking the model again.
+
+    Well formed replies take the fast path through json.loads. Anything else goes
+    through a single JSONRepairer pass, and missing thoughts keys are filled with
+    defaults. stats counts the replies that would have cost the agent an extra
+    "not a valid json" or "missing key" round trip before.
+    """
+
+    def __init__(self):
+        self.stats = {"replies": 0, "repaired": 0, "defaults_filled": 0, "failed": 0, "retries_saved": 0}
+
+    def parse(self, text: str, repairer: Optional[JSONRepairer] = None) -> dict:
+        """Parse a reply. repairer may hold a reply that was already fed while streaming."""
+        self.stats["replies"] += 1
+        try:
+            parsed = legacy_loads(text)
+            legacy_ok = missing_key(parsed) is None
+        except json.JSONDecodeError:
+            parsed, legacy_ok = None, False
+        if legacy_ok:
+            return parsed
+
+        if parsed is None:
+            if repairer is None:
+                repairer = JSONRepairer()
+                repairer.feed(text)
+            repairer.finish()
+            if repairer.error is not None:
+                self.stats["failed"] += 1
+                raise ReplyParseError(f"The response is not a valid json: {repairer.error}")
+            parsed = repairer.values
+            if "command" in repairer.truncated_keys and repairer.truncated_value:
+                self.stats["failed"] += 1
+                raise ReplyParseError("The response was cut off before the command was complete")
+            self.stats["repaired"] += 1
+
+        parsed = self.fill_defaults(parsed)
+        key = missing_key(parsed)
+        if key is not None:
+            self.stats["failed"] += 1
+            raise ReplyParseError(f"The response is missing the key '{key}'", missing_key=key)
+        self.stats["retries_saved"] += 1
+        return parsed
+
+    def fill_defaults(self, parsed: Any) -> Any:
+        """Fill the optional parts of the response format; the command itself is never guessed."""
+        if not isinstance(parsed, dict) or not isinstance(parsed.get("thoughts"), dict):
+            return parsed
+        thoughts = parsed["thoughts"]
+        filled = False
+        for key, default in THOUGHTS_DEFAULTS.items():
+            if key not in thoughts:
+                thoughts[key] = default
+                filled = True
+        kanban = thoughts.setdefault("kanban", {})
+        if isinstance(kanban, dict):
+            for key, default in (("todo", []), ("in_progress", ""), ("done", [])):
+                if key not in kanban:
+                    kanban[key] = default
+                    filled = True
+        command = parsed.get("command")
+        if isinstance(command, dict) and "name" in command and "args" not in command:
+            command["args"] = {}
+            filled = True
+        if filled:
+            self.stats["defaults_filled"] += 1
+        return parsed
@@ -0,0 +1,142 @@
+import fnmatch
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Union
+
+from cli import DEFAULT_MAX_OUTPUT_BYTES, run_command_with_timeout
+from test_runner import JEST_COMMAND_PATTERN, PYTEST_COMMAND_PATTERN
+
+# Directories and files written by the tools themselves rather than by the agent, the
+# test runs included, so that a run writing its snapshots or coverage keeps its result
+SKIP_DIRS = {
+    "node_modules", ".git", "coverage", "__pycache__", ".pytest_cache", ".cache", "build", "dist", "venv", ".venv",
+    "__snapshots__", "htmlcov", ".nyc_output", "test-results", ".mypy_cache", ".tox",
+}
+SKIP_FILES = [".coverage", ".coverage.*", "coverage.xml", "junit.xml", "*.pyc"]
+
+
+def workspace_fingerprint(root: str) -> str:
+    """Hash of the paths, sizes and modification times of the files under root."""
+    h = hashlib.blake2b(digest_size=16)
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if d not in SKIP_DIRS)
+        for name in sorted(files):
+            if any(fnmatch.fnmatch(name, pattern) for pattern in SKIP_FILES):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            h.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+
+def is_test_command(command: str) -> bool:
+    return bool(JEST_COMMAND_PATTERN.search(command) or PYTEST_COMMAND_PATTERN.search(command))
+
+
+class SpeculativeRun:
+    def __init__(self, command: str, fingerprint: str):
+        self.command = command
+        self.fingerprint = fingerprint
+        self.cancel = threading.Event()
+        self.related: List[str] = []
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+        self.future: Optional[Future] = None
+
+
+class TestSpeculator:
+    """Runs the last test command in the background as soon as a file is written.
+
+    The agent calls start() after each write_file step, so the tests run while
+    the next reply is generated. When the cli tool is then asked for the same
+    test command, claim() returns the speculative result, waiting for it if it
+    is still running, provided the files under root did not change since it
+    started. Any other command, or a changed workspace, cancels the run.
+
+    Speculative runs use a new shell in the directory and with the exported
+    variables of the session, if any, so they do not hold the session while the
+    agent uses it.
+    """
+
+    __test__ = False
+
+    def __init__(
+        self,
+        root: str,
+        session: Optional[Any] = None,
+        test_runner: Optional[Any] = None,
+        timeout_sec: int = 60,
+        max_output_bytes: int = DEFAULT_MAX_OUTPUT_BYTES,
+    ):
+        self.root = os.path.abspath(root)
+        self.session = session
+        self.test_runner = test_runner
+        self.timeout_sec = timeout_sec
+        self.max_output_bytes = max_output_bytes
+        self.test_command: Optional[str] = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="speculative-tests")
+        self._pending: Optional[SpeculativeRun] = None
+        self.stats = {"started": 0, "hits": 0, "misses": 0, "cancelled": 0, "seconds_saved": 0.0}
+
+    @property
+    def hit_rate(self) -> float:
+        return self.stats["hits"] / self.stats["started"] if self.stats["started"] else 0.0
+
+    def start(self) -> bool:
+        """Start running the last test command, if the agent ran one already."""
+        self.cancel()
+        if self.test_command is None:
+            return False
+        run = SpeculativeRun(self.test_command, workspace_fingerprint(self.root))
+        command = run.command
+        if self.test_runner is not None:
+            command, run.related = self.test_runner.rewrite(command)
+        cwd, env = (self.session.cwd, self.session.environment()) if self.session is not None else (None, None)
+        run.future = self.executor.submit(self._execute, run, command, cwd, env)
+        self._pending = run
+        self.stats["started"] += 1
+        return True
+
+    def _execute(self, run: SpeculativeRun, command: str, cwd: Optional[str], env: Optional[Dict[str, str]]) -> str:
+        output = run_command_with_timeout(command, self.timeout_sec, self.max_output_bytes, cwd=cwd, cancel=run.cancel, env=env)
+        run.finished = time.perf_counter()
+        return output
+
+    def cancel(self) -> None:
+        run, self._pending = self._pending, None
+        if run is not None:
+            run.cancel.set()
+            self.stats["cancelled"] += 1
+
+    def claim(self, commands: Union[str, List[str]]) -> Optional[str]:
+        """Return the speculative output for commands, or None when they have to be run."""
+        command = " && ".join(commands) if isinstance(commands, list) else commands
+        if is_test_command(command):
+            self.test_command = command
+        run = self._pending
+        if run is None:
+            return None
+        claimed = time.perf_counter()
+        if command != run.command or workspace_fingerprint(self.root) != run.fingerprint:
+            self.cancel()
+            self.stats["misses"] += 1
+            return None
+
+        self._pending = None
+        output = run.future.result()
+        waited = time.perf_counter() - claimed
+        self.stats["hits"] += 1
+        self.stats["seconds_saved"] += max(0.0, run.finished - run.started - waited)
+        if self.test_runner is not None:
+            self.test_runner.record(run.related, output)
+        return output
+
+    def close(self) -> None:
+        self.cancel()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,66 @@
+import json
+from typing import Callable, Collection, List, Optional, Tuple
+
+from langchain.schema import Document
+
+from file_index import parse_metadata
+
+# Characters of the failing test output used in the query
+QUERY_OUTPUT_CHARS = 2000
+# Candidates fetched per selected record, as the earlier runs of the last action rank first
+FETCH_FACTOR = 4
+
+
+def past_step_query(in_progress: str, failing_output: str) -> str:
+    """Query the memory with the task in progress and the failing tests of the last step."""
+    return f"{in_progress}\n{failing_output[:QUERY_OUTPUT_CHARS]}".strip()
+
+
+def _action_file(step: dict) -> Optional[str]:
+    action = str(step.get("Action", ""))
+    for prefix in ("reading file ", "writing file "):
+        if action.startswith(prefix):
+            return action[len(prefix):]
+    return None
+
+
+def select_past_steps(
+    documents: List[Document],
+    budget: int,
+    token_counter: Callable[[str], int],
+    last_step: Optional[dict] = None,
+    files: Collection[str] = (),
+    limit: Optional[int] = None,
+) -> Tuple[List[str], int]:
+    """Fit the retrieved step records, most relevant first, into the token budget.
+
+    The last step, which the prompt already shows, earlier runs of its action, whose
+    output it supersedes, and repeated records are dropped, and so is the code of the
+    records of files the Files section holds. Records are told apart by their content,
+    as a memory reused across runs holds several records of the same step number. At most limit records are kept. Returns
+    the records in step order and their token count.
+    """
+    last_step = last_step or {}
+    selected = []
+    seen = set()
+    used = 0
+    for document in documents:
+        if limit is not None and len(selected) >= limit:
+            break
+        step = parse_metadata(document.page_content)
+        identity = json.dumps(step, sort_keys=True)
+        if not step or step == last_step or identity in seen:
+            continue
+        if "Action" in step and step["Action"] == last_step.get("Action"):
+            continue
+        seen.add(identity)
+        record = document.page_content
+        if _action_file(step) in files and "Result" in step:
+            step["Result"] = "(see the Files section)"
+            record = f"```json\n{json.dumps(step, indent=4)}\n```"
+        tokens = token_counter(record)
+        if used + tokens > budget:
+            continue
+        selected.append((step.get("step") or 0, record))
+        used += tokens
+    return [record for _, record in sorted(selected, key=lambda item: item[0])], used
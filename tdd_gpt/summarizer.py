@@ -1,13 +1,98 @@
 from langchain.prompts import PromptTemplate
 from langchain.chat_models import ChatOpenAI
+from langchain.chat_models.base import BaseChatModel
 from langchain.schema.document import Document
 from langchain.chains import MapReduceDocumentsChain, ReduceDocumentsChain
 from langchain.chains.mapreduce import MapReduceChain
 from langchain.text_splitter import CharacterTextSplitter
 from langchain.chains import StuffDocumentsChain, LLMChain
+from typing import Callable, List, Optional, Tuple
+import asyncio
+from summary_cache import SummaryCache
+from llm_cache import LLMCache, RecordReplayChatModel
+import tracing
+import re
 import textwrap
 
+ERROR_LINE_PATTERN = re.compile(
+    r"error|fail|exception|traceback|fatal|panic|cannot|can't|not found|no such|denied|invalid|"
+    r"undefined|unexpected|refused|timed out|ERR!|✖|×",
+    re.IGNORECASE,
+)
+MAX_LINE_CHARS = 500
+# Digits, hex ids and paths that change between otherwise repeated lines
+VOLATILE_PATTERN = re.compile(r"0x[0-9a-f]+|\d+(\.\d+)*")
+
+
+def line_key(line: str) -> str:
+    return VOLATILE_PATTERN.sub("#", line.strip())
+
+
+def extract_summary(
+    text: str,
+    token_counter: Callable[[str], int],
+    max_tokens: int = 600,
+    head_lines: int = 10,
+    tail_lines: int = 20,
+) -> str:
+    """Local extractive summary of a command output.
+
+    Keeps the exit status line, the lines that carry an error, and a head and tail
+    window, collapses repeated lines, and marks the lines that were left out.
+    """
+    lines = []
+    counts = {}
+    for line in text.rstrip().split("\n"):
+        if len(line) > MAX_LINE_CHARS:
+            line = line[:MAX_LINE_CHARS] + "..."
+        key = line_key(line)
+        if key and key in counts:
+            counts[key] += 1
+            continue
+        counts[key] = 1
+        lines.append(line)
+
+    # Lines in order of priority: status, tail, head, then errors
+    first_tail = max(len(lines) - tail_lines, 0)
+    priority = [0] + list(range(len(lines) - 1, first_tail - 1, -1)) + list(range(1, min(head_lines, len(lines))))
+    priority += [i for i, line in enumerate(lines) if ERROR_LINE_PATTERN.search(line)]
+
+    kept = set()
+    tokens = 0
+    for i in priority:
+        if i in kept:
+            continue
+        line_tokens = token_counter(lines[i]) + 1
+        if tokens + line_tokens > max_tokens and kept:
+            continue
+        kept.add(i)
+        tokens += line_tokens
+
+    summary: List[str] = []
+    previous = -1
+    for i in sorted(kept):
+        if i > previous + 1:
+            summary.append(f"... ({i - previous - 1} lines omitted)")
+        repeats = counts[line_key(lines[i])]
+        summary.append(f"{lines[i]} (repeated {repeats} times)" if repeats > 1 else lines[i])
+        previous = i
+    if previous < len(lines) - 1:
+        summary.append(f"... ({len(lines) - previous - 1} lines omitted)")
+    return "\n".join(summary)
+
+
 class TextSummarizer:
+    """Summarize text by size.
+
+    Texts up to passthrough_tokens are returned verbatim, texts up to
+    extractive_tokens get a local extractive summary of at most extract_tokens,
+    and only larger texts go through the LLM map-reduce chain, unless the cache
+    already has their summary. The map step summarizes the chunks concurrently,
+    up to max_concurrency at a time, and the reduce step is streamed.
+    """
+
+    TIERS = ("passthrough", "extractive", "cached", "map_reduce")
+
     CLI_TEMPLATE = textwrap.dedent("""
             Summarize the output like 'The commands <succeeded/failed> with the message <output summary>'.
             """)
@@ -17,22 +102,51 @@ class TextSummarizer:
             Ignore any suggestions, warnings, security vulnerabilities, dependency/audit issues. 
             Start with '- I successfully executed the <command> ' """)
 
-    def __init__(self, summary_type: str):
-        llm = ChatOpenAI(temperature=0.2, model_name="gpt-3.5-turbo-16k")
+    def __init__(
+        self,
+        summary_type: str,
+        token_counter: Optional[Callable[[str], int]] = None,
+        llm: Optional[BaseChatModel] = None,
+        passthrough_tokens: int = 300,
+        extractive_tokens: int = 6000,
+        extract_tokens: int = 600,
+        cache: Optional[SummaryCache] = None,
+        max_concurrency: int = 8,
+        chunk_tokens: int = 1000,
+        llm_cache: Optional[LLMCache] = None,
+    ):
+        default_llm = llm is None
+        llm = llm or ChatOpenAI(temperature=0.2, model_name="gpt-3.5-turbo-16k")
+        if llm_cache is not None:
+            llm = RecordReplayChatModel(llm=llm, llm_cache=llm_cache)
+        if default_llm:
+            # On the outermost model, the cache wrapper calls the one it wraps directly
+            llm.callbacks = tracing.callbacks()
+        self.llm = llm
+        self.token_counter = token_counter
+        self.passthrough_tokens = passthrough_tokens
+        self.extractive_tokens = extractive_tokens
+        self.extract_tokens = extract_tokens
+        self.summary_type = summary_type
+        self.cache = cache
+        self.max_concurrency = max_concurrency
+        self.chunk_tokens = chunk_tokens
+        self.stats = {tier: 0 for tier in self.TIERS}
+        self._text_splitter = None
 
         # Define the prompt based on the summary_type
         prompt_template = self.get_prompt_template(summary_type)
 
         # MapReduce chain for longer texts
-        map_prompt = PromptTemplate.from_template(prompt_template.replace("{text}", "{docs}"))
-        map_chain = LLMChain(llm=llm, prompt=map_prompt)
+        self.map_prompt = PromptTemplate.from_template(prompt_template.replace("{text}", "{docs}"))
+        self.map_chain = LLMChain(llm=llm, prompt=self.map_prompt)
 
         reduce_template = self.get_reduce_template(summary_type)
-        reduce_prompt = PromptTemplate.from_template(reduce_template)
-        reduce_chain = LLMChain(llm=llm, prompt=reduce_prompt)
+        self.reduce_prompt = PromptTemplate.from_template(reduce_template)
+        self.reduce_chain = LLMChain(llm=llm, prompt=self.reduce_prompt)
 
         combine_documents_chain = StuffDocumentsChain(
-            llm_chain=reduce_chain, document_variable_name="doc_summaries"
+            llm_chain=self.reduce_chain, document_variable_name="doc_summaries"
         )
 
         self.reduce_documents_chain = ReduceDocumentsChain(
@@ -42,7 +156,7 @@ class TextSummarizer:
         )
 
         self.map_reduce_chain = MapReduceDocumentsChain(
-            llm_chain=map_chain,
+            llm_chain=self.map_chain,
             reduce_documents_chain=self.reduce_documents_chain,
             document_variable_name="docs",
             return_intermediate_steps=False,
@@ -88,10 +202,126 @@ class TextSummarizer:
         else:
             raise ValueError("Invalid summary type")
 
+    def count_tokens(self, text: str) -> int:
+        if self.token_counter:
+            return self.token_counter(text)
+        return len(text) // 4
+
+    def tier(self, text: str) -> str:
+        tokens = self.count_tokens(text)
+        if tokens <= self.passthrough_tokens:
+            return "passthrough"
+        if tokens <= self.extractive_tokens:
+            return "extractive"
+        return "map_reduce"
+
+    @property
+    def text_splitter(self) -> CharacterTextSplitter:
+        """Splitter for the map step, built on first use and shared by every call."""
+        if self._text_splitter is None:
+            if self.token_counter:
+                self._text_splitter = CharacterTextSplitter(
+                    separator="\n", chunk_size=self.chunk_tokens, chunk_overlap=0, length_function=self.token_counter
+                )
+            else:
+                self._text_splitter = CharacterTextSplitter.from_tiktoken_encoder(
+                    separator="\n", chunk_size=self.chunk_tokens, chunk_overlap=0
+                )
+        return self._text_splitter
+
+    def split(self, text: str) -> List[Document]:
+        return self.text_splitter.split_documents([Document(page_content=text)])
+
     def summarize(self, text: str, token_max: int = 4000) -> str:
-        docs = [Document(page_content=text)]
-        text_splitter = CharacterTextSplitter.from_tiktoken_encoder(chunk_size=1000, chunk_overlap=0)
-        split_docs = text_splitter.split_documents(docs)
+        return self.summarize_tiered(text, token_max)[0]
+
+    def _summarize_locally(self, text: str) -> Tuple[Optional[str], str]:
+        """Summary and tier of text, or no summary when it needs the map-reduce tier."""
+        tier = self.tier(text)
+        if tier == "passthrough":
+            return text, tier
+        if tier == "extractive":
+            return extract_summary(text, self.count_tokens, self.extract_tokens), tier
+        summary = self.cache.get(self.summary_type, text) if self.cache is not None else None
+        if summary is not None:
+            return summary, "cached"
+        return None, tier
+
+    def summarize_tiered(self, text: str, token_max: int = 4000) -> Tuple[str, str]:
+        """Summarize text with the cheapest tier that fits its size, returning the summary and the tier."""
+        with tracing.span("summarize", summary_type=self.summary_type, input_bytes=len(text)) as span:
+            summary, tier = self._summarize_locally(text)
+            if summary is None:
+                summary = self.map_reduce(text, token_max)
+                if self.cache is not None:
+                    self.cache.put(self.summary_type, text, summary)
+            self.stats[tier] += 1
+            span.set(tier=tier, output_bytes=len(summary))
+            return summary, tier
+
+    async def asummarize_tiered(
+        self, text: str, token_max: int = 4000, on_token: Optional[Callable[[str], None]] = None
+    ) -> Tuple[str, str]:
+        """Async summarize_tiered, passing the tokens of the final summary to on_token as they are generated."""
+        with tracing.span("summarize", summary_type=self.summary_type, input_bytes=len(text)) as span:
+            summary, tier = self._summarize_locally(text)
+            if summary is None:
+                summary = await self.amap_reduce(text, token_max, on_token)
+                if self.cache is not None:
+                    self.cache.put(self.summary_type, text, summary)
+            self.stats[tier] += 1
+            span.set(tier=tier, output_bytes=len(summary))
+            return summary, tier
+
+    def map_reduce(self, text: str, token_max: int = 4000) -> str:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.amap_reduce(text, token_max))
+        # Already inside an event loop, fall back to the sequential chain
         self.reduce_documents_chain.token_max = token_max
-        result = self.map_reduce_chain.run(split_docs)
-        return result
+        return self.map_reduce_chain.run(self.split(text))
+
+    async def amap_reduce(
+        self, text: str, token_max: int = 4000, on_token: Optional[Callable[[str], None]] = None
+    ) -> str:
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def predict(chain: LLMChain, **kwargs) -> str:
+            async with semaphore:
+                return await chain.apredict(**kwargs)
+
+        chunks = [doc.page_content for doc in self.split(text)]
+        if len(chunks) == 1:
+            return await self._astream(self.map_prompt.format(docs=chunks[0]), on_token)
+
+        summaries = await asyncio.gather(*(predict(self.map_chain, docs=chunk) for chunk in chunks))
+        # Collapse the summaries until they fit in a single reduce call
+        while len(summaries) > 1 and self.count_tokens("\n\n".join(summaries)) > token_max:
+            groups = self._group(summaries, token_max)
+            if len(groups) == len(summaries):
+                break
+            summaries = await asyncio.gather(
+                *(predict(self.reduce_chain, doc_summaries="\n\n".join(group)) for group in groups)
+            )
+        return await self._astream(self.reduce_prompt.format(doc_summaries="\n\n".join(summaries)), on_token)
+
+    def _group(self, summaries: List[str], token_max: int) -> List[List[str]]:
+        groups: List[List[str]] = [[]]
+        tokens = 0
+        for summary in summaries:
+            summary_tokens = self.count_tokens(summary)
+            if groups[-1] and tokens + summary_tokens > token_max:
+                groups.append([])
+                tokens = 0
+            groups[-1].append(summary)
+            tokens += summary_tokens
+        return groups
+
+    async def _astream(self, prompt: str, on_token: Optional[Callable[[str], None]] = None) -> str:
+        parts = []
+        async for chunk in self.llm.astream(prompt):
+            parts.append(chunk.content)
+            if on_token is not None:
+                on_token(chunk.content)
+        return "".join(parts)
@@ -0,0 +1,143 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+# Parts of a command output that change between runs without changing its meaning:
+# colors, then timestamps, times and durations, temporary paths, hashes and PIDs.
+# Each pattern is a single pass over the output, so they are kept few and cheap.
+NORMALIZE_PATTERNS = [
+    (re.compile(r"\x1b\[[0-9;?]*[A-Za-z]"), ""),
+    (re.compile(
+        r"\b\d(?:\d{3}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(?:\.\d+)?(?:Z|[+-]\d{2}:?\d{2})?"
+        r"|\d?:\d{2}:\d{2}(?:\.\d+)?\b"
+        # A duration is a whole number, not the end of a version, then its unit as a whole word
+        r"|(?<!\.\d)\d*(?:\.\d+)? ?(?:ms|s|sec|secs|seconds|m|min|minutes)\b)"
+    ), "<time>"),
+    (re.compile(r"(?:/tmp|/var/folders|/private/var/folders|/var/tmp)/[^\s'\":]*"), "<tmp>"),
+    # A hash has both letters and digits, so counts and words like "defaced" are kept
+    (re.compile(r"\b(?:(?=[0-9a-f]*[a-f])(?=[0-9a-f]*\d)[0-9a-f]{7,64}|(?:pid|PID|process)\s*[:=]?\s*\d+)\b"), "<id>"),
+]
+
+# Number of recent outputs whose normalized key is remembered
+MAX_RECENT_KEYS = 1024
+
+
+def normalize_output(text: str) -> str:
+    """Strip timings, temporary paths, PIDs and hashes from a command output."""
+    for pattern, replacement in NORMALIZE_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text.strip()
+
+
+def digest(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def output_key(text: str) -> str:
+    return digest(normalize_output(text))
+
+
+class SummaryCache:
+    """On-disk cache of summaries, keyed by the normalized hash of the summarized text.
+
+    Entries are namespaced by summary type. When the summaries take more than
+    max_bytes, the least recently used ones are evicted. The normalized keys of
+    recent outputs are remembered by their exact hash, so an output seen again
+    in the same run is not normalized again. Hits only update the recency in
+    the open transaction, which is committed with the next put or on close(),
+    so lookups do not wait for the disk.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._recent_keys: "OrderedDict[str, str]" = OrderedDict()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS summaries ("
+            " namespace TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " summary TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS summaries_last_used ON summaries (last_used)")
+        self._conn.commit()
+
+    def key(self, text: str) -> str:
+        exact = digest(text)
+        with self._lock:
+            key = self._recent_keys.get(exact)
+            if key is not None:
+                self._recent_keys.move_to_end(exact)
+                return key
+        key = output_key(text)
+        with self._lock:
+            self._recent_keys[exact] = key
+            if len(self._recent_keys) > MAX_RECENT_KEYS:
+                self._recent_keys.popitem(last=False)
+        return key
+
+    def get(self, namespace: str, text: str) -> Optional[str]:
+        key = self.key(text)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT summary FROM summaries WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE summaries SET last_used = ? WHERE namespace = ? AND key = ?", (time.time(), namespace, key)
+            )
+            return row[0]
+
+    def put(self, namespace: str, text: str, summary: str) -> None:
+        now = time.time()
+        key = self.key(text)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO summaries (namespace, key, summary, size, created, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (namespace, key, summary, len(summary.encode("utf-8")), now, now),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM summaries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute("SELECT namespace, key, size FROM summaries ORDER BY last_used").fetchall()
+        evicted = []
+        for namespace, key, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((namespace, key))
+            total -= size
+        self._conn.executemany("DELETE FROM summaries WHERE namespace = ? AND key = ?", evicted)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0, "entries": len(self)}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
@@ -0,0 +1,153 @@
+import json
+import os
+import re
+import shlex
+from typing import List, Optional, Set, Tuple, Union
+
+from cli import DEFAULT_MAX_OUTPUT_BYTES, ShellSession
+
+# Start of a command: the start of the line or a shell operator, then any VAR=value assignments
+COMMAND_START = r"(?:^|&&|\|\||[;|(])\s*(?:[A-Za-z_]\w*=\S*\s+)*"
+# The end of the program name, so that test:e2e scripts and jest.config.js do not match
+COMMAND_END = r"(?=\s|$|[;&|)])"
+JEST_COMMAND_PATTERN = re.compile(rf"{COMMAND_START}(?P<command>(?P<runner>npm|yarn|pnpm)(?: run)? test|(?:(?:npx|yarn|pnpm) )?jest){COMMAND_END}")
+PYTEST_COMMAND_PATTERN = re.compile(rf"{COMMAND_START}(?P<command>(?:python3? -m )?pytest){COMMAND_END}")
+SEPARATOR_PATTERN = re.compile(r"(?:^|\s)--(?=\s|$)")
+CD_PATTERN = re.compile(r"(?:^|&&|;)\s*cd\s+(\"[^\"]+\"|'[^']+'|[^\s&;|]+)")
+JEST_SCRIPT_PATTERN = re.compile(r"\bjest\b|\breact-scripts test\b|\bcraco test\b")
+JS_SOURCE_PATTERN = re.compile(r"\.(js|jsx|ts|tsx|mjs|cjs)$")
+FULL_RUN_FLAG = "--all"
+
+
+class TestRunner:
+    """Runs the test commands of the cli tool in a warm shell session.
+
+    Files written by the agent are reported with notify_changed(). A jest or
+    pytest run then only runs the tests related to the files changed since the
+    last passing run, through jest --findRelatedTests or by selecting the
+    matching pytest files. --all in the command asks for the full suite, as
+    does a run with no changed files. The output is returned as the cli tool
+    returns it, so it goes through the same parsing as any test run.
+    """
+
+    __test__ = False
+
+    def __init__(self, session: Optional[ShellSession] = None, cwd: Optional[str] = None):
+        self.session = session or ShellSession(cwd=cwd)
+        self.changed: Set[str] = set()
+        self.last_run_related: List[str] = []
+        self.stats = {"related_runs": 0, "full_runs": 0}
+
+    def notify_changed(self, file_path: str) -> None:
+        self.changed.add(os.path.abspath(file_path))
+
+    def handles(self, commands: Union[str, List[str]]) -> bool:
+        command = " && ".join(commands) if isinstance(commands, list) else commands
+        return bool(JEST_COMMAND_PATTERN.search(command) or PYTEST_COMMAND_PATTERN.search(command))
+
+    def _project_dir(self, command: str, end: int) -> str:
+        """Directory the test command runs in: the last cd before it, or the session directory."""
+        project_dir = self.session.cwd
+        for match in CD_PATTERN.finditer(command[:end]):
+            target = os.path.expanduser(match.group(1).strip("\"'"))
+            project_dir = os.path.normpath(os.path.join(project_dir, target))
+        return project_dir
+
+    def _is_jest_project(self, project_dir: str, invocation: str) -> bool:
+        if re.search(r"\bjest\b", invocation):
+            return True
+        try:
+            with open(os.path.join(project_dir, "package.json"), encoding="utf-8") as f:
+                script = json.load(f).get("scripts", {}).get("test", "")
+        except (OSError, ValueError):
+            return False
+        return bool(JEST_SCRIPT_PATTERN.search(script))
+
+    def _related_files(self, project_dir: str, pattern: re.Pattern) -> List[str]:
+        return sorted(
+            path for path in self.changed
+            if path.startswith(project_dir + os.sep) and pattern.search(path)
+            and "node_modules" not in path and os.path.exists(path)
+        )
+
+    def _related_pytest_files(self, project_dir: str) -> List[str]:
+        """Changed test files, and the test files named after changed modules."""
+        selected = set()
+        for path in self._related_files(project_dir, re.compile(r"\.py$")):
+            name = os.path.basename(path)
+            if name.startswith("test_") or name.endswith("_test.py"):
+                selected.add(path)
+                continue
+            module = name[:-3]
+            for root, dirs, files in os.walk(project_dir):
+                dirs[:] = [d for d in dirs if not d.startswith(".") and d not in ("venv", "node_modules", "__pycache__")]
+                for test_file in (f"test_{module}.py", f"{module}_test.py"):
+                    if test_file in files:
+                        selected.add(os.path.join(root, test_file))
+        return sorted(selected)
+
+    def rewrite(self, command: str) -> Tuple[str, List[str]]:
+        """Limit the test command to the related tests, returning it with the files it was limited to."""
+        if FULL_RUN_FLAG in command.split():
+            if PYTEST_COMMAND_PATTERN.search(command):
+                command = re.sub(rf"\s{FULL_RUN_FLAG}(?=\s|$)", "", command)
+            return command, []
+
+        jest = JEST_COMMAND_PATTERN.search(command)
+        if jest:
+            project_dir = self._project_dir(command, jest.start("command"))
+            related = self._related_files(project_dir, JS_SOURCE_PATTERN)
+            if not related or not self._is_jest_project(project_dir, jest.group("command")):
+                return command, []
+            end = self._argument_end(command, jest.end("command"))
+            arguments = command[jest.end("command"):end].split()
+            if any(argument.startswith("--findRelatedTests") for argument in arguments):
+                # The agent chose the tests itself
+                return command, []
+            flags = []
+            # Arguments go after the -- of npm test, jest takes them directly
+            if jest.group("runner") and not SEPARATOR_PATTERN.search(command[jest.end("command"):end]):
+                flags.append("--")
+            if not any(argument.split("=")[0] in ("--watch", "--watchAll") for argument in arguments):
+                flags.append("--watchAll=false")
+            flags.append("--findRelatedTests")
+            flags.extend(shlex.quote(path) for path in related)
+            return command[:end] + " " + " ".join(flags) + command[end:], related
+
+        pytest = PYTEST_COMMAND_PATTERN.search(command)
+        if pytest:
+            project_dir = self._project_dir(command, pytest.start("command"))
+            related = self._related_pytest_files(project_dir)
+            if not related:
+                return command, []
+            end = self._argument_end(command, pytest.end("command"))
+            return command[:end] + " " + " ".join(shlex.quote(path) for path in related) + command[end:], related
+
+        return command, []
+
+    @staticmethod
+    def _argument_end(command: str, start: int) -> int:
+        """End of the arguments of the command starting before start."""
+        match = re.compile(r"&&|\|\||;|\|").search(command, start)
+        end = match.start() if match else len(command)
+        while end > start and command[end - 1].isspace():
+            end -= 1
+        return end
+
+    def record(self, related: List[str], output: str) -> None:
+        """Account for a run of a command returned by rewrite()."""
+        self.last_run_related = related
+        self.stats["related_runs" if related else "full_runs"] += 1
+        if " succeeded with the following output:" in output.split("\n", 1)[0]:
+            # Everything changed so far is covered by a passing run
+            self.changed.clear()
+
+    def run(self, commands: Union[str, List[str]], timeout_sec: int, max_output_bytes: int = DEFAULT_MAX_OUTPUT_BYTES) -> str:
+        command = " && ".join(commands) if isinstance(commands, list) else commands
+        command, related = self.rewrite(command)
+        output = self.session.run(command, timeout_sec, max_output_bytes)
+        self.record(related, output)
+        return output
+
+    def close(self) -> None:
+        self.session.close()
@@ -0,0 +1,52 @@
+import hashlib
+from collections import OrderedDict
+from typing import Callable, Dict
+
+
+class TokenCounterCache:
+    """Bounded LRU cache in front of a token counter, keyed by a hash of the text.
+
+    The same file contents, step metadata and CLI outputs are counted many times
+    over a run, so a single instance is shared by the prompt and the summarizer.
+    """
+
+    def __init__(self, token_counter: Callable[[str], int], maxsize: int = 4096):
+        self.token_counter = token_counter
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache: "OrderedDict[bytes, int]" = OrderedDict()
+
+    def __call__(self, text: str) -> int:
+        key = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        count = self._cache.get(key)
+        if count is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return count
+
+        self.misses += 1
+        count = self.token_counter(text)
+        self._cache[key] = count
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return count
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "size": len(self._cache),
+            "maxsize": self.maxsize,
+        }
+
+    def clear(self) -> None:
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
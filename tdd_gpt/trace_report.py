@@ -0,0 +1,114 @@
+import argparse
+import json
+from typing import Dict, List
+
+from tracing import cost
+
+
+def load_spans(path: str) -> List[dict]:
+    spans = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                spans.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A line torn by a crash
+                continue
+    return spans
+
+
+def self_times(spans: List[dict]) -> Dict[str, float]:
+    """Wall time of every span less that of its children, spans run in parallel with it included."""
+    children: Dict[str, float] = {}
+    for span in spans:
+        if span["parent_id"] is not None:
+            children[span["parent_id"]] = children.get(span["parent_id"], 0.0) + span["wall_s"]
+    return {span["span_id"]: max(span["wall_s"] - children.get(span["span_id"], 0.0), 0.0) for span in spans}
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def report(path: str, top: int = 15) -> None:
+    """Print the hot spots, the model calls and their cost, and the commands of a trace file."""
+    spans = load_spans(path)
+    if not spans:
+        print(f"No spans in {path}")
+        return
+    runs = [span for span in spans if span["name"] == "agent.run"]
+    total = sum(span["wall_s"] for span in runs) or max(s["start"] + s["wall_s"] for s in spans) - min(s["start"] for s in spans)
+    steps = [span for span in spans if span["name"] == "step"]
+    print(f"\033[92mTrace:\033[0m {path}, {len(runs)} runs, {len(steps)} steps, {total:.2f}s")
+
+    own = self_times(spans)
+    names: Dict[str, List[dict]] = {}
+    for span in spans:
+        names.setdefault(span["name"], []).append(span)
+    rows = []
+    for name, group in names.items():
+        walls = [span["wall_s"] for span in group]
+        rows.append((
+            sum(own[span["span_id"]] for span in group), name, len(group), sum(walls),
+            statistics_ms(walls), sum(span["cpu_s"] or 0.0 for span in group),
+        ))
+    rows.sort(reverse=True)
+    print(f"\n\033[92mHot spots\033[0m (self time, less the spans within)")
+    print(f"{'span':<22} {'count':>6} {'self s':>8} {'% run':>6} {'total s':>8} {'mean ms':>9} {'p95 ms':>9} {'cpu s':>7}")
+    for self_s, name, count, wall, (mean, p95), cpu in rows[:top]:
+        print(f"{name:<22} {count:>6} {self_s:>8.3f} {self_s / total * 100 if total else 0:>6.1f} {wall:>8.3f} {mean:>9.1f} {p95:>9.1f} {cpu:>7.3f}")
+
+    calls = names.get("llm.call", [])
+    if calls:
+        models: Dict[str, dict] = {}
+        for span in calls:
+            attributes = span["attributes"]
+            model = models.setdefault(attributes.get("model", "unknown"), {"calls": 0, "errors": 0, "seconds": 0.0, "prompt": 0, "completion": 0})
+            model["calls"] += 1
+            model["errors"] += span["status"] == "error"
+            model["seconds"] += span["wall_s"]
+            model["prompt"] += attributes.get("prompt_tokens", 0)
+            model["completion"] += attributes.get("completion_tokens", 0)
+        print(f"\n\033[92mModels\033[0m")
+        print(f"{'model':<22} {'calls':>6} {'errors':>6} {'seconds':>8} {'prompt tk':>10} {'compl. tk':>10} {'cost $':>8}")
+        for name, model in sorted(models.items(), key=lambda item: -item[1]["prompt"]):
+            estimate = cost(name, model["prompt"], model["completion"])
+            price = f"{estimate:.4f}" if estimate is not None else "?"
+            print(f"{name:<22} {model['calls']:>6} {model['errors']:>6} {model['seconds']:>8.2f} {model['prompt']:>10} {model['completion']:>10} {price:>8}")
+
+    commands = names.get("cli.run", [])
+    if commands:
+        statuses: Dict[str, int] = {}
+        for span in commands:
+            status = span["attributes"].get("status", span["status"])
+            statuses[status] = statuses.get(status, 0) + 1
+        output_bytes = sum(span["attributes"].get("output_bytes", 0) for span in commands)
+        print(f"\n\033[92mCommands:\033[0m {len(commands)} runs, "
+              + ", ".join(f"{count} {status}" for status, count in sorted(statuses.items()))
+              + f", {output_bytes} bytes of output")
+        for span in sorted(commands, key=lambda span: -span["wall_s"])[:5]:
+            attributes = span["attributes"]
+            commands_str = attributes.get("commands")
+            if isinstance(commands_str, list):
+                commands_str = " && ".join(commands_str)
+            print(f"{span['wall_s'] * 1000:>9.1f} ms  {attributes.get('status', span['status']):<10} exit {attributes.get('exit_code', '-')!s:<4} "
+                  f"{attributes.get('output_bytes', 0):>8} B  {str(commands_str)[:60]}")
+
+    if steps:
+        print(f"\n\033[92mSlowest steps\033[0m")
+        for span in sorted(steps, key=lambda span: -span["wall_s"])[:5]:
+            attributes = span["attributes"]
+            print(f"step {attributes.get('step', '?'):>5} {span['wall_s'] * 1000:>9.1f} ms  {span['status']:<10} {attributes.get('command', '')}")
+
+
+def statistics_ms(walls: List[float]):
+    return sum(walls) / len(walls) * 1000, percentile(walls, 0.95) * 1000
+
+
+def main(argv: List[str]) -> None:
+    parser = argparse.ArgumentParser(prog="tdd-gpt trace-report", description="Print the hot spots and the model costs of a --trace_file")
+    parser.add_argument("trace_file", type=str, help="JSONL trace file written by --trace_file")
+    parser.add_argument("--top", type=int, default=15, help="Number of span names listed in the hot spots")
+    args = parser.parse_args(argv)
+    report(args.trace_file, args.top)
@@ -0,0 +1,292 @@
+import contextvars
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+from uuid import UUID
+
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.schema import LLMResult
+
+from token_cache import TokenCounterCache
+
+# USD per 1K prompt and completion tokens, the list prices of late 2023
+PRICES = {
+    "gpt-4-1106-preview": (0.01, 0.03),
+    "gpt-4-vision-preview": (0.01, 0.03),
+    "gpt-4-32k": (0.06, 0.12),
+    "gpt-4": (0.03, 0.06),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-3.5-turbo-1106": (0.001, 0.002),
+    "gpt-3.5-turbo": (0.0015, 0.002),
+}
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+_current: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("tdd_gpt_span", default=None)
+_tracer: Optional["Tracer"] = None
+
+
+def cost(model: str, prompt_tokens: int, completion_tokens: int) -> Optional[float]:
+    """Estimated cost in USD of a model call, or None for a model without a known price."""
+    for name, (prompt_price, completion_price) in PRICES.items():
+        if model.startswith(name):
+            return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+    return None
+
+
+def default_token_counter() -> Callable[[str], int]:
+    try:
+        import tiktoken
+
+        encoding = tiktoken.get_encoding("cl100k_base")
+        return lambda text: len(encoding.encode(text))
+    except Exception:
+        # The encoding cannot be downloaded offline, count words and punctuation
+        return lambda text: len(TOKEN_PATTERN.findall(text))
+
+
+class Span:
+    """A timed operation, with its wall and thread CPU time and its attributes."""
+
+    def __init__(self, tracer: "Tracer", name: str, parent: Optional["Span"], attributes: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = attributes
+        self.status = "ok"
+        self.start = time.time()
+        self._perf = time.perf_counter()
+        self._cpu = time.thread_time()
+        self._token: Optional[contextvars.Token] = None
+        self._ended = False
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def end(self, status: Optional[str] = None, cpu: bool = True) -> None:
+        if self._ended:
+            return
+        self._ended = True
+        self.status = status or self.status
+        wall = time.perf_counter() - self._perf
+        cpu_time = time.thread_time() - self._cpu if cpu else None
+        if self._token is not None:
+            try:
+                _current.reset(self._token)
+            except ValueError:
+                # Ended from another context, e.g. by Tracer.close()
+                pass
+        self.tracer._end(self, wall, cpu_time)
+
+    def __enter__(self) -> "Span":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.end("error" if exc_type is not None else None)
+
+
+class _NoopSpan:
+    def set(self, **attributes: Any) -> None:
+        pass
+
+    def end(self, status: Optional[str] = None, cpu: bool = True) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Tracer:
+    """Spans of a run, written one JSON line each to path as they end, and exported to the exporters.
+
+    An exporter has on_start(span), on_end(span, record) and close() methods. Spans are
+    nested through a context variable, so a span started in a thread or a task started
+    from within another span is its child. The model calls of the LLMs given callbacks()
+    are spans too, with their tokens.
+    """
+
+    def __init__(self, path: Optional[str] = None, exporters: Optional[List[Any]] = None, token_counter: Optional[Callable[[str], int]] = None):
+        self.path = path
+        self.trace_id = os.urandom(16).hex()
+        self.exporters = list(exporters or [])
+        # The messages of the chat history are counted again in the prompt of every step
+        self.token_counter = TokenCounterCache(token_counter or default_token_counter())
+        self.handler = TracingCallbackHandler(self)
+        self._open: Dict[str, Span] = {}
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8") if path else None
+
+    def start_span(self, name: str, parent: Optional[Span] = None, current: bool = True, **attributes: Any) -> Span:
+        """Start a span, by default a child of the current one that becomes the current one until it ends."""
+        span = Span(self, name, parent if parent is not None else _current.get(), attributes)
+        if current:
+            span._token = _current.set(span)
+        with self._lock:
+            self._open[span.span_id] = span
+        for exporter in self.exporters:
+            exporter.on_start(span)
+        return span
+
+    def _end(self, span: Span, wall: float, cpu: Optional[float]) -> None:
+        record = {
+            "trace_id": self.trace_id,
+            "span_id": span.span_id,
+            "parent_id": span.parent_id,
+            "name": span.name,
+            "start": round(span.start, 6),
+            "wall_s": round(wall, 6),
+            "cpu_s": round(cpu, 6) if cpu is not None else None,
+            "status": span.status,
+            "attributes": span.attributes,
+        }
+        with self._lock:
+            self._open.pop(span.span_id, None)
+            if self._file is not None:
+                self._file.write(json.dumps(record, default=str) + "\n")
+                self._file.flush()
+        for exporter in self.exporters:
+            exporter.on_end(span, record)
+
+    def close(self) -> None:
+        """End the spans still open, e.g. the step a crash interrupted, and close the exporters."""
+        for span in list(self._open.values()):
+            span.end("unfinished", cpu=False)
+        for exporter in self.exporters:
+            exporter.close()
+        if self._file is not None:
+            self._file.close()
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Records every chat model call as an "llm.call" span with its model and tokens.
+
+    The tokens are those the API reports, or else counted in the messages and in the
+    generated text, streamed tokens included, so that a stream stopped early counts
+    what was generated.
+    """
+
+    run_inline = True
+
+    def __init__(self, tracer: Tracer):
+        self.tracer = tracer
+        self._runs: Dict[UUID, Span] = {}
+        self._streamed: Dict[UUID, List[str]] = {}
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID, **kwargs: Any) -> None:
+        params = kwargs.get("invocation_params") or {}
+        model = params.get("model_name") or params.get("model") or serialized.get("id", ["unknown"])[-1]
+        span = self.tracer.start_span("llm.call", current=False, model=model)
+        span._messages = [message.content for batch in messages for message in batch]
+        self._runs[run_id] = span
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        self._streamed.setdefault(run_id, []).append(token)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        text = "".join(generation.text for generations in response.generations for generation in generations)
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        self._end(run_id, "ok", usage, text)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        # Closing a stream once the reply is complete raises GeneratorExit in it
+        self._end(run_id, "stopped" if isinstance(error, GeneratorExit) else "error", {}, "")
+
+    def _end(self, run_id: UUID, status: str, usage: dict, text: str) -> None:
+        span = self._runs.pop(run_id, None)
+        streamed = "".join(self._streamed.pop(run_id, []))
+        if span is None:
+            return
+        counter = self.tracer.token_counter
+        prompt_tokens = usage.get("prompt_tokens") or sum(counter(content) for content in span._messages)
+        completion_tokens = usage.get("completion_tokens") or counter(text or streamed)
+        span.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+        span.end(status, cpu=False)
+
+
+class OTelExporter:
+    """Exports the spans through OpenTelemetry, to the OTLP/HTTP endpoint of the OTEL_EXPORTER_OTLP_* variables."""
+
+    def __init__(self, service_name: str = "tdd-gpt"):
+        try:
+            from opentelemetry import trace
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            from opentelemetry.sdk.resources import Resource
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        except ImportError:
+            raise ImportError(
+                "Could not import opentelemetry, install it with "
+                "`pip install opentelemetry-sdk opentelemetry-exporter-otlp-proto-http`"
+            )
+        self._trace = trace
+        self._provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+        self._provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        self._tracer = self._provider.get_tracer("tdd_gpt")
+        self._spans: Dict[str, Any] = {}
+
+    def on_start(self, span: Span) -> None:
+        parent = self._spans.get(span.parent_id)
+        context = self._trace.set_span_in_context(parent) if parent is not None else None
+        self._spans[span.span_id] = self._tracer.start_span(span.name, context=context, start_time=int(span.start * 1e9))
+
+    def on_end(self, span: Span, record: dict) -> None:
+        otel_span = self._spans.pop(span.span_id, None)
+        if otel_span is None:
+            return
+        for key, value in record["attributes"].items():
+            otel_span.set_attribute(key, value if isinstance(value, (str, bool, int, float)) else str(value))
+        if record["cpu_s"] is not None:
+            otel_span.set_attribute("cpu_s", record["cpu_s"])
+        if record["status"] != "ok":
+            otel_span.set_attribute("status", record["status"])
+        if record["status"] == "error":
+            otel_span.set_status(self._trace.Status(self._trace.StatusCode.ERROR))
+        otel_span.end(end_time=int((span.start + record["wall_s"]) * 1e9))
+
+    def close(self) -> None:
+        self._provider.shutdown()
+
+
+def set_tracer(tracer: Optional[Tracer]) -> None:
+    global _tracer
+    _tracer = tracer
+
+
+def get_tracer() -> Optional[Tracer]:
+    return _tracer
+
+
+def span(name: str, **attributes: Any) -> Any:
+    """Context manager of a span that is the current one while it runs, or a no-op without a tracer."""
+    if _tracer is None:
+        return NOOP_SPAN
+    return _tracer.start_span(name, **attributes)
+
+
+def start_span(name: str, **attributes: Any) -> Any:
+    """Start a span, ended by its end() method, or a no-op without a tracer."""
+    if _tracer is None:
+        return NOOP_SPAN
+    return _tracer.start_span(name, **attributes)
+
+
+def annotate(**attributes: Any) -> None:
+    """Set attributes on the current span, if any."""
+    current = _current.get()
+    if current is not None:
+        current.set(**attributes)
+
+
+def callbacks() -> Optional[List[BaseCallbackHandler]]:
+    """Callbacks that trace the calls of a chat model, None without a tracer."""
+    return [_tracer.handler] if _tracer is not None else None
@@ -0,0 +1,261 @@
+import json
+import math
+import os
+import threading
+from array import array
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+import faiss
+import numpy as np
+
+from langchain.docstore.base import AddableMixin, Docstore
+from langchain.schema import Document
+from langchain.schema.embeddings import Embeddings
+from langchain.vectorstores import FAISS
+
+INDEX_FILE = "index.faiss"
+DOCSTORE_FILE = "docstore.jsonl"
+INDEX_TYPES = ("hnsw", "ivf")
+
+
+class JournalDocstore(Docstore, AddableMixin):
+    """Documents appended to a JSONL file and read back from disk when searched.
+
+    Two sidecar files list the ids, one per line, and the offsets of the lines, so
+    opening a docstore of a million documents reads neither the documents nor any
+    JSON. A line is written before its offset and its id: a document without both,
+    or whose line is torn, was never added and is cut off on open. The ids must not
+    contain newlines.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ids_path = f"{path}.ids"
+        self.index_path = f"{path}.idx"
+        self.ids: List[str] = []
+        self._positions: Dict[str, int] = {}
+        self._offsets = array("Q")
+        self._lock = threading.Lock()
+        self._recover()
+        self._file = open(path, "ab")
+        self._size = self._file.tell()
+        self._ids_file = open(self.ids_path, "a", encoding="utf-8")
+        self._index_file = open(self.index_path, "ab")
+        self._reader = open(path, "rb")
+
+    def _recover(self) -> None:
+        for path in (self.path, self.ids_path, self.index_path):
+            open(path, "ab").close()
+        with open(self.ids_path, encoding="utf-8") as f:
+            text = f.read()
+        # The last item is empty, or an id torn by a crash
+        ids = text.split("\n")[:-1]
+        listed = len(ids)
+        offsets = array("Q")
+        with open(self.index_path, "rb") as f:
+            data = f.read()
+        offsets.frombytes(data[:len(data) - len(data) % offsets.itemsize])
+        count = min(len(ids), len(offsets))
+        while count and not self._read_line(offsets[count - 1]).endswith(b"\n"):
+            count -= 1
+        del ids[count:]
+        del offsets[count:]
+
+        size = offsets[-1] + len(self._read_line(offsets[-1])) if count else 0
+        for path, length in ((self.path, size), (self.index_path, count * offsets.itemsize)):
+            if os.path.getsize(path) != length:
+                with open(path, "ab") as f:
+                    f.truncate(length)
+        if count != listed or not text.endswith("\n") and text:
+            with open(self.ids_path, "w", encoding="utf-8") as f:
+                f.writelines(f"{doc_id}\n" for doc_id in ids)
+        self.ids = ids
+        self._offsets = offsets
+        self._positions = dict(zip(ids, range(count)))
+
+    def _read_line(self, offset: int) -> bytes:
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return f.readline()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        with self._lock:
+            start = len(self._offsets)
+            for doc_id, document in texts.items():
+                line = (json.dumps({"page_content": document.page_content, "metadata": document.metadata}) + "\n").encode("utf-8")
+                self._file.write(line)
+                self._positions[doc_id] = len(self._offsets)
+                self._offsets.append(self._size)
+                self.ids.append(doc_id)
+                self._size += len(line)
+            self._file.flush()
+            self._index_file.write(self._offsets[start:].tobytes())
+            self._index_file.flush()
+            self._ids_file.writelines(f"{doc_id}\n" for doc_id in texts)
+            self._ids_file.flush()
+
+    def search(self, search: str) -> Union[str, Document]:
+        position = self._positions.get(search)
+        if position is None:
+            return f"ID {search} not found."
+        with self._lock:
+            self._reader.seek(self._offsets[position])
+            item = json.loads(self._reader.readline())
+        return Document(page_content=item["page_content"], metadata=item["metadata"])
+
+    def sync(self) -> None:
+        with self._lock:
+            for f in (self._file, self._index_file, self._ids_file):
+                os.fsync(f.fileno())
+
+    def close(self) -> None:
+        self.sync()
+        for f in (self._file, self._index_file, self._ids_file, self._reader):
+            f.close()
+
+
+class DiskFAISS(FAISS):
+    """FAISS vector memory persisted in a directory, to be reused across runs and projects.
+
+    The documents are appended to a JournalDocstore as they are added, and the index is
+    written on persist() and close(). On open the index is memory-mapped, so a large
+    memory opens in a fraction of a second and its pages are only read when searched;
+    it is read into memory before the next add. Documents the saved index is missing,
+    e.g. after a crash, are embedded again on open. The index starts exact (flat) and is
+    migrated to HNSW or IVF once it holds migrate_at vectors, trading a little recall for
+    searches that stay fast as the memory grows.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.directory: Optional[str] = None
+        self.migrate_at = 50000
+        self.index_type = "ivf"
+        self.hnsw_m = 32
+        self.ef_search = 128
+        self.nprobe = 16
+        self.stats = {"added": 0, "migrations": 0, "reembedded": 0}
+        self._mapped = False
+        self._dirty = False
+
+    @classmethod
+    def open(
+        cls,
+        directory: str,
+        embeddings: Embeddings,
+        dimension: int,
+        migrate_at: int = 50000,
+        index_type: str = "ivf",
+        hnsw_m: int = 32,
+        ef_search: int = 128,
+        nprobe: int = 16,
+        mmap: bool = True,
+    ) -> "DiskFAISS":
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type {index_type}, expected one of {', '.join(INDEX_TYPES)}")
+        os.makedirs(directory, exist_ok=True)
+        index_path = os.path.join(directory, INDEX_FILE)
+        mapped = mmap and os.path.exists(index_path)
+        if os.path.exists(index_path):
+            index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP_IFC if mmap else 0)
+        else:
+            index = faiss.IndexFlatL2(dimension)
+        if index.d != dimension:
+            raise ValueError(f"The memory in {directory} has {index.d} dimensions, the embeddings have {dimension}")
+        docstore = JournalDocstore(os.path.join(directory, DOCSTORE_FILE))
+        if index.ntotal > len(docstore):
+            raise ValueError(f"The index in {directory} has {index.ntotal} vectors for {len(docstore)} documents")
+
+        store = cls(embeddings, index, docstore, dict(enumerate(docstore.ids)))
+        store.directory = directory
+        store.migrate_at = migrate_at
+        store.index_type = index_type
+        store.hnsw_m = hnsw_m
+        store.ef_search = ef_search
+        store.nprobe = nprobe
+        store._mapped = mapped
+        store._configure(index)
+
+        missing = [docstore.search(doc_id).page_content for doc_id in docstore.ids[index.ntotal:]]
+        if missing:
+            store._writable()
+            store.index.add(np.array(store._embed_documents(missing), dtype=np.float32))
+            store.stats["reembedded"] = len(missing)
+            store._dirty = True
+        return store
+
+    def _configure(self, index: Any) -> None:
+        if isinstance(index, faiss.IndexHNSW):
+            index.hnsw.efSearch = self.ef_search
+        elif isinstance(index, faiss.IndexIVF):
+            index.nprobe = self.nprobe
+
+    def _writable(self) -> None:
+        # A memory-mapped index is read-only, the file holds the same index
+        if self._mapped:
+            self.index = faiss.read_index(os.path.join(self.directory, INDEX_FILE))
+            self._configure(self.index)
+            self._mapped = False
+
+    def _added(self, ids: List[str]) -> None:
+        self.stats["added"] += len(ids)
+        self._dirty = True
+        if isinstance(self.index, faiss.IndexFlat) and self.index.ntotal >= self.migrate_at:
+            self.migrate()
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        self._writable()
+        ids = super().add_texts(texts, metadatas=metadatas, ids=ids, **kwargs)
+        self._added(ids)
+        return ids
+
+    async def aadd_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        self._writable()
+        ids = await super().aadd_texts(texts, metadatas=metadatas, ids=ids, **kwargs)
+        self._added(ids)
+        return ids
+
+    def add_embeddings(self, text_embeddings: Iterable[Tuple[str, List[float]]], metadatas: Optional[List[dict]] = None, ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        self._writable()
+        ids = super().add_embeddings(text_embeddings, metadatas=metadatas, ids=ids, **kwargs)
+        self._added(ids)
+        return ids
+
+    def migrate(self) -> None:
+        """Move the vectors of the flat index to an approximate index of index_type."""
+        self._writable()
+        vectors = self.index.reconstruct_n(0, self.index.ntotal)
+        dimension = self.index.d
+        if self.index_type == "hnsw":
+            index = faiss.IndexHNSWFlat(dimension, self.hnsw_m)
+        else:
+            # FAISS wants at least 39 training vectors per list
+            nlist = max(1, min(int(4 * math.sqrt(len(vectors))), len(vectors) // 39))
+            index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dimension), dimension, nlist)
+            sample = vectors[np.random.default_rng(0).permutation(len(vectors))[:nlist * 64]]
+            index.train(sample)
+        index.add(vectors)
+        self._configure(index)
+        self.index = index
+        self.stats["migrations"] += 1
+        self._dirty = True
+        self.persist()
+
+    def persist(self) -> None:
+        """Write the index, replacing the previous one atomically, if vectors were added since."""
+        if not self._dirty:
+            return
+        self.docstore.sync()
+        path = os.path.join(self.directory, INDEX_FILE)
+        faiss.write_index(self.index, f"{path}.tmp")
+        with open(f"{path}.tmp", "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(f"{path}.tmp", path)
+        self._dirty = False
+
+    def close(self) -> None:
+        self.persist()
+        self.docstore.close()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+# The package modules import each other as top-level modules, like main.py runs them
+sys.path[:0] = [os.path.join(ROOT, "tdd_gpt"), os.path.join(ROOT, "benchmarks")]
@@ -0,0 +1,130 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+
+import pytest
+from langchain.callbacks.base import BaseCallbackHandler
+
+from _common import build_agent, json_reply, project_steps
+from fakes import ScriptedChatModel
+
+
+def replies(output_dir, steps):
+    return [json_reply(command) for command in project_steps(output_dir, files=2, steps=steps)]
+
+
+def quiet(run):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return run()
+
+
+@pytest.mark.parametrize("async_loop", [False, True])
+def test_pending_memories_flushed_when_the_loop_fails(tmp_path, async_loop):
+    output_dir = str(tmp_path)
+    # Five steps, then the model runs out of responses in the middle of the run
+    agent = build_agent(ScriptedChatModel(responses=replies(output_dir, 12)[:5]), output_dir)
+    agent.memory_writer.batch_size = 16
+    run = (lambda: asyncio.run(agent.arun(["Build"]))) if async_loop else (lambda: agent.run(["Build"]))
+    with pytest.raises(IndexError):
+        quiet(run)
+    assert agent.memory_writer.pending == 0
+    assert agent.memory_writer.memory.vectorstore.index.ntotal == 5
+
+
+class TokenCounter(BaseCallbackHandler):
+    def __init__(self):
+        self.tokens = 0
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.tokens += 1
+
+
+def stream_reply(agent, async_loop):
+    inputs = agent._step_inputs(["Build"], agent._first_user_input())
+    if async_loop:
+        return asyncio.run(agent._astream_reply(inputs))
+    return agent._stream_reply(inputs)
+
+
+def streaming_agent(output_dir, responses, chunk_size=5):
+    counter = TokenCounter()
+    llm = ScriptedChatModel(responses=responses, chunk_size=chunk_size, callbacks=[counter])
+    agent = build_agent(llm, output_dir, streaming=True)
+    lines = []
+    agent.console = lines.append
+    return agent, counter, lines
+
+
+@pytest.mark.parametrize("async_loop", [False, True])
+def test_stream_assembles_the_chunks(tmp_path, async_loop):
+    reply = replies(str(tmp_path), 4)[1]
+    agent, _, lines = streaming_agent(str(tmp_path), [reply], chunk_size=3)
+    text, repairer, thoughts = stream_reply(agent, async_loop)
+    assert json.loads(text) == json.loads(reply)
+    assert thoughts == json.loads(reply)["thoughts"]
+    assert any(line.startswith("\033[92mThought:") for line in lines)
+    parsed, retry_input = agent._parse_reply(text, repairer, thoughts)
+    assert retry_input is None and parsed["command"] == json.loads(reply)["command"]
+
+
+@pytest.mark.parametrize("async_loop", [False, True])
+def test_stream_stops_once_the_reply_is_complete(tmp_path, async_loop):
+    reply = replies(str(tmp_path), 4)[0]
+    # The model goes on after the object, the agent must not wait for the rest
+    agent, counter, _ = streaming_agent(str(tmp_path), [reply + "\n\nLet me explain. " + "More text. " * 2000])
+    text, repairer, _ = stream_reply(agent, async_loop)
+    assert repairer.done and json.loads(text) == json.loads(reply)
+    assert counter.tokens <= len(reply) // 5 + 1
+
+
+@pytest.mark.parametrize("async_loop", [False, True])
+def test_stream_aborts_on_a_malformed_reply(tmp_path, async_loop):
+    agent, counter, lines = streaming_agent(str(tmp_path), ['{"thoughts": ]' + "x" * 10000])
+    text, repairer, thoughts = stream_reply(agent, async_loop)
+    assert repairer.error is not None and thoughts is None
+    assert counter.tokens < 10
+    assert any(line.startswith("Aborting the response") for line in lines)
+    parsed, retry_input = agent._parse_reply(text, repairer, thoughts)
+    assert parsed is None and "not a valid json" in retry_input
+
+
+@pytest.mark.parametrize("async_loop", [False, True])
+def test_streamed_run(tmp_path, async_loop):
+    output_dir = str(tmp_path)
+    # WriteFileTool does not create directories
+    os.makedirs(os.path.join(output_dir, "src", "components"))
+    agent, _, _ = streaming_agent(output_dir, replies(output_dir, 12))
+    run = (lambda: asyncio.run(agent.arun(["Build"]))) if async_loop else (lambda: agent.run(["Build"]))
+    assert quiet(run) == "All tasks are completed."
+    assert os.path.exists(os.path.join(output_dir, "src", "components", "Component0.js"))
+
+
+class Feedback:
+    def __init__(self, answers):
+        self.answers = list(answers)
+
+    def run(self, prompt):
+        return self.answers.pop(0)
+
+
+@pytest.mark.parametrize("async_loop", [False, True])
+def test_feedback_stops_the_run(tmp_path, async_loop):
+    output_dir = str(tmp_path)
+    os.makedirs(os.path.join(output_dir, "src", "components"))
+    agent = build_agent(ScriptedChatModel(responses=replies(output_dir, 12)), output_dir)
+    agent.feedback_tool = Feedback(["looks good", "q"])
+    lines = []
+    agent.console = lines.append
+    run = (lambda: asyncio.run(agent.arun(["Build"]))) if async_loop else (lambda: agent.run(["Build"]))
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+        assert run() == "EXITING"
+    if async_loop:
+        # The async loop renders the console lines in the background
+        assert stdout.getvalue().splitlines()[-1] == "EXITING"
+    else:
+        assert lines[-1] == "EXITING" and "EXITING" not in stdout.getvalue()
+    metadata = [message.additional_kwargs.get("metadata", "") for message in agent.chat_history_memory.messages]
+    assert sum("Feedback: \nlooks good" in entry for entry in metadata) == 1
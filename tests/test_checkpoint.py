@@ -0,0 +1,119 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+
+import pytest
+from langchain.schema.messages import HumanMessage
+
+from _common import build_agent, json_reply, project_steps
+from checkpoint import Checkpoint, CheckpointManager
+from fakes import ScriptedChatModel
+from history import JournalChatMessageHistory
+
+STEPS = 30
+
+
+def snapshot(output_dir):
+    files = {}
+    for directory, _, names in os.walk(os.path.join(output_dir, "src")):
+        for name in names:
+            with open(os.path.join(directory, name)) as f:
+                files[os.path.relpath(os.path.join(directory, name), output_dir)] = f.read()
+    return files
+
+
+def run(agent, async_loop, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        if async_loop:
+            return asyncio.run(agent.arun(*args, **kwargs))
+        return agent.run(*args, **kwargs)
+
+
+def start(output_dir, replies, memory_every=4):
+    checkpoints = CheckpointManager(os.path.join(output_dir, ".checkpoint"), output_dir, memory_every=memory_every)
+    history = JournalChatMessageHistory(os.path.join(checkpoints.directory, "history.jsonl"))
+    agent = build_agent(ScriptedChatModel(responses=replies), output_dir, chat_history_memory=history, checkpoints=checkpoints)
+    return agent, history
+
+
+def uninterrupted(output_dir):
+    replies = [json_reply(command) for command in project_steps(output_dir, files=3, steps=STEPS)]
+    agent, history = start(output_dir, replies)
+    run(agent, False, ["Build the components"])
+    result = (snapshot(output_dir), len(history), len(agent.memory.vectorstore.docstore._dict))
+    history.close()
+    return result
+
+
+def resume(output_dir, replies):
+    """Rebuild the agent from the checkpoint the way main.py does with --resume."""
+    checkpoints = CheckpointManager(os.path.join(output_dir, ".checkpoint"), output_dir, memory_every=4)
+    saved = checkpoints.load()
+    history = JournalChatMessageHistory(saved.history_path)
+    history.truncate(saved.messages)
+    agent = build_agent(ScriptedChatModel(responses=replies[saved.step:]), output_dir, chat_history_memory=history, checkpoints=checkpoints)
+    agent.memory.vectorstore = checkpoints.restore_memory(saved, agent.memory.vectorstore, history.messages)
+    return agent, history, saved, checkpoints
+
+
+@pytest.mark.parametrize("async_loop", [False, True])
+@pytest.mark.parametrize("crash_step", [9, 15])
+def test_resumed_run_matches_an_uninterrupted_one(tmp_path, crash_step, async_loop):
+    expected = uninterrupted(str(tmp_path / "uninterrupted"))
+
+    output_dir = str(tmp_path / "crashed")
+    replies = [json_reply(command) for command in project_steps(output_dir, files=3, steps=STEPS)]
+    agent, history = start(output_dir, replies[:crash_step])
+    with pytest.raises(IndexError):
+        run(agent, async_loop, ["Build the components"])
+    # The crash happened after half of the next step was written
+    history.add_message(HumanMessage(content=f"You have completed step {crash_step}. Half a step."))
+    history.close()
+
+    agent, history, saved, checkpoints = resume(output_dir, replies)
+    assert saved.step == crash_step
+    # The memory was saved at steps 1, 5, 9, 13, the later memories come from the history
+    assert saved.memory_step == crash_step - (crash_step - 1) % 4
+    assert len(history) == saved.messages
+    assert len(agent.memory.vectorstore.docstore._dict) == crash_step
+    assert checkpoints.changed_files(saved) == []
+    run(agent, async_loop, saved.goals, start_step=saved.step, user_input=saved.user_input)
+    assert history.messages[saved.messages].content.startswith(f"You have completed step {crash_step}.")
+    assert (snapshot(output_dir), len(history), len(agent.memory.vectorstore.docstore._dict)) == expected
+    history.close()
+
+
+def test_only_the_latest_memory_is_kept(tmp_path):
+    output_dir = str(tmp_path)
+    replies = [json_reply(command) for command in project_steps(output_dir, files=3, steps=STEPS)]
+    agent, history = start(output_dir, replies[:11])
+    with pytest.raises(IndexError):
+        run(agent, False, ["Build the components"])
+    history.close()
+    assert agent.checkpoints.stats["saves"] == 11
+    # Steps 1, 5 and 9
+    assert agent.checkpoints.stats["memory_saves"] == 3
+    assert sorted(name for name in os.listdir(agent.checkpoints.directory) if name.startswith("memory-")) == ["memory-000009"]
+
+
+def test_changed_files(tmp_path):
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "App.js").write_text("v1")
+    (tmp_path / "src" / "index.js").write_text("v1")
+    checkpoints = CheckpointManager(str(tmp_path / ".checkpoint"), str(tmp_path))
+    saved = Checkpoint(step=1, user_input="", goals=[], messages=0, kanban={}, manifest=checkpoints.manifest())
+    (tmp_path / "src" / "App.js").write_text("v2")
+    (tmp_path / "src" / "index.js").unlink()
+    (tmp_path / "src" / "new.js").write_text("v1")
+    assert checkpoints.changed_files(saved) == ["src/App.js", "src/index.js", "src/new.js"]
+
+
+def test_no_checkpoint_and_unknown_version(tmp_path):
+    checkpoints = CheckpointManager(str(tmp_path), str(tmp_path))
+    assert checkpoints.load() is None
+    with open(checkpoints.state_path, "w") as f:
+        json.dump({"version": 99}, f)
+    with pytest.raises(ValueError, match="Unsupported checkpoint version 99"):
+        checkpoints.load()
@@ -0,0 +1,156 @@
+import re
+import signal
+import time
+
+import pytest
+
+from cli import OutputBuffer, ShellSession, run_command_with_timeout
+
+MARKER_PATTERN = re.compile(r"\.\.\. \((\d+) bytes of output elided\) \.\.\.\n")
+
+
+def split_elided(value):
+    marker = MARKER_PATTERN.search(value)
+    return value[:marker.start()], marker, value[marker.end():]
+
+
+def feed(buffer, data, size):
+    for start in range(0, len(data), size):
+        buffer.write(data[start:start + size])
+
+
+@pytest.mark.parametrize("size", [1, 3, 1000])
+def test_output_under_the_limit_is_kept_whole(size):
+    text = "".join(f"línea {i} ✓\n" for i in range(50))
+    buffer = OutputBuffer(10 * 1024)
+    feed(buffer, text.encode("utf-8"), size)
+    assert buffer.elided_bytes == 0
+    assert buffer.getvalue() == text
+
+
+@pytest.mark.parametrize("size", [1, 7, 4096])
+def test_head_and_tail_on_line_boundaries(size):
+    data = "".join(f"line {i}\n" for i in range(20000)).encode("utf-8")
+    buffer = OutputBuffer(4096)
+    feed(buffer, data, size)
+    head, marker, tail = split_elided(buffer.getvalue())
+    assert head.startswith("line 0\n") and head.endswith("\n")
+    assert tail.endswith("line 19999\n") and re.match(r"line \d+\n", tail)
+    # What is kept and what is elided add up to the whole output
+    assert len(head.encode()) + int(marker.group(1)) + len(tail.encode()) == len(data) == buffer.total_bytes
+    assert len(head.encode()) + len(tail.encode()) <= 4096
+
+
+def test_tail_cut_inside_a_character():
+    # No newline to align on, and the cut lands inside the 3 byte characters
+    data = ("✓" * 10000).encode("utf-8")
+    buffer = OutputBuffer(1000)
+    feed(buffer, data, 100)
+    head, _, tail = split_elided(buffer.getvalue())
+    assert "�" not in head + tail
+    assert set(head.strip()) == {"✓"} and set(tail) == {"✓"}
+
+
+def test_tail_is_trimmed_while_writing():
+    buffer = OutputBuffer(1000)
+    feed(buffer, b"x" * 1_000_000, 100)
+    assert len(buffer._tail) <= 2 * buffer.tail_bytes
+    assert buffer.total_bytes == 1_000_000
+
+
+def test_command_output_is_bounded():
+    output = run_command_with_timeout("seq 1 200000", 10, max_output_bytes=2048)
+    assert output.startswith("Command 'seq 1 200000' succeeded with the following output:\n1\n2\n")
+    assert MARKER_PATTERN.search(output)
+    assert output.endswith("\n200000\n")
+    assert len(output) < 2048 + 200
+
+
+def running(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # Killed and not reaped yet
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def test_interrupted_command_is_killed(tmp_path):
+    pid_file = tmp_path / "pid"
+
+    def interrupt(signum, frame):
+        if not pid_file.exists() or not pid_file.read_text().strip():
+            return
+        raise KeyboardInterrupt
+
+    previous = signal.signal(signal.SIGALRM, interrupt)
+    signal.setitimer(signal.ITIMER_REAL, 0.1, 0.1)
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            run_command_with_timeout(f"sleep 60 & echo $! > {pid_file}; wait", 60)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+    pid = int(pid_file.read_text())
+    deadline = time.monotonic() + 5
+    while running(pid) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not running(pid)
+
+
+@pytest.fixture
+def session(tmp_path):
+    session = ShellSession(cwd=str(tmp_path))
+    yield session
+    session.close()
+
+
+def test_session_keeps_the_directory_and_environment(session, tmp_path):
+    (tmp_path / "src").mkdir()
+    assert session.run(["cd src", "export GREETING=hi"], 10).startswith("Command 'cd src && export GREETING=hi' succeeded")
+    output = session.run("pwd; echo $GREETING", 10)
+    assert output == f"Command 'pwd; echo $GREETING' succeeded with the following output:\n{tmp_path / 'src'}\nhi\n"
+    assert session.cwd == str(tmp_path / "src")
+    assert session.sentinel not in output
+
+
+def test_session_reports_the_exit_status(session):
+    output = session.run("echo partial; false", 10)
+    assert output == "Command 'echo partial; false' failed with error: partial\n"
+    assert session.run("echo next", 10).endswith("output:\nnext\n")
+
+
+def test_session_output_without_final_newline(session):
+    assert session.run("printf 'no newline'", 10).endswith("output:\nno newline")
+
+
+def test_session_runs_heredocs_and_quotes(session, tmp_path):
+    command = "cat > notes.txt <<'EOF'\nit's \"quoted\" $HOME\nEOF\ncat notes.txt"
+    assert session.run(command, 10).endswith("output:\nit's \"quoted\" $HOME\n")
+
+
+def test_session_survives_a_syntax_error(session):
+    assert "failed with error" in session.run("if then fi (", 10)
+    assert session.run("echo still here", 10).endswith("output:\nstill here\n")
+    assert session.alive
+
+
+def test_session_does_not_read_the_next_command_as_input(session):
+    # Commands get /dev/null as stdin, so cat cannot swallow the rest of the script
+    assert session.run("cat; echo done", 10).endswith("output:\ndone\n")
+
+
+def test_session_killed_on_timeout_and_restarted(session, tmp_path):
+    (tmp_path / "app").mkdir()
+    session.run("cd app", 10)
+    process = session._proc
+    output = session.run("echo started; sleep 30", 1)
+    assert output.startswith("Command 'echo started; sleep 30' timed out after 1 seconds of inactivity on stdout started")
+    assert "The shell session was killed" in output
+    assert process.poll() is not None and not session.alive
+    assert session.run("pwd", 10).endswith(f"output:\n{tmp_path / 'app'}\n")
+
+
+def test_session_restarted_after_exit(session):
+    assert "The shell session exited" in session.run("exit 3", 10)
+    assert session.run("echo back", 10).endswith("output:\nback\n")
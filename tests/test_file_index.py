@@ -0,0 +1,85 @@
+import contextlib
+import io
+import json
+import os
+
+from langchain.schema.messages import AIMessage, HumanMessage, SystemMessage
+
+from _common import build_agent, json_reply, project_steps
+from fakes import ScriptedChatModel
+from file_index import FileIndex, step_from_metadata
+
+
+def words(text):
+    return len(text.split())
+
+
+def system_message(step, file_path=None, code=None):
+    kwargs = {"metadata": f"```json\n{json.dumps({'step': step})}\n```"}
+    if file_path is not None:
+        kwargs.update(file_path=file_path, code=code)
+    return SystemMessage(content=f"step {step}", additional_kwargs=kwargs)
+
+
+def test_update_replaces_the_entry_and_moves_it_first():
+    file_index = FileIndex(words)
+    file_index.update("src/App.js", "const a = 1;", 1)
+    file_index.update("src/Counter.js", "export function Counter() {}", 2)
+    assert [entry.file_path for entry in file_index.entries()] == ["src/Counter.js", "src/App.js"]
+
+    file_index.update("src/App.js", "const a = 1; const b = 2;", 5)
+    entry = file_index.get("src/App.js")
+    assert (entry.code, entry.tokens, entry.step) == ("const a = 1; const b = 2;", 8, 5)
+    assert [entry.file_path for entry in file_index.entries()] == ["src/App.js", "src/Counter.js"]
+    assert len(file_index) == 2 and "src/Counter.js" in file_index and "src/Other.js" not in file_index
+
+
+def test_empty_content_keeps_the_last_code():
+    file_index = FileIndex(words)
+    file_index.update("src/App.js", "const a = 1;", 1)
+    file_index.update("src/App.js", "  \n", 2)
+    file_index.update("src/Empty.js", "", 3)
+    assert file_index.get("src/App.js").code == "const a = 1;" and "src/Empty.js" not in file_index
+
+
+def test_rebuild_from_the_history():
+    messages = [
+        HumanMessage(content="Determine the next command"),
+        AIMessage(content="{}"),
+        system_message(1, "src/App.js", "v1"),
+        system_message(2),
+        system_message(3, "src/Counter.js", "counter"),
+        # A message without step metadata follows the previous step
+        SystemMessage(content="legacy", additional_kwargs={"file_path": "src/App.js", "code": "v2"}),
+    ]
+    file_index = FileIndex.from_messages(messages, words)
+    assert [(entry.file_path, entry.code, entry.step) for entry in file_index.entries()] == [
+        ("src/App.js", "v2", 4), ("src/Counter.js", "counter", 3),
+    ]
+    file_index.rebuild(messages[:3])
+    assert [entry.code for entry in file_index.entries()] == ["v1"]
+
+
+def test_step_from_metadata():
+    assert step_from_metadata('```json\n{"step": 7, "Action": "x"}\n```') == 7
+    assert step_from_metadata('{"step": "7"}') is None
+    assert step_from_metadata("no json") is None
+
+
+def test_agent_index_matches_a_rebuild_of_its_history(tmp_path):
+    output_dir = str(tmp_path)
+    os.makedirs(os.path.join(output_dir, "src", "components"))
+    commands = project_steps(output_dir, files=3, steps=16)
+    # Each write changes the file, so a stale entry would show
+    for n, command in enumerate(commands):
+        if command["name"] == "write_file":
+            command["args"]["text"] = f"export const version = {n};\n"
+    agent = build_agent(ScriptedChatModel(responses=[json_reply(command) for command in commands]), output_dir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        agent.run(["Build"])
+    rebuilt = FileIndex.from_messages(agent.chat_history_memory.messages, words)
+    entries = [(entry.file_path, entry.code, entry.step) for entry in agent.file_index.entries()]
+    assert entries == [(entry.file_path, entry.code, entry.step) for entry in rebuilt.entries()]
+    latest = {command["args"]["file_path"]: command["args"]["text"] for command in commands if command["name"] == "write_file"}
+    assert len(entries) == len(latest) == 3
+    assert all(latest[file_path] in code for file_path, code, _ in entries)
@@ -0,0 +1,65 @@
+import random
+
+import pytest
+
+import file_packer
+from file_index import FileEntry
+from file_packer import pack_files, score_file
+
+
+def count_tokens(text):
+    return len(text.split())
+
+
+def entry(n, functions, step):
+    body = "".join(f"export function part{i}(props) {{\n  return props.value + {i};\n}}\n" for i in range(functions))
+    code = f"\n```\n// src/components/Component{n}.js\n{body}```"
+    return FileEntry(f"src/components/Component{n}.js", code, count_tokens(code), step)
+
+
+def project(seed, files):
+    rng = random.Random(seed)
+    return [entry(n, rng.choice([1, 5, 20, 60]), rng.randint(1, 50)) for n in range(files)]
+
+
+def total_value(packed, entries, in_progress):
+    current_step = max(e.step for e in entries)
+    return sum(
+        score_file(e, current_step, in_progress, "") * (1 if code == e.code else file_packer.SKELETON_VALUE)
+        for e, code, _ in packed
+    )
+
+
+def test_everything_fits():
+    entries = project(0, 5)
+    packed = pack_files(entries, sum(e.tokens for e in entries), count_tokens)
+    assert [code for _, code, _ in packed] == [e.code for e in entries]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_bounded_knapsack_matches_the_full_one(seed, monkeypatch):
+    entries = project(seed, 60)
+    budget = random.Random(seed).randint(300, 3000)
+    in_progress = f"Fix {entries[seed].file_path}"
+    packed = pack_files(entries, budget, count_tokens, in_progress=in_progress)
+    assert sum(tokens for _, _, tokens in packed) <= budget
+    monkeypatch.setattr(file_packer, "CANDIDATE_BUDGETS", len(entries))
+    monkeypatch.setattr(file_packer, "SIMILAR_VALUES", 0)
+    full = pack_files(entries, budget, count_tokens, in_progress=in_progress)
+    assert total_value(packed, entries, in_progress) == pytest.approx(total_value(full, entries, in_progress))
+
+
+def test_similar_scores_are_packed_greedily(monkeypatch):
+    # Files of the same step without references score the same
+    entries = [entry(n, functions, 1) for n, functions in enumerate([60, 1, 5, 20, 1, 5])]
+    monkeypatch.setattr(file_packer, "_pack_knapsack", None)
+    packed = pack_files(entries, 200, count_tokens, skeleton_min_tokens=None)
+    # The most files for the budget, the small ones
+    assert [e.file_path for e, _, _ in packed] == [entries[n].file_path for n in (1, 2, 4, 5)]
+
+
+def test_skeleton_when_the_file_does_not_fit():
+    big, small = entry(0, 60, 10), entry(1, 1, 1)
+    packed = pack_files([big, small], big.tokens - 1, count_tokens, in_progress=f"Fix {big.file_path}")
+    assert packed[0][1].startswith("\n```\n// src/components/Component0.js\n// (skeleton")
+    assert [e for e, _, _ in packed] == [big, small]
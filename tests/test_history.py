@@ -0,0 +1,238 @@
+import json
+import os
+from array import array
+
+import pytest
+from langchain.memory.chat_message_histories import FileChatMessageHistory
+from langchain.schema.messages import AIMessage, HumanMessage, SystemMessage
+
+from history import HistoryCompactor, JournalChatMessageHistory
+
+
+def step_messages(step, file_path="", code=""):
+    return [
+        HumanMessage(content=f"You have completed step {step - 1}."),
+        AIMessage(content=json.dumps({"command": {"name": "write_file", "args": {"file_path": file_path}}})),
+        SystemMessage(content="File written successfully", additional_kwargs={"metadata": f"step {step}", "code": code, "file_path": file_path}),
+    ]
+
+
+def write_steps(journal, steps):
+    messages = []
+    for step in range(1, steps + 1):
+        for message in step_messages(step, f"src/File{step % 3}.js", f"// version {step}\n"):
+            journal.add_message(message)
+            messages.append(message)
+    return messages
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "history.jsonl")
+
+
+def read_offsets(index_path):
+    offsets = array("Q")
+    with open(index_path, "rb") as f:
+        offsets.frombytes(f.read())
+    return list(offsets)
+
+
+def test_reopen(path):
+    journal = JournalChatMessageHistory(path)
+    messages = write_steps(journal, 4)
+    journal.close()
+    journal = JournalChatMessageHistory(path)
+    assert journal.messages == messages
+    assert len(journal) == 12 and journal.recovered_bytes == 0
+    assert journal.tail(2) == messages[-2:]
+
+
+def test_torn_last_line_is_cut_off(path):
+    journal = JournalChatMessageHistory(path)
+    messages = write_steps(journal, 2)
+    journal.close()
+    size = os.path.getsize(path)
+    with open(path, "ab") as f:
+        f.write(b'{"type":"human","data":{"content":"You have comp')
+    journal = JournalChatMessageHistory(path)
+    assert journal.recovered_bytes == 48
+    assert os.path.getsize(path) == size
+    assert journal.messages == messages
+    # The next message starts on its own line
+    journal.add_message(HumanMessage(content="next"))
+    journal.close()
+    assert JournalChatMessageHistory(path).messages == messages + [HumanMessage(content="next")]
+
+
+def test_torn_index_entry(path):
+    journal = JournalChatMessageHistory(path)
+    messages = write_steps(journal, 2)
+    journal.close()
+    with open(f"{path}.idx", "ab") as f:
+        f.write(b"\x01\x02\x03")
+    journal = JournalChatMessageHistory(path)
+    assert len(journal) == len(messages)
+    assert journal.tail(1) == messages[-1:]
+
+
+def test_lines_missed_by_the_index_are_indexed(path):
+    journal = JournalChatMessageHistory(path)
+    messages = write_steps(journal, 3)
+    journal.close()
+    offsets = read_offsets(f"{path}.idx")
+    # The index was not flushed when the journal was
+    with open(f"{path}.idx", "wb") as f:
+        f.write(array("Q", offsets[:4]).tobytes())
+    journal = JournalChatMessageHistory(path)
+    assert read_offsets(f"{path}.idx") == offsets
+    assert journal.tail(3) == messages[-3:]
+
+
+@pytest.mark.parametrize("damage", ["deleted", "wrong offsets", "past the end"])
+def test_lost_index_is_rebuilt(path, damage):
+    journal = JournalChatMessageHistory(path)
+    messages = write_steps(journal, 3)
+    journal.close()
+    offsets = read_offsets(f"{path}.idx")
+    if damage == "deleted":
+        os.remove(f"{path}.idx")
+    else:
+        wrong = [offset + 5 for offset in offsets] if damage == "wrong offsets" else offsets + [10 ** 9]
+        with open(f"{path}.idx", "wb") as f:
+            f.write(array("Q", wrong).tobytes())
+    journal = JournalChatMessageHistory(path)
+    assert read_offsets(f"{path}.idx") == offsets
+    assert journal.tail(4) == messages[-4:]
+    assert journal.messages == messages
+
+
+def test_compaction_keeps_the_latest_code_of_each_file(path):
+    journal = JournalChatMessageHistory(path)
+    messages = write_steps(journal, 7)
+    size = os.path.getsize(path)
+    saved = journal.compact()
+    assert saved > 0 and os.path.getsize(path) == size - saved
+    codes = {}
+    for message in journal.messages:
+        if isinstance(message, SystemMessage) and "code" in message.additional_kwargs:
+            codes.setdefault(message.additional_kwargs["file_path"], []).append(message.additional_kwargs["code"])
+    # Steps 5, 6 and 7 wrote the last versions of the three files
+    assert codes == {"src/File2.js": ["// version 5\n"], "src/File0.js": ["// version 6\n"], "src/File1.js": ["// version 7\n"]}
+    assert [m.content for m in journal.messages] == [m.content for m in messages]
+    journal.add_message(HumanMessage(content="next"))
+    journal.close()
+    reopened = JournalChatMessageHistory(path)
+    assert reopened.recovered_bytes == 0
+    assert len(reopened.messages) == len(messages) + 1
+
+
+def test_truncate(path):
+    journal = JournalChatMessageHistory(path)
+    messages = write_steps(journal, 3)
+    journal.truncate(5)
+    assert journal.messages == messages[:5]
+    journal.close()
+    assert JournalChatMessageHistory(path).messages == messages[:5]
+
+
+def test_legacy_json_file_is_converted(path):
+    legacy = FileChatMessageHistory(path)
+    messages = step_messages(1, "src/App.js", "// app\n")
+    for message in messages:
+        legacy.add_message(message)
+    journal = JournalChatMessageHistory(path)
+    assert journal.messages == messages
+    with open(path, encoding="utf-8") as f:
+        assert len(f.readlines()) == 3
+
+
+def metadata(step, action):
+    return f"```json\n{json.dumps({'step': step, 'Action': action, 'Result': 'ok'})}\n```"
+
+
+def agent_step(step, file_path, action="write_file", result="File written successfully"):
+    code = f"\n```\n// {file_path}\nexport const version = {step};\n```" if action != "cli" else ""
+    return [
+        HumanMessage(content=f"You have completed step {step - 1}."),
+        AIMessage(content=json.dumps({"command": {"name": action, "args": {"file_path": file_path}}})),
+        SystemMessage(
+            content=result,
+            additional_kwargs={"metadata": metadata(step, action), "code": code, "file_path": file_path if code else ""},
+        ),
+    ]
+
+
+def project_step(step):
+    if step % 4 == 0:
+        return agent_step(step, "", action="cli", result="Command 'npm test' failed with error: 1 failed")
+    return agent_step(step, f"src/File{step % 3}.js")
+
+
+def project(steps):
+    return [message for step in range(1, steps + 1) for message in project_step(step)]
+
+
+def latest_code(messages):
+    files = {}
+    for message in messages:
+        if message.type == "system" and message.additional_kwargs.get("code"):
+            files[message.additional_kwargs["file_path"]] = message.additional_kwargs["code"]
+    return files
+
+
+def test_compactor_keeps_the_recent_steps_verbatim():
+    messages = project(20)
+    full = list(messages)
+    HistoryCompactor(max_messages=9).compact(messages)
+    assert messages[-9:] == full[-9:]
+    collapsed = messages[:-9]
+    assert len(collapsed) == 17
+    assert all(m.additional_kwargs["compacted"] for m in collapsed)
+    assert collapsed[0].content == "Step 1: write_file (written)"
+    assert collapsed[3].content == "Step 4: cli (failed)"
+
+
+def test_compactor_bounds_the_bytes():
+    messages = project(20)
+    HistoryCompactor(max_bytes=1000).compact(messages)
+    verbatim = [m for m in messages if not m.additional_kwargs.get("compacted")]
+    assert 0 < sum(len(m.content) + sum(len(v) for v in m.additional_kwargs.values() if isinstance(v, str)) for m in verbatim) <= 1000
+
+
+def test_compactor_always_keeps_the_last_step():
+    messages = project(3)
+    HistoryCompactor(max_messages=1).compact(messages)
+    assert len(messages) == 5 and messages[-3].type == "human"
+
+
+def test_compaction_keeps_the_file_index():
+    messages = project(30)
+    expected = latest_code(messages)
+    HistoryCompactor(max_messages=6).compact(messages)
+    assert latest_code(messages) == expected
+    # Only one message has the code of each file
+    assert sum(bool(m.additional_kwargs.get("code")) for m in messages) == len(expected)
+
+
+def test_incremental_compaction_matches_one_pass():
+    compactor = HistoryCompactor(max_messages=12)
+    incremental = []
+    for step in range(1, 31):
+        incremental += project_step(step)
+        compactor.compact(incremental)
+    one_pass = project(30)
+    HistoryCompactor(max_messages=12).compact(one_pass)
+    assert [m.content for m in incremental] == [m.content for m in one_pass]
+    assert latest_code(incremental) == latest_code(one_pass)
+    assert compactor.stats["steps_collapsed"] == 26
+
+
+def test_compacting_the_journal_messages_keeps_the_journal(path):
+    journal = JournalChatMessageHistory(path)
+    for message in project(10):
+        journal.add_message(message)
+    HistoryCompactor(max_messages=3).compact(journal.messages)
+    assert len(journal.messages) == 12
+    journal.close()
+    assert len(JournalChatMessageHistory(path).messages) == 30
@@ -0,0 +1,161 @@
+import asyncio
+import json
+
+import pytest
+from langchain.schema.messages import AIMessage, HumanMessage, SystemMessage
+
+from fakes import ScriptedChatModel
+from llm_cache import CacheMissError, LLMCache, RecordReplayChatModel
+
+
+def cached(path, mode, responses=(), **kwargs):
+    cache = LLMCache(str(path), mode=mode)
+    return cache, RecordReplayChatModel(llm=ScriptedChatModel(responses=list(responses), **kwargs), llm_cache=cache)
+
+
+def ask(model, content):
+    return model.invoke([HumanMessage(content=content)]).content
+
+
+@pytest.fixture
+def key(tmp_path):
+    caches = {normalize: LLMCache(str(tmp_path / f"{normalize}.jsonl"), normalize=normalize) for normalize in (False, True)}
+
+    def key(content, normalize=False, **params):
+        return caches[normalize].key("gpt-4", 0.2, [HumanMessage(content=content)], **params)
+
+    yield key
+    for cache in caches.values():
+        cache.close()
+
+
+def test_keys_are_exact_by_default(key):
+    assert key("Tests: 3 passed in 2.1 s") != key("Tests: 3 passed in 4.7 s")
+    assert key("see /tmp/run-1/out.log") != key("see /tmp/run-2/out.log")
+    assert key("commit ab12cd34") != key("commit ef56ab78")
+    assert key("x") != key("x", stop=["\n"])
+
+
+def test_normalized_keys_keep_counts(key):
+    assert key("Tests: 3 passed in 2.1 s", normalize=True) == key("Tests: 3 passed in 4.7 s", normalize=True)
+    assert key("Tests: 1234567 passed in 3.1 s", normalize=True) != key("Tests: 1234568 passed in 3.1 s", normalize=True)
+
+
+def test_key_of_the_message_types_and_function_calls(tmp_path):
+    cache = LLMCache(str(tmp_path / "transcript.jsonl"))
+    call = AIMessage(content="", additional_kwargs={"function_call": {"name": "cli", "arguments": "{}"}})
+    keys = {
+        cache.key("gpt-4", 0.2, messages)
+        for messages in ([HumanMessage(content="a")], [SystemMessage(content="a")], [call], [AIMessage(content="")])
+    }
+    assert len(keys) == 4
+    cache.close()
+
+
+def test_record_then_replay(tmp_path):
+    path = tmp_path / "transcript.jsonl"
+    cache, model = cached(path, "record", ["first", "second", "other"])
+    assert [ask(model, "step"), ask(model, "step"), ask(model, "other step")] == ["first", "second", "other"]
+    cache.close()
+    assert cache.stats["recorded"] == 3 and len(path.read_text().splitlines()) == 3
+
+    # The model of the replay has no responses, every call comes from the transcript
+    cache, model = cached(path, "replay")
+    assert len(cache) == 3
+    assert [ask(model, "other step"), ask(model, "step"), ask(model, "step")] == ["other", "first", "second"]
+    assert cache.stats["hits"] == 3 and cache.stats["misses"] == 0
+    cache.close()
+
+
+def test_replay_miss_raises(tmp_path):
+    path = tmp_path / "transcript.jsonl"
+    cache, model = cached(path, "record", ["first"])
+    ask(model, "step")
+    cache.close()
+    cache, model = cached(path, "replay")
+    with pytest.raises(CacheMissError):
+        ask(model, "another step")
+    ask(model, "step")
+    # A call replayed more times than it was recorded is a miss as well
+    with pytest.raises(CacheMissError):
+        ask(model, "step")
+    assert cache.stats["misses"] == 2
+    cache.close()
+
+
+def test_read_through_calls_the_model_on_misses(tmp_path):
+    path = tmp_path / "transcript.jsonl"
+    cache, model = cached(path, "record", ["first"])
+    ask(model, "step")
+    cache.close()
+
+    cache, model = cached(path, "read-through", ["second", "new"])
+    assert ask(model, "step") == "first"
+    # Once the recorded responses are used up, the model is called rather than repeating them
+    assert ask(model, "step") == "second"
+    assert ask(model, "new step") == "new"
+    assert (cache.stats["hits"], cache.stats["misses"], cache.stats["recorded"]) == (1, 2, 2)
+    cache.close()
+
+    cache, model = cached(path, "replay")
+    assert [ask(model, "step"), ask(model, "step"), ask(model, "new step")] == ["first", "second", "new"]
+    cache.close()
+
+
+def test_torn_line_is_cut_off(tmp_path):
+    path = tmp_path / "transcript.jsonl"
+    cache, model = cached(path, "record", ["first"])
+    ask(model, "step")
+    cache.close()
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"key": "to')
+    cache = LLMCache(str(path), mode="replay")
+    assert len(cache) == 1
+    cache.close()
+    assert all(json.loads(line) for line in path.read_text().splitlines())
+
+
+def test_unknown_mode(tmp_path):
+    with pytest.raises(ValueError, match="Unknown LLM cache mode"):
+        LLMCache(str(tmp_path / "transcript.jsonl"), mode="write")
+
+
+def stream(model, content, stop_after=None):
+    chunks = []
+    for chunk in model.stream([HumanMessage(content=content)]):
+        chunks.append(chunk.content)
+        if stop_after is not None and "".join(chunks).endswith(stop_after):
+            break
+    return chunks
+
+
+def astream(model, content):
+    async def collect():
+        return [chunk.content async for chunk in model.astream([HumanMessage(content=content)])]
+
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize("async_stream", [False, True])
+def test_stream_recorded_then_replayed_in_one_chunk(tmp_path, async_stream):
+    path = tmp_path / "transcript.jsonl"
+    reply = '{"command": {"name": "write_file"}}'
+    cache, model = cached(path, "record", [reply], chunk_size=4)
+    chunks = astream(model, "step") if async_stream else stream(model, "step")
+    assert len(chunks) > 1 and "".join(chunks) == reply
+    cache.close()
+
+    cache, model = cached(path, "replay")
+    assert (astream(model, "step") if async_stream else stream(model, "step")) == [reply]
+    cache.close()
+
+
+def test_stream_stopped_early_is_replayed_up_to_the_same_point(tmp_path):
+    path = tmp_path / "transcript.jsonl"
+    cache, model = cached(path, "record", ['{"done": true} and more text'], chunk_size=2)
+    assert "".join(stream(model, "step", stop_after="}")) == '{"done": true}'
+    cache.close()
+
+    cache, model = cached(path, "replay")
+    assert stream(model, "step") == ['{"done": true}']
+    cache.close()
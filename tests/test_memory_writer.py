@@ -0,0 +1,75 @@
+from typing import List
+
+import faiss
+import pytest
+from langchain.docstore import InMemoryDocstore
+from langchain.schema import Document
+from langchain.schema.embeddings import Embeddings
+from langchain.vectorstores import FAISS
+
+from memory_writer import HashingEmbeddings, MemoryWriter
+
+STEPS = [
+    "Command write_file wrote src/components/Counter.js",
+    "Command cli ran npm test: 3 passed",
+    "Command read_file read src/App.css",
+    "Command write_file wrote src/components/Header.js",
+]
+
+
+class CountingEmbeddings(Embeddings):
+    def __init__(self):
+        self.embeddings = HashingEmbeddings(size=256)
+        self.texts: List[str] = []
+        self.requests = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.requests += 1
+        self.texts.extend(texts)
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def writer(batch_size, metric=faiss.METRIC_L2):
+    embeddings = CountingEmbeddings()
+    index = faiss.IndexFlatL2(256) if metric == faiss.METRIC_L2 else faiss.IndexFlatIP(256)
+    vectorstore = FAISS(embeddings, index, InMemoryDocstore({}), {})
+    return MemoryWriter(vectorstore.as_retriever(), batch_size=batch_size), embeddings
+
+
+@pytest.mark.parametrize("metric", [faiss.METRIC_L2, faiss.METRIC_INNER_PRODUCT])
+def test_search_sees_pending_documents(metric):
+    memory, embeddings = writer(batch_size=16, metric=metric)
+    for step in STEPS:
+        memory.add(Document(page_content=step))
+    assert memory.pending == len(STEPS)
+    results = memory.search("write_file src/components/Header.js", k=2)
+    assert [document.page_content for document in results][0] == STEPS[3]
+    assert len(results) == 2
+
+
+def test_search_merges_added_and_pending():
+    memory, _ = writer(batch_size=2)
+    for step in STEPS[:3]:
+        memory.add(Document(page_content=step))
+    assert memory.pending == 1
+    assert memory.search("read_file src/App.css", k=1)[0].page_content == STEPS[2]
+    assert memory.search("npm test passed", k=1)[0].page_content == STEPS[1]
+
+
+def test_pending_documents_are_embedded_once():
+    memory, embeddings = writer(batch_size=16)
+    memory.add(Document(page_content=STEPS[0]))
+    memory.search("first query")
+    memory.add(Document(page_content=STEPS[1]))
+    memory.search("second query")
+    memory.search("third query")
+    memory.add(Document(page_content=STEPS[2]))
+    memory.flush()
+    # One request per search, the new pending documents with the query, and one for the unsearched rest
+    assert embeddings.requests == 4
+    assert sorted(text for text in embeddings.texts if text in STEPS) == sorted(STEPS[:3])
+    assert memory.pending == 0
+    assert memory.search("npm test passed", k=1)[0].page_content == STEPS[1]
@@ -0,0 +1,47 @@
+import json
+import os
+
+import pytest
+
+from output_parsers import default_registry
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks", "data", "command_outputs.jsonl")
+
+with open(CORPUS, encoding="utf-8") as f:
+    CASES = [json.loads(line) for line in f if line.strip()]
+
+
+def describe(command_report):
+    if command_report is None:
+        return None
+    return {
+        "tools": [r.tool for r in command_report.reports],
+        "passed": sum(r.passed for r in command_report.reports),
+        "failed": sum(r.failed for r in command_report.reports),
+        "failures": [[f.name, f.file, f.line] for r in command_report.reports for f in r.failures],
+    }
+
+
+@pytest.mark.parametrize("case", CASES, ids=[case["name"] for case in CASES])
+def test_corpus(case):
+    assert describe(default_registry().parse(case["commands"], case["observation"])) == case["expected"]
+
+
+def test_split_at_the_npm_script_header():
+    output = "added 3 packages in 2s\n\n> app@1.0.0 postinstall\n> husky install\n\n> app@1.0.0 test\n> jest\n\nPASS src/App.test.js\n"
+    install, test = default_registry().split_output(["npm install", "npm test"], output)
+    assert install.endswith("> husky install\n\n")
+    assert test.startswith("> app@1.0.0 test\n")
+
+
+def test_split_at_the_first_line_of_the_tool():
+    output = "Collecting flask\nSuccessfully installed flask-2.3.3\n============ test session starts ============\n1 passed in 0.01s\n"
+    install, test = default_registry().split_output(["pip install flask", "pytest"], output)
+    assert install == "Collecting flask\nSuccessfully installed flask-2.3.3\n"
+    assert test.startswith("============ test session starts")
+
+
+def test_command_without_a_start_shares_the_previous_output():
+    output = "src/App.tsx(12,5): error TS2322: Type 'string' is not assignable to type 'number'.\n"
+    # Neither eslint nor tsc print a first line of their own
+    assert default_registry().split_output(["npx tsc", "npx eslint src"], output) == [output, output]
@@ -0,0 +1,92 @@
+import json
+import os
+
+import pytest
+
+from reply_parser import JSONRepairer, ReplyParseError, ReplyParser
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks", "data", "replies.jsonl")
+
+with open(CORPUS, encoding="utf-8") as f:
+    CASES = [json.loads(line) for line in f if line.strip()]
+VALID = [case for case in CASES if case["valid"]]
+
+
+def chunks(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("case", CASES, ids=[case["name"] for case in CASES])
+def test_corpus(case):
+    if case["valid"]:
+        parsed = ReplyParser().parse(case["reply"])
+        assert parsed["command"] == case["command"]
+        assert parsed["thoughts"]["text"] == "Implement the counter."
+    else:
+        with pytest.raises(ReplyParseError, match=case["error"]):
+            ReplyParser().parse(case["reply"])
+
+
+@pytest.mark.parametrize("size", [1, 7, 64])
+@pytest.mark.parametrize("case", VALID, ids=[case["name"] for case in VALID])
+def test_streamed_chunks(case, size):
+    repairer = JSONRepairer()
+    keys = []
+    for chunk in chunks(case["reply"], size):
+        keys.extend(key for key, _ in repairer.feed(chunk))
+        if repairer.complete:
+            break
+    else:
+        # The stream ended, as the agent does the parser closes what was left open
+        keys.extend(key for key, _ in repairer.finish())
+    parsed = ReplyParser().parse(repairer.result(), repairer)
+    assert parsed["command"] == case["command"]
+    # Every top-level key is reported once, as soon as its value is complete
+    assert len(keys) == len(set(keys))
+    assert keys.index("command") > keys.index("thoughts")
+
+
+def test_stream_complete_before_closing_brace():
+    reply = VALID[0]["reply"]
+    repairer = JSONRepairer()
+    repairer.feed(reply[:-1])
+    assert repairer.complete and not repairer.done
+    assert json.loads(repairer.result())["command"] == VALID[0]["command"]
+
+
+def test_truncated_after_command():
+    reply = VALID[0]["reply"].rstrip()[:-1]
+    parsed = ReplyParser().parse(reply)
+    assert parsed["command"] == VALID[0]["command"]
+
+
+@pytest.mark.parametrize("cut", [0.5, 0.9])
+def test_truncated_inside_command(cut):
+    case = next(case for case in VALID if case["command"]["name"] == "write_file")
+    reply = case["reply"]
+    start = reply.index('"command"')
+    reply = reply[:start + int((len(reply) - start) * cut)]
+    with pytest.raises(ReplyParseError):
+        ReplyParser().parse(reply)
+
+
+def test_error_in_stream_stops_feeding():
+    repairer = JSONRepairer()
+    repairer.feed('{"thoughts": }')
+    assert repairer.error is not None
+    assert repairer.feed('"more"') == []
+
+
+@pytest.mark.parametrize("reply", ['{"tho\\ughts": 1', '{"a\\u00": 1}', '{"\\ud8": {"text": "x"}}'])
+def test_invalid_unicode_escape_in_key(reply):
+    with pytest.raises(ReplyParseError, match="missing the key"):
+        ReplyParser().parse(reply)
+
+
+def test_invalid_unicode_escape_in_value():
+    repairer = JSONRepairer()
+    for chunk in chunks('{"text": "C:\\users \\u00e9 \\u12', 3):
+        repairer.feed(chunk)
+    repairer.finish()
+    assert repairer.error is None
+    assert repairer.values == {"text": "C:\\users \u00e9 \\u12"}
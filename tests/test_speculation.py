@@ -0,0 +1,162 @@
+import os
+import stat
+
+import pytest
+
+from cli import CLITool, ShellSession
+from speculation import TestSpeculator, workspace_fingerprint
+
+# Stands in for pytest: logs its run, prints what the run depends on and writes test outputs
+FAKE_PYTEST = """#!/bin/sh
+echo run >> {log}
+[ -n "$SLOW" ] && sleep 30
+echo "marker=${{MARKER:-none}}"
+cat calc.py
+mkdir -p __snapshots__ coverage
+date +%s%N > __snapshots__/calc.snap
+date +%s%N > coverage/lcov.info
+date +%s%N > .coverage
+"""
+
+
+@pytest.fixture
+def project(tmp_path):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    fake = bin_dir / "pytest"
+    fake.write_text(FAKE_PYTEST.format(log=tmp_path / "runs.log"))
+    fake.chmod(fake.stat().st_mode | stat.S_IEXEC)
+    project = tmp_path / "project"
+    project.mkdir()
+    (project / "calc.py").write_text("version 1\n")
+    return project
+
+
+@pytest.fixture
+def on_path(project, monkeypatch):
+    monkeypatch.setenv("PATH", f"{project.parent / 'bin'}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.chdir(project)
+
+
+def runs(project):
+    log = project.parent / "runs.log"
+    return len(log.read_text().splitlines()) if log.exists() else 0
+
+
+@pytest.fixture
+def speculator(project, on_path):
+    speculator = TestSpeculator(str(project), timeout_sec=10)
+    yield speculator
+    speculator.close()
+
+
+def edit(project, content):
+    (project / "calc.py").write_text(content)
+
+
+def test_nothing_to_speculate_before_a_test_command(speculator):
+    assert not speculator.start()
+    assert speculator.claim("ls") is None
+    assert not speculator.start()
+    assert speculator.claim(["cd .", "pytest -q"]) is None
+    assert speculator.test_command == "cd . && pytest -q"
+    assert speculator.start()
+
+
+def test_hit(speculator, project):
+    speculator.claim("pytest")
+    edit(project, "version 2\n")
+    assert speculator.start()
+    output = speculator.claim("pytest")
+    assert output.startswith("Command 'pytest' succeeded") and "version 2" in output
+    assert runs(project) == 1
+    assert speculator.stats["hits"] == 1 and speculator.hit_rate == 1.0
+
+
+def test_test_outputs_do_not_invalidate_the_run(speculator, project):
+    speculator.claim("pytest")
+    speculator.start()
+    speculator._pending.future.result()
+    # The run wrote its snapshots and coverage, the workspace is the same for the next run
+    assert (project / ".coverage").exists() and (project / "__snapshots__" / "calc.snap").exists()
+    assert speculator.claim("pytest") is not None
+    assert speculator.stats["hits"] == 1
+
+
+def test_miss_after_an_edit(speculator, project):
+    speculator.claim("pytest")
+    speculator.start()
+    speculator._pending.future.result()
+    edit(project, "version 3, longer\n")
+    assert speculator.claim("pytest") is None
+    assert speculator.stats["misses"] == 1 and speculator.stats["cancelled"] == 1
+    assert speculator._pending is None
+
+
+def test_fingerprint_sees_an_edit_of_the_same_size(project):
+    before = workspace_fingerprint(str(project))
+    edit(project, "version 9\n")
+    os.utime(project / "calc.py", ns=(0, 0))
+    assert workspace_fingerprint(str(project)) != before
+
+
+def test_other_command_cancels_the_run(speculator, project, monkeypatch):
+    monkeypatch.setenv("SLOW", "1")
+    speculator.claim("pytest")
+    speculator.start()
+    run = speculator._pending
+    assert speculator.claim("ls") is None
+    # The run is killed rather than left to finish its 30 seconds
+    assert run.future.result(timeout=5).startswith("Command 'pytest' was cancelled")
+    assert speculator.stats["cancelled"] == 1 and speculator.stats["hits"] == 0
+
+
+def test_start_cancels_the_previous_run(speculator, monkeypatch):
+    monkeypatch.setenv("SLOW", "1")
+    speculator.claim("pytest")
+    speculator.start()
+    first = speculator._pending
+    speculator.start()
+    assert first.future.result(timeout=5).startswith("Command 'pytest' was cancelled")
+    assert speculator.stats["started"] == 2 and speculator.stats["cancelled"] == 1
+
+
+def test_cli_tool_falls_back_to_a_real_run(speculator, project):
+    tool = CLITool(speculator=speculator)
+    output, source = tool._run_commands(["pytest"])
+    assert source == "shell" and "version 1" in output
+
+    speculator.start()
+    edit(project, "version 2, edited after the start\n")
+    output, source = tool._run_commands(["pytest"])
+    assert source == "shell" and "version 2" in output
+
+    before = runs(project)
+    speculator.start()
+    output, source = tool._run_commands(["pytest"])
+    assert source == "speculated" and "version 2" in output
+    assert runs(project) == before + 1
+
+
+def test_runs_in_the_environment_of_the_session(project):
+    session = ShellSession(cwd=str(project.parent))
+    speculator = TestSpeculator(str(project), session=session, timeout_sec=10)
+    try:
+        assert session.environment() is None
+        # As activating a virtualenv does
+        session.run(f"cd project && export PATH={project.parent / 'bin'}:$PATH MARKER=venv", 10)
+        assert session.environment()["MARKER"] == "venv"
+        speculator.claim("pytest")
+        speculator.start()
+        output = speculator.claim("pytest")
+        assert "marker=venv" in output and "version 1" in output
+        assert output == session.run("pytest", 10)
+
+        # A restarted session has lost the variables, and so has the speculative run
+        session.close()
+        assert session.environment() is None
+        speculator.start()
+        assert "marker=venv" not in speculator.claim("pytest")
+    finally:
+        speculator.close()
+        session.close()
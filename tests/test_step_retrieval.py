@@ -0,0 +1,47 @@
+import json
+
+from langchain.schema import Document
+
+from file_index import parse_metadata
+from step_retrieval import select_past_steps
+
+
+def record(step, action, result):
+    metadata = {"step": step, "kanban": {"in_progress": "Counter"}, "Action": action, "Result": result}
+    return f"```json\n{json.dumps(metadata, indent=4)}\n```"
+
+
+def words(text):
+    return len(text.split())
+
+
+def select(documents, last_step, budget=10_000, **kwargs):
+    records, _ = select_past_steps([Document(page_content=text) for text in documents], budget, words, last_step=parse_metadata(last_step), **kwargs)
+    return records
+
+
+def test_same_step_number_of_another_run_is_kept():
+    earlier_run = [record(7, "running cli npm test", "FAIL default export"), record(3, "writing file src/Counter.js", "code")]
+    last_step = record(7, "writing file src/Header.js", "code")
+    # The step 7 and the step 3 of an earlier run, step 3 of this run, and the last step itself
+    documents = earlier_run + [record(3, "reading file src/App.js", "app"), last_step]
+    assert select(documents, last_step) == [earlier_run[1], documents[2], earlier_run[0]]
+
+
+def test_repeated_record_is_kept_once():
+    documents = [record(2, "running cli npm test", "FAIL"), record(2, "running cli npm test", "FAIL")]
+    assert select(documents, record(5, "writing file src/App.js", "code")) == documents[:1]
+
+
+def test_earlier_runs_of_the_last_action_are_dropped():
+    documents = [record(2, "running cli npm test", "FAIL"), record(4, "reading file src/App.js", "app")]
+    assert select(documents, record(6, "running cli npm test", "PASS")) == documents[1:]
+
+
+def test_budget_limit_and_files():
+    documents = [record(i, f"writing file src/File{i}.js", "long code " * 20) for i in range(1, 5)]
+    records = select(documents, record(9, "running cli npm test", "FAIL"), files={"src/File2.js"})
+    assert parse_metadata(records[1])["Result"] == "(see the Files section)"
+    assert len(select(documents, record(9, "running cli npm test", "FAIL"), limit=2)) == 2
+    budget = words(documents[0])
+    assert select(documents, record(9, "running cli npm test", "FAIL"), budget=budget) == documents[:1]
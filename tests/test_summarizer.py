@@ -0,0 +1,189 @@
+import asyncio
+import re
+from typing import Any, AsyncIterator, List
+
+import pytest
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import ChatResult
+from langchain.schema.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain.schema.output import ChatGeneration, ChatGenerationChunk
+
+from fakes import ScriptedChatModel
+from summarizer import TextSummarizer, extract_summary
+from summary_cache import SummaryCache
+
+
+def words(text):
+    return len(text.split())
+
+
+def summarizer(llm=None, **kwargs):
+    kwargs = {"passthrough_tokens": 30, "extractive_tokens": 200, "extract_tokens": 40, **kwargs}
+    return TextSummarizer("cli", words, llm=llm or ScriptedChatModel(responses=[]), **kwargs)
+
+
+def name(i):
+    # Lines that only differ in digits are collapsed as repeats
+    return "".join("abcdefghij"[int(digit)] for digit in str(i))
+
+
+def output(lines):
+    return "\n".join(f"line {name(i)} of the output" for i in range(lines))
+
+
+@pytest.mark.parametrize("lines, tier", [(1, "passthrough"), (6, "passthrough"), (7, "extractive"), (40, "extractive"), (41, "map_reduce")])
+def test_tier_by_size(lines, tier):
+    # Five words a line, against 30 and 200 tokens
+    assert summarizer().tier(output(lines)) == tier
+
+
+def test_passthrough_is_verbatim():
+    text = output(5)
+    text_summarizer = summarizer()
+    assert text_summarizer.summarize_tiered(text) == (text, "passthrough")
+
+
+def test_extractive_tier_stays_local():
+    text_summarizer = summarizer()
+    summary, tier = text_summarizer.summarize_tiered(output(40))
+    assert tier == "extractive" and words(summary) <= 40 + 20
+    assert text_summarizer.stats == {"passthrough": 0, "extractive": 1, "cached": 0, "map_reduce": 0}
+
+
+def test_cached_tier_skips_the_model(tmp_path):
+    cache = SummaryCache(str(tmp_path / "summaries.db"))
+    text = output(60)
+    cache.put("cli", text, "The commands succeeded with the message done")
+    text_summarizer = summarizer(cache=cache)
+    assert text_summarizer.summarize_tiered(text) == ("The commands succeeded with the message done", "cached")
+    cache.close()
+
+
+def test_map_reduce_tier_is_cached(tmp_path):
+    cache = SummaryCache(str(tmp_path / "summaries.db"))
+    text_summarizer = summarizer(llm=ScriptedChatModel(responses=["The commands succeeded"]), cache=cache, chunk_tokens=1000)
+    text = output(60)
+    assert text_summarizer.summarize_tiered(text) == ("The commands succeeded", "map_reduce")
+    # The model has no response left, the summary comes from the cache
+    assert text_summarizer.summarize_tiered(text) == ("The commands succeeded", "cached")
+    cache.close()
+
+
+def test_extract_keeps_status_errors_head_and_tail():
+    lines = ["Command 'npm test' failed with error:"]
+    lines += [f"  progress {name(i)}" for i in range(40)]
+    lines += ["FAIL src/App.test.js", "  TypeError: formatCount is not a function"]
+    lines += [f"  detail {name(i)} of the stack" for i in range(40)]
+    lines += ["Tests: 1 failed, 12 passed, 13 total"]
+    summary = extract_summary("\n".join(lines), words, max_tokens=120, head_lines=3, tail_lines=4)
+    kept = summary.split("\n")
+    assert kept[0] == lines[0]
+    assert "FAIL src/App.test.js" in kept and "  TypeError: formatCount is not a function" in kept
+    assert kept[-1] == "Tests: 1 failed, 12 passed, 13 total"
+    assert kept[-4:-1] == [f"  detail {name(i)} of the stack" for i in range(37, 40)]
+    assert "  progress b" in kept and "  progress c" not in kept
+
+
+def test_extract_collapses_repeated_lines():
+    text = "\n".join(["start"] + [f"Downloading package {i} in 0.{i}s" for i in range(30)] + ["done"])
+    assert extract_summary(text, words) == "start\nDownloading package 0 in 0.0s (repeated 30 times)\ndone"
+
+
+def test_extract_marks_the_omitted_lines_and_fits_the_budget():
+    text = "\n".join(f"step {name(i)} compiled" for i in range(200))
+    summary = extract_summary(text, words, max_tokens=50, head_lines=5, tail_lines=5)
+    assert "... (" in summary and summary.split("\n")[0] == "step a compiled"
+    kept = [line for line in summary.split("\n") if not line.startswith("... (")]
+    assert sum(words(line) + 1 for line in kept) <= 50
+    omitted = sum(int(line.split("(")[1].split()[0]) for line in summary.split("\n") if line.startswith("... ("))
+    assert omitted + len(kept) == 200
+
+
+def test_extract_cuts_long_lines():
+    summary = extract_summary("x" * 2000, words)
+    assert summary == "x" * 500 + "..."
+
+
+class EchoChatModel(BaseChatModel):
+    """Summarizes the chunks by their ids, the later chunks answered first, and counts the calls in flight."""
+
+    delay: float = 0.05
+    chunk_size: int = 4
+    active: int = 0
+    peak: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "echo-chat-model"
+
+    def get_num_tokens(self, text: str) -> int:
+        return words(text)
+
+    def _reply(self, messages: List[BaseMessage]) -> str:
+        prompt = "".join(message.content for message in messages)
+        ids = list(dict.fromkeys(re.findall(r"chunk-\d+", prompt)))
+        return f"{'reduced' if '<summaries>' in prompt else 'summary'} {' '.join(ids)}"
+
+    def _generate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._reply(messages)))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        first = int(re.search(r"chunk-(\d+)", "".join(message.content for message in messages)).group(1))
+        await asyncio.sleep(self.delay / (1 + first))
+        self.active -= 1
+        return self._generate(messages)
+
+    async def _astream(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        reply = self._reply(messages)
+        for start in range(0, len(reply), self.chunk_size):
+            await asyncio.sleep(0)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=reply[start:start + self.chunk_size]))
+
+
+def chunked_output(chunks):
+    # Four lines of five words, a chunk of 20 tokens each
+    return "\n".join(f"chunk-{i} test output line {name(j)}" for i in range(chunks) for j in range(4))
+
+
+@pytest.mark.parametrize("max_concurrency", [1, 3, 16])
+def test_map_calls_bounded_by_the_concurrency(max_concurrency):
+    llm = EchoChatModel()
+    text_summarizer = summarizer(llm=llm, extractive_tokens=0, chunk_tokens=20, max_concurrency=max_concurrency)
+    asyncio.run(text_summarizer.amap_reduce(chunked_output(12)))
+    assert llm.peak == min(max_concurrency, 12) and llm.active == 0
+
+
+def test_chunk_order_survives_concurrent_completion():
+    text_summarizer = summarizer(llm=EchoChatModel(), extractive_tokens=0, chunk_tokens=20, max_concurrency=8)
+    summary = asyncio.run(text_summarizer.amap_reduce(chunked_output(12)))
+    # The later chunks were summarized first, the reduce still sees them in order
+    assert summary == "reduced " + " ".join(f"chunk-{i}" for i in range(12))
+
+
+def test_collapsed_summaries_keep_their_order():
+    text_summarizer = summarizer(llm=EchoChatModel(), extractive_tokens=0, chunk_tokens=20, max_concurrency=4)
+    # Summaries of two words, grouped by ten tokens before the final reduce
+    summary = asyncio.run(text_summarizer.amap_reduce(chunked_output(12), token_max=10))
+    assert summary == "reduced " + " ".join(f"chunk-{i}" for i in range(12))
+
+
+@pytest.mark.parametrize("chunks", [1, 12])
+def test_streamed_reduce_matches_the_sequential_chain(chunks):
+    text_summarizer = summarizer(llm=EchoChatModel(), passthrough_tokens=0, extractive_tokens=0, chunk_tokens=20)
+    text = chunked_output(chunks)
+    tokens = []
+    streamed, tier = asyncio.run(text_summarizer.asummarize_tiered(text, on_token=tokens.append))
+    assert tier == "map_reduce" and len(tokens) > 1 and "".join(tokens) == streamed
+
+    async def sequential():
+        # Within an event loop map_reduce runs the sequential langchain chain
+        return text_summarizer.map_reduce(text)
+
+    expected = asyncio.run(sequential())
+    if chunks == 1:
+        # A single chunk is summarized in one streamed call rather than mapped then reduced
+        assert streamed == "summary chunk-0" and expected == "reduced chunk-0"
+    else:
+        assert streamed == expected
@@ -0,0 +1,51 @@
+import pytest
+
+from summary_cache import SummaryCache, normalize_output, output_key
+
+COLLIDE = [
+    ("Time:        1.234 s\nTests: 3 passed", "Time:        12.5 s\nTests: 3 passed"),
+    ("Compiled successfully in 812ms", "Compiled successfully in 1043ms"),
+    ("Done in 2 min", "Done in 3 minutes"),
+    ("[2023-11-02T10:15:42.120Z] started", "[2023-11-03 08:01:07+01:00] started"),
+    ("elapsed 0:01:12.5", "elapsed 0:00:59.1"),
+    ("wrote /tmp/tmpa1b2c3/app/index.js", "wrote /tmp/tmpz9y8x7/app/index.js"),
+    ("Server running, pid: 4312", "Server running, pid: 977"),
+    ("HEAD is now at 3f2a9c1d Add counter", "HEAD is now at 9b8e7d6 Add counter"),
+    ("chunk main.4e5f6a7b.js", "chunk main.0c1d2e3f.js"),
+    ("\x1b[32mPASS\x1b[39m src/App.test.js", "PASS src/App.test.js"),
+]
+
+DISTINCT = [
+    ("added 1234567 packages", "added 1234568 packages"),
+    ("expected 10000000 to equal 10000001", "expected 10000000 to equal 20000000"),
+    ("the page was defaced", "the page was effaced"),
+    ("bundle.2s.js", "bundle.3s.js"),
+    ("Tests: 3 failed, 5 passed", "Tests: 4 failed, 5 passed"),
+    ("found 2 modules", "found 3 modules"),
+    ("Component2s.js", "Component3s.js"),
+    ("retries 2\nsrc/App.js", "retries 3\nsrc/App.js"),
+]
+
+
+@pytest.mark.parametrize("a, b", COLLIDE)
+def test_outputs_that_differ_by_noise_collide(a, b):
+    assert output_key(a) == output_key(b)
+
+
+@pytest.mark.parametrize("a, b", DISTINCT)
+def test_outputs_that_differ_by_meaning_do_not_collide(a, b):
+    assert output_key(a) != output_key(b)
+
+
+def test_normalized_output():
+    assert normalize_output("Ran 3 tests in 0.5s, pid=12 commit ab12cd34 defaced") == "Ran 3 tests in <time>, <id> commit <id> defaced"
+
+
+def test_cache_hit_across_runs(tmp_path):
+    path = str(tmp_path / "summaries.db")
+    cache = SummaryCache(path)
+    cache.put("summary", "Done in 812ms", "Build done")
+    cache.close()
+    cache = SummaryCache(path)
+    assert cache.get("summary", "Done in 99ms") == "Build done"
+    assert cache.get("summary", "Done in 99 modules") is None
@@ -0,0 +1,136 @@
+import json
+import os
+
+import pytest
+
+from cli import ShellSession
+from test_runner import TestRunner
+
+
+@pytest.fixture
+def project(tmp_path):
+    (tmp_path / "package.json").write_text(json.dumps({"scripts": {"test": "react-scripts test", "test:e2e": "playwright test"}}))
+    (tmp_path / "src").mkdir()
+    for name in ("App.js", "App.test.js"):
+        (tmp_path / "src" / name).write_text("")
+    return tmp_path
+
+
+@pytest.fixture
+def runner(project):
+    runner = TestRunner(cwd=str(project))
+    runner.notify_changed(str(project / "src" / "App.js"))
+    yield runner
+    runner.close()
+
+
+def flags(project):
+    return f"--watchAll=false --findRelatedTests {project / 'src' / 'App.js'}"
+
+
+@pytest.mark.parametrize("command", [
+    "npm install jest",
+    "npm install --save-dev jest @testing-library/react",
+    "cat jest.config.js",
+    "ls src/jest",
+    "npm run test:e2e",
+    "yarn test:unit",
+    "echo npm test",
+    "pip install pytest",
+    "cat pytest.ini",
+])
+def test_not_a_test_invocation(runner, command):
+    assert not runner.handles(command)
+    assert runner.rewrite(command) == (command, [])
+
+
+@pytest.mark.parametrize("command", [
+    "npm test", "npm run test", "yarn test", "npx jest", "jest", "CI=true npm test",
+    "npm install && npm test", "cd app && npx jest --coverage", "pytest", "python -m pytest -q",
+])
+def test_test_invocations(runner, command):
+    assert runner.handles(command)
+    assert runner.handles(command.split(" && "))
+
+
+def test_npm_test_arguments_go_after_the_separator(runner, project):
+    command, related = runner.rewrite("npm test")
+    assert command == f"npm test -- {flags(project)}"
+    assert related == [str(project / "src" / "App.js")]
+    assert runner.rewrite("npm install && npm test && echo done")[0] == f"npm install && npm test -- {flags(project)} && echo done"
+
+
+def test_jest_takes_the_arguments_directly(runner, project):
+    assert runner.rewrite("npx jest --coverage")[0] == f"npx jest --coverage {flags(project)}"
+    assert runner.rewrite("CI=true npx jest | tail -5")[0] == f"CI=true npx jest {flags(project)} | tail -5"
+
+
+def test_flags_already_present_are_not_repeated(runner, project):
+    related = f"--findRelatedTests {project / 'src' / 'App.js'}"
+    assert runner.rewrite("npm test -- --watchAll=false")[0] == f"npm test -- --watchAll=false {related}"
+    assert runner.rewrite("npm test -- --coverage")[0] == f"npm test -- --coverage {flags(project)}"
+    assert runner.rewrite("npx jest --watch=false")[0] == f"npx jest --watch=false {related}"
+    command = "npx jest --findRelatedTests src/App.js"
+    assert runner.rewrite(command) == (command, [])
+
+
+def test_full_run(runner):
+    assert runner.rewrite("npm test -- --all") == ("npm test -- --all", [])
+    assert runner.rewrite("pytest --all -q") == ("pytest -q", [])
+
+
+def test_no_changed_files_runs_everything(project):
+    runner = TestRunner(cwd=str(project))
+    assert runner.rewrite("npm test") == ("npm test", [])
+    runner.close()
+
+
+def test_npm_test_of_another_runner_is_left_alone(runner, project):
+    (project / "package.json").write_text(json.dumps({"scripts": {"test": "mocha"}}))
+    assert runner.rewrite("npm test") == ("npm test", [])
+    # jest given explicitly needs no test script
+    assert runner.rewrite("npx jest")[0] == f"npx jest {flags(project)}"
+
+
+def test_changed_files_outside_the_project_are_ignored(runner, project):
+    other = project / "other"
+    other.mkdir()
+    (other / "package.json").write_text(json.dumps({"scripts": {"test": "jest"}}))
+    assert runner.rewrite("cd other && npm test") == ("cd other && npm test", [])
+    assert runner.rewrite("cd src/.. && npm test")[0] == f"cd src/.. && npm test -- {flags(project)}"
+
+
+def test_pytest_selects_the_related_test_files(tmp_path):
+    (tmp_path / "tests").mkdir()
+    for name in ("calc.py", "other.py", "tests/test_calc.py", "tests/test_other.py", "tests/test_io.py"):
+        (tmp_path / name).write_text("")
+    runner = TestRunner(cwd=str(tmp_path))
+    runner.notify_changed(str(tmp_path / "calc.py"))
+    runner.notify_changed(str(tmp_path / "tests" / "test_io.py"))
+    command, related = runner.rewrite("python -m pytest -q && echo done")
+    assert related == [str(tmp_path / "tests" / "test_calc.py"), str(tmp_path / "tests" / "test_io.py")]
+    assert command == f"python -m pytest -q {related[0]} {related[1]} && echo done"
+    runner.close()
+
+
+def test_record_clears_the_changes_after_a_passing_run(runner, project):
+    command, related = runner.rewrite("npm test")
+    runner.record(related, "Command npm test failed with exit code 1, with the following output:\nFAIL")
+    assert runner.changed and runner.stats == {"related_runs": 1, "full_runs": 0}
+    runner.record(related, "Command npm test succeeded with the following output:\nPASS")
+    assert not runner.changed and runner.last_run_related == related
+    assert runner.rewrite("npm test") == ("npm test", [])
+
+
+def test_run_in_the_session(tmp_path):
+    (tmp_path / "calc.py").write_text("")
+    (tmp_path / "test_calc.py").write_text("")
+    session = ShellSession(cwd=str(tmp_path))
+    runner = TestRunner(session=session)
+    runner.notify_changed(str(tmp_path / "calc.py"))
+    # echo stands in for pytest, the arguments show the selected files
+    session.run("pytest() { echo \"pytest $*\"; }", 10)
+    output = runner.run(["pytest -q"], 10)
+    assert f"pytest -q {tmp_path / 'test_calc.py'}" in output
+    assert runner.stats["related_runs"] == 1
+    runner.close()
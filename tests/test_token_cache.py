@@ -0,0 +1,52 @@
+from token_cache import TokenCounterCache
+
+
+class CountingCounter:
+    def __init__(self):
+        self.texts = []
+
+    def __call__(self, text):
+        self.texts.append(text)
+        return len(text.split())
+
+
+def test_hits_and_misses():
+    counter = CountingCounter()
+    cache = TokenCounterCache(counter)
+    assert [cache("a b c"), cache("a b c"), cache("d e"), cache("a b c")] == [3, 3, 2, 3]
+    assert counter.texts == ["a b c", "d e"]
+    assert (cache.hits, cache.misses, cache.hit_rate) == (2, 2, 0.5)
+    assert cache.stats() == {"hits": 2, "misses": 2, "hit_rate": 0.5, "size": 2, "maxsize": 4096}
+
+
+def test_texts_are_told_apart_by_content():
+    counter = CountingCounter()
+    cache = TokenCounterCache(counter)
+    assert cache("") == 0 and cache(" ") == 0 and cache("\ud800 lone surrogate") == 3
+    assert cache.misses == 3 and cache.hits == 0
+
+
+def test_least_recently_used_is_evicted():
+    counter = CountingCounter()
+    cache = TokenCounterCache(counter, maxsize=2)
+    cache("one")
+    cache("two")
+    cache("one")
+    # "two" is the least recently used
+    cache("three")
+    cache("one")
+    assert counter.texts == ["one", "two", "three"]
+    cache("two")
+    assert counter.texts == ["one", "two", "three", "two"]
+    assert cache.stats()["size"] == 2
+
+
+def test_clear():
+    counter = CountingCounter()
+    cache = TokenCounterCache(counter)
+    cache("a")
+    cache("a")
+    cache.clear()
+    assert cache.stats()["size"] == 0 and cache.hit_rate == 0.0
+    cache("a")
+    assert counter.texts == ["a", "a"] and cache.misses == 1
@@ -0,0 +1,178 @@
+import asyncio
+import json
+import threading
+from uuid import uuid4
+
+import pytest
+from langchain.schema import AIMessage, ChatGeneration, HumanMessage, LLMResult
+
+import tracing
+from trace_report import load_spans, self_times
+from tracing import Tracer
+
+
+def word_count(text):
+    return len(text.split())
+
+
+@pytest.fixture
+def tracer(tmp_path):
+    tracer = Tracer(str(tmp_path / "trace.jsonl"), token_counter=word_count)
+    yield tracer
+    tracer.close()
+
+
+def records(tracer):
+    tracer._file.flush()
+    return {span["name"]: span for span in load_spans(tracer.path)}
+
+
+def test_spans_nest_through_the_context(tracer):
+    with tracer.start_span("run") as run:
+        with tracer.start_span("step", step=1):
+            with tracer.start_span("tool"):
+                pass
+        with tracer.start_span("step", step=2) as second:
+            second.set(command="cli")
+        detached = tracer.start_span("detached", current=False)
+        # A span that is not current is not the parent of the next one
+        with tracer.start_span("sibling"):
+            pass
+        detached.end()
+    spans = load_spans(tracer.path)
+    by_id = {span["span_id"]: span for span in spans}
+    parents = {span["name"]: by_id[span["parent_id"]]["name"] if span["parent_id"] else None for span in spans}
+    assert parents == {"run": None, "step": "run", "tool": "step", "detached": "run", "sibling": "run"}
+    assert [span["attributes"] for span in spans if span["name"] == "step"] == [{"step": 1}, {"step": 2, "command": "cli"}]
+    assert tracing._current.get() is None and run.status == "ok"
+
+
+def test_error_status_and_current_span_restored(tracer):
+    with pytest.raises(ValueError):
+        with tracer.start_span("run"):
+            with tracer.start_span("step"):
+                raise ValueError("boom")
+    assert {name: span["status"] for name, span in records(tracer).items()} == {"run": "error", "step": "error"}
+    assert tracing._current.get() is None
+
+
+def test_spans_in_threads_and_tasks_are_children(tracer):
+    async def task():
+        with tracer.start_span("task"):
+            await asyncio.to_thread(in_thread, "to_thread")
+
+    def in_thread(name):
+        with tracer.start_span(name):
+            pass
+
+    async def main():
+        with tracer.start_span("run"):
+            await asyncio.gather(task(), task())
+
+    asyncio.run(main())
+    # A plain thread does not inherit the context, the parent is given
+    with tracer.start_span("other") as other:
+        thread = threading.Thread(target=lambda: tracer.start_span("thread", parent=other).end())
+        thread.start()
+        thread.join()
+    spans = load_spans(tracer.path)
+    by_id = {span["span_id"]: span for span in spans}
+    run = next(span for span in spans if span["name"] == "run")
+    tasks = [span for span in spans if span["name"] == "task"]
+    assert len(tasks) == 2 and all(span["parent_id"] == run["span_id"] for span in tasks)
+    assert sorted(by_id[span["parent_id"]]["span_id"] for span in spans if span["name"] == "to_thread") == sorted(span["span_id"] for span in tasks)
+    assert by_id[next(span for span in spans if span["name"] == "thread")["parent_id"]]["name"] == "other"
+
+
+def test_close_ends_the_open_spans_as_unfinished(tmp_path):
+    tracer = Tracer(str(tmp_path / "trace.jsonl"), token_counter=word_count)
+    run = tracer.start_span("run")
+    tracer.start_span("step")
+    with tracer.start_span("done"):
+        pass
+    tracer.close()
+    statuses = {span["name"]: (span["status"], span["cpu_s"]) for span in load_spans(tracer.path)}
+    assert statuses["done"][0] == "ok"
+    assert statuses["run"] == ("unfinished", None) and statuses["step"] == ("unfinished", None)
+    # Ending it later does not write it twice
+    run.end()
+    assert len(load_spans(tracer.path)) == 3
+
+
+def test_model_calls_are_spans(tracer):
+    handler = tracer.handler
+    messages = [[HumanMessage(content="write the counter component")]]
+    with tracer.start_span("step"):
+        ended, stopped, failed = uuid4(), uuid4(), uuid4()
+        for run_id in (ended, stopped, failed):
+            handler.on_chat_model_start({"id": ["ChatOpenAI"]}, messages, run_id=run_id, invocation_params={"model_name": "gpt-4"})
+        # The span of a model call does not become the current one
+        assert tracing._current.get().name == "step"
+        reply = ChatGeneration(message=AIMessage(content="done"), text="done")
+        handler.on_llm_end(LLMResult(generations=[[reply]], llm_output={"token_usage": {"prompt_tokens": 120, "completion_tokens": 30}}), run_id=ended)
+        for token in ["{", "thoughts ", "so ", "far"]:
+            handler.on_llm_new_token(token, run_id=stopped)
+        handler.on_llm_error(GeneratorExit(), run_id=stopped)
+        handler.on_llm_error(RuntimeError("rate limited"), run_id=failed)
+    spans = load_spans(tracer.path)
+    step = next(span for span in spans if span["name"] == "step")
+    calls = [span for span in spans if span["name"] == "llm.call"]
+    assert all(span["parent_id"] == step["span_id"] and span["cpu_s"] is None for span in calls)
+    assert [(span["status"], span["attributes"]) for span in calls] == [
+        ("ok", {"model": "gpt-4", "prompt_tokens": 120, "completion_tokens": 30}),
+        # Counted in the messages and in what was streamed before the stop
+        ("stopped", {"model": "gpt-4", "prompt_tokens": 4, "completion_tokens": 3}),
+        ("error", {"model": "gpt-4", "prompt_tokens": 4, "completion_tokens": 0}),
+    ]
+
+
+def test_module_functions_without_a_tracer():
+    tracing.set_tracer(None)
+    with tracing.span("step") as span:
+        span.set(step=1)
+        tracing.annotate(command="cli")
+    tracing.start_span("step").end()
+    assert tracing.callbacks() is None
+
+
+def test_module_functions_with_a_tracer(tracer):
+    tracing.set_tracer(tracer)
+    try:
+        with tracing.span("step", step=1):
+            tracing.annotate(command="cli")
+            tracing.start_span("tool").end()
+        assert tracing.callbacks() == [tracer.handler]
+    finally:
+        tracing.set_tracer(None)
+    spans = records(tracer)
+    assert spans["step"]["attributes"] == {"step": 1, "command": "cli"}
+    assert spans["tool"]["parent_id"] == spans["step"]["span_id"]
+
+
+def span(span_id, parent_id, wall_s):
+    return {"span_id": span_id, "parent_id": parent_id, "name": span_id, "wall_s": wall_s}
+
+
+def test_self_times():
+    spans = [
+        span("run", None, 10.0),
+        span("step1", "run", 4.0),
+        span("llm", "step1", 3.0),
+        span("tool", "step1", 0.5),
+        span("step2", "run", 5.0),
+        span("cli", "step2", 5.0),
+    ]
+    assert self_times(spans) == pytest.approx({"run": 1.0, "step1": 0.5, "llm": 3.0, "tool": 0.5, "step2": 0.0, "cli": 5.0})
+
+
+def test_self_times_of_parallel_children_is_not_negative():
+    # Two children run in parallel take more wall time than their parent
+    spans = [span("run", None, 2.0), span("a", "run", 1.5), span("b", "run", 1.5)]
+    assert self_times(spans) == {"run": 0.0, "a": 1.5, "b": 1.5}
+
+
+def test_load_spans_skips_a_torn_line(tmp_path):
+    path = tmp_path / "trace.jsonl"
+    lines = [json.dumps(span("run", None, 1.0)), json.dumps(span("step", "run", 0.5)), '{"span_id": "to']
+    path.write_text("\n".join(lines), encoding="utf-8")
+    assert [span["span_id"] for span in load_spans(str(path))] == ["run", "step"]
@@ -0,0 +1,115 @@
+import faiss
+import pytest
+from langchain.schema.messages import SystemMessage
+
+from checkpoint import Checkpoint, CheckpointManager
+from memory_writer import HashingEmbeddings
+from vector_memory import DiskFAISS
+
+DIMENSION = 128
+
+
+class CountingEmbeddings(HashingEmbeddings):
+    calls: int = 0
+
+    def embed_documents(self, texts):
+        self.calls += len(texts)
+        return super().embed_documents(texts)
+
+
+def step_text(i):
+    return f"Step {i}: write_file src/components/Component{i}.js, tests for Component{i} failing"
+
+
+def open_memory(directory, **kwargs):
+    embeddings = CountingEmbeddings(size=DIMENSION)
+    return DiskFAISS.open(str(directory), embeddings, DIMENSION, **kwargs), embeddings
+
+
+def top(memory, i):
+    return memory.similarity_search(step_text(i), k=1)[0].page_content
+
+
+def test_reopen_memory_mapped(tmp_path):
+    memory, _ = open_memory(tmp_path)
+    memory.add_texts([step_text(i) for i in range(20)])
+    memory.close()
+    memory, embeddings = open_memory(tmp_path)
+    assert memory._mapped and memory.index.ntotal == 20
+    assert top(memory, 7) == step_text(7)
+    assert embeddings.calls == 0
+    # The mapped index is read back into memory before the next add
+    memory.add_texts([step_text(20)])
+    assert not memory._mapped and memory.index.ntotal == 21
+    memory.close()
+    assert open_memory(tmp_path)[0].index.ntotal == 21
+
+
+@pytest.mark.parametrize("index_type, index_class", [("ivf", faiss.IndexIVFFlat), ("hnsw", faiss.IndexHNSWFlat)])
+def test_migration(tmp_path, index_type, index_class):
+    memory, _ = open_memory(tmp_path, migrate_at=200, index_type=index_type)
+    memory.add_texts([step_text(i) for i in range(150)])
+    assert isinstance(memory.index, faiss.IndexFlat)
+    memory.add_texts([step_text(i) for i in range(150, 250)])
+    assert isinstance(memory.index, index_class)
+    assert memory.stats["migrations"] == 1 and memory.index.ntotal == 250
+    # Added after the migration, to the approximate index
+    memory.add_texts([step_text(250)])
+    assert memory.stats["migrations"] == 1
+    assert [top(memory, i) for i in (3, 180, 250)] == [step_text(i) for i in (3, 180, 250)]
+    memory.close()
+
+    memory, _ = open_memory(tmp_path, migrate_at=200, index_type=index_type)
+    assert isinstance(memory.index, index_class) and memory.index.ntotal == 251
+    assert top(memory, 42) == step_text(42)
+
+
+def test_documents_missing_from_the_index_are_embedded_on_open(tmp_path):
+    memory, _ = open_memory(tmp_path)
+    memory.add_texts([step_text(i) for i in range(10)])
+    memory.persist()
+    # A crash before the next persist: the docstore has documents the saved index lacks
+    memory.add_texts([step_text(i) for i in range(10, 16)])
+    memory.docstore.close()
+
+    memory, embeddings = open_memory(tmp_path)
+    assert memory.stats["reembedded"] == 6 and embeddings.calls == 6
+    assert memory.index.ntotal == len(memory.docstore) == 16
+    assert top(memory, 13) == step_text(13)
+    memory.close()
+    memory, embeddings = open_memory(tmp_path)
+    assert memory.stats["reembedded"] == 0 and embeddings.calls == 0
+
+
+def test_dimension_mismatch(tmp_path):
+    memory, _ = open_memory(tmp_path)
+    memory.add_texts([step_text(0)])
+    memory.close()
+    with pytest.raises(ValueError, match="has 128 dimensions, the embeddings have 64"):
+        DiskFAISS.open(str(tmp_path), HashingEmbeddings(size=64), 64)
+
+
+def test_unknown_index_type(tmp_path):
+    with pytest.raises(ValueError, match="Unknown index type"):
+        open_memory(tmp_path, index_type="lsh")
+
+
+def step_metadata(i):
+    return f'```json\n{{"step": {i}, "Action": "write_file src/components/Component{i}.js"}}\n```'
+
+
+def test_resume_does_not_add_the_persisted_memories_twice(tmp_path):
+    memory, _ = open_memory(tmp_path / "memory")
+    memory.add_texts([step_metadata(i) for i in range(1, 6)])
+    memory.persist()
+    checkpoint = Checkpoint(step=5, user_input="", goals=[], messages=15, kanban={}, manifest={}, memory_step=5, memories=5)
+    # Steps 6 and 7 completed after the checkpoint, the memory of step 6 was written before the crash
+    memory.add_texts([step_metadata(6)])
+    memory.close()
+    messages = [SystemMessage(content="ok", additional_kwargs={"metadata": step_metadata(i)}) for i in range(1, 8)]
+
+    memory, _ = open_memory(tmp_path / "memory")
+    memory = CheckpointManager(str(tmp_path / "checkpoint"), str(tmp_path)).restore_memory(checkpoint, memory, messages)
+    contents = [memory.docstore.search(doc_id).page_content for doc_id in memory.docstore.ids]
+    assert contents == [step_metadata(i) for i in range(1, 8)]
+    assert memory.index.ntotal == 7